@@ -0,0 +1,166 @@
+import asyncio, traceback
+
+from ServerWorker import ServerWorker
+from UdpBatchSender import UdpBatchSender
+from Scheduler import PacingScheduler
+from Rtcp import bindPortPair
+from RtspMessage import RtspParser, RtspError, InterleavedFrame
+from InterleavedWriter import InterleavedWriter
+
+class AsyncServerWorker(ServerWorker):
+	"""RTSP session driven by an asyncio event loop instead of threads.
+
+	Request handling (SETUP/PLAY/PAUSE/TEARDOWN) and RTP pacing are
+	inherited from ServerWorker; the shared scheduler is driven by the
+	loop instead of its own thread, so only the RTSP transport hooks are
+	replaced."""
+
+	def __init__(self, clientInfo, server):
+		ServerWorker.__init__(self, clientInfo)
+		self.server = server
+
+	def sendRtspReply(self, reply):
+		"""Write an RTSP reply on the client's transport."""
+		if 'writer' in self.clientInfo:
+			self.clientInfo['writer'].sendReply(reply.encode())
+			return
+		self.clientInfo['rtspSocket'][0].write(reply.encode())
+	
+	def makeWriter(self):
+		return TransportWriter(self.clientInfo['rtspSocket'][0], self.getScheduler())
+
+	def closeConnection(self):
+		"""Close the client's transport; connection_lost follows."""
+		self.clientInfo['rtspSocket'][0].close()
+
+class TransportWriter(InterleavedWriter):
+	"""InterleavedWriter on an asyncio transport, which buffers what the
+	socket does not take; that buffer counts against the limit."""
+
+	def backlog(self):
+		return len(self.pending) + self.sock.get_write_buffer_size()
+
+	def flushLocked(self):
+		if not self.pending:
+			return
+		if self.sock.is_closing():
+			self.closed = True
+		else:
+			self.sock.write(bytes(self.pending))
+		self.pending = bytearray()
+
+class RtspProtocol(asyncio.Protocol):
+	"""RTSP control connection of one client."""
+
+	def __init__(self, server):
+		self.server = server
+		self.parser = RtspParser()
+		self.transport = None
+		self.worker = None
+
+	def connection_made(self, transport):
+		self.transport = transport
+		clientInfo = {}
+		clientInfo['rtspSocket'] = (transport, transport.get_extra_info('peername'))
+		self.worker = AsyncServerWorker(clientInfo, self.server)
+		self.server.sessions.add(self.worker)
+
+	def data_received(self, data):
+		seq = 0
+		try:
+			for request in self.parser.feed(data):
+				if isinstance(request, InterleavedFrame):
+					self.worker.receiveInterleaved(request)
+					continue
+				if ServerWorker.VERBOSE:
+					print("Data received:\n" + str(request))
+				seq = request.header('cseq', '0')
+				self.worker.processRtspRequest(request)
+		except RtspError as e:
+			print("Bad request: %s" % e)
+			self.worker.replyError(self.worker.BAD_REQUEST_400, 0)
+			self.transport.close()
+		except Exception:
+			# connection_lost releases the session
+			traceback.print_exc()
+			self.worker.replyError(self.worker.CON_ERR_500, seq)
+			self.transport.close()
+
+	def connection_lost(self, exc):
+		# The client went away without TEARDOWN
+		self.worker.closeSession()
+		self.worker.closeWriter()
+		self.server.sessions.discard(self.worker)
+
+class AsyncServer:
+	"""Single-threaded RTSP/RTP server built on asyncio."""
+
+	def __init__(self):
+		self.loop = None
+		self.rtpSender = None
+		self.scheduler = None
+		self.timer = None
+		self.timerDeadline = None
+		self.sessions = set()
+
+	async def serve(self, port, reusePort=False):
+		"""Open the RTSP listener and the shared RTP endpoint, then serve forever."""
+		self.loop = asyncio.get_running_loop()
+
+		# One non-blocking UDP socket carries the RTP packets of every session,
+		# the next port their RTCP
+		sock, rtcpSocket = bindPortPair(ServerWorker.RTP_PORT)
+		sock.setblocking(False)
+		rtcpSocket.setblocking(False)
+		self.rtpSender = UdpBatchSender(sock, mode=ServerWorker.SEND_MODE)
+		ServerWorker.rtcpSocket = rtcpSocket
+		self.loop.add_reader(rtcpSocket, self.readRtcp, rtcpSocket)
+		self.scheduler = PacingScheduler(ServerWorker.GLOBAL_RATE, self.rtpSender.flush)
+		self.scheduler.onWake = self.wakeScheduler
+		# Every session paces its packets through these
+		ServerWorker.rtpSender = self.rtpSender
+		ServerWorker.scheduler = self.scheduler
+		for channel in ServerWorker.CHANNELS.values():
+			channel.start(self.scheduler, self.rtpSender)
+
+		server = await self.loop.create_server(lambda: RtspProtocol(self), '', port, backlog=1024,
+			reuse_port=reusePort or None)
+		print("Async RTSP server listening on port %d" % port)
+		async with server:
+			await server.serve_forever()
+
+	def readRtcp(self, sock):
+		"""Take in the RTCP packets waiting on the socket."""
+		while True:
+			try:
+				data, address = sock.recvfrom(2048)
+			except (BlockingIOError, InterruptedError):
+				return
+			except OSError:
+				# e.g. ICMP port unreachable from a client that went away
+				continue
+			ServerWorker.handleRtcp(data, address)
+
+	def wakeScheduler(self, when):
+		"""Make sure the loop runs the scheduler by 'when'.
+
+		One loop timer serves every session: sessions whose packets are due
+		together are sent in one batch after the scheduler's run."""
+		if self.timer is not None:
+			if self.timerDeadline <= when:
+				return
+			self.timer.cancel()
+		self.timerDeadline = when
+		self.timer = self.loop.call_at(when, self.runScheduler)
+
+	def runScheduler(self):
+		self.timer = None
+		deadline = self.scheduler.runDue(self.loop.time())
+		if deadline is not None:
+			self.wakeScheduler(deadline)
+
+	def main(self, port, reusePort=False):
+		try:
+			asyncio.run(self.serve(port, reusePort))
+		except KeyboardInterrupt:
+			pass
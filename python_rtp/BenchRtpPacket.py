@@ -0,0 +1,87 @@
+import time, tracemalloc, argparse
+
+from RtpPacket import RtpPacket, HEADER_SIZE
+
+def benchEncodeNew(payload, buf):
+	"""Allocate a packet and copy header plus payload into a new bytes object."""
+	packet = RtpPacket()
+	packet.encode(2, 0, 0, 0, 1, 0, 26, 1234, payload, 90000)
+	return packet.getPacket()
+
+def makeEncodeInto(payload, buf):
+	"""Reuse one packet object and one send buffer."""
+	packet = RtpPacket()
+	def run(payload, buf):
+		packet.encode(2, 0, 0, 0, 1, 0, 26, 1234, payload, 90000)
+		return packet.packInto(buf)
+	return run
+
+def makeScatter(payload, buf):
+	"""Reuse one packet object; header buffer plus payload view for sendmsg."""
+	packet = RtpPacket()
+	header = bytearray(HEADER_SIZE)
+	def run(payload, buf):
+		packet.encode(2, 0, 0, 0, 1, 0, 26, 1234, payload, 90000)
+		packet.packHeaderInto(header)
+		return (header, payload)
+	return run
+
+def benchDecodeNew(datagram, nbytes):
+	"""Allocate a packet per datagram, as recv() would."""
+	packet = RtpPacket()
+	packet.decode(bytes(datagram[:nbytes]))
+	return packet.getPayload()
+
+def makeDecodeInto(datagram, nbytes):
+	"""Reuse one packet object over a recv_into buffer."""
+	packet = RtpPacket()
+	def run(datagram, nbytes):
+		packet.decode(datagram, nbytes)
+		return packet.getPayload()
+	return run
+
+def measure(func, a, b, count):
+	"""Return (ns per call, bytes allocated at peak by one call)."""
+	for _ in range(1000):
+		func(a, b)
+	start = time.perf_counter_ns()
+	for _ in range(count):
+		func(a, b)
+	elapsed = time.perf_counter_ns() - start
+
+	tracemalloc.start()
+	func(a, b)
+	tracemalloc.reset_peak()
+	base = tracemalloc.get_traced_memory()[0]
+	func(a, b)
+	peak = tracemalloc.get_traced_memory()[1] - base
+	tracemalloc.stop()
+	return elapsed / count, peak
+
+def main():
+	parser = argparse.ArgumentParser(description="Micro-benchmark of RtpPacket encode/decode.")
+	parser.add_argument('--payload', type=int, default=1380)
+	parser.add_argument('--count', type=int, default=200000)
+	args = parser.parse_args()
+
+	payload = memoryview(bytes(args.payload))
+	buf = bytearray(65536)
+	sample = RtpPacket()
+	sample.encode(2, 0, 0, 0, 1, 1, 26, 1234, payload, 90000)
+	nbytes = sample.packInto(buf)
+
+	cases = [
+		("encode + getPacket (new object)", benchEncodeNew, payload, buf),
+		("encode + packInto (reused)", makeEncodeInto(payload, buf), payload, buf),
+		("encode + scatter header (reused)", makeScatter(payload, buf), payload, buf),
+		("decode from bytes (new object)", benchDecodeNew, buf, nbytes),
+		("decode from recv_into buffer (reused)", makeDecodeInto(buf, nbytes), buf, nbytes),
+	]
+	print("%d-byte payload" % args.payload)
+	print("%-40s %10s %14s" % ("case", "ns/packet", "bytes alloc'd"))
+	for name, func, a, b in cases:
+		ns, peak = measure(func, a, b, args.count)
+		print("%-40s %10.0f %14d" % (name, ns, peak))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,106 @@
+import time, random, argparse
+
+from RtspMessage import RtspParser, RtspError, interleave
+
+REQUEST = (b'PLAY movie.Mjpeg RTSP/1.0\r\nCSeq: 2\r\nSession: 123456\r\n'
+	b'Range: npt=0.000-\r\n\r\n')
+BODY_REQUEST = (b'SET_PARAMETER movie.Mjpeg RTSP/1.0\r\nCSeq: 3\r\nSession: 123456\r\n'
+	b'Content-Type: text/parameters\r\nContent-Length: 16\r\n\r\nbarparam: barval')
+# An RTP packet of 1400 bytes sent on the RTSP connection
+RTP_FRAME = interleave(0, bytes(1400)) + bytes(1400)
+
+def chunksWhole(data, rng):
+	return [data]
+
+def chunksBytes(data, rng):
+	"""One byte per read, the worst case of a slow sender."""
+	return [data[i:i + 1] for i in range(len(data))]
+
+def chunksRandom(data, rng):
+	chunks = []
+	pos = 0
+	while pos < len(data):
+		size = rng.randint(1, 64)
+		chunks.append(data[pos:pos + size])
+		pos += size
+	return chunks
+
+def measure(message, split, count, pipeline, rng):
+	"""Return messages parsed per second, feeding 'pipeline' messages per stream."""
+	stream = message * pipeline
+	chunks = split(stream, rng)
+	parser = RtspParser()
+	rounds = max(1, count // pipeline)
+	parsed = 0
+	start = time.perf_counter()
+	for _ in range(rounds):
+		for chunk in chunks:
+			for message in parser.feed(chunk):
+				parsed += 1
+	elapsed = time.perf_counter() - start
+	assert parsed == rounds * pipeline
+	return parsed / elapsed
+
+def mutate(data, rng):
+	"""Return a copy of 'data' with random bytes flipped, dropped or repeated."""
+	data = bytearray(data)
+	for _ in range(rng.randint(1, 8)):
+		pos = rng.randrange(len(data))
+		op = rng.randrange(3)
+		if op == 0:
+			data[pos] = rng.randrange(256)
+		elif op == 1:
+			del data[pos]
+		else:
+			data[pos:pos] = data[pos:pos + rng.randint(1, 32)]
+		if not data:
+			break
+	return bytes(data)
+
+def fuzz(count, rng):
+	"""Feed random and mutated input; anything but RtspError is a bug."""
+	seeds = [REQUEST, BODY_REQUEST, REQUEST + BODY_REQUEST, RTP_FRAME[:64] + REQUEST]
+	rejected = 0
+	for i in range(count):
+		if i % 4 == 0:
+			data = bytes(rng.randrange(256) for _ in range(rng.randint(1, 512)))
+		else:
+			data = mutate(rng.choice(seeds), rng)
+		parser = RtspParser(maxHeaderSize=1024, maxBodySize=4096)
+		try:
+			for chunk in chunksRandom(data, rng):
+				for message in parser.feed(chunk):
+					pass
+		except RtspError:
+			rejected += 1
+	return rejected
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark and fuzz the incremental RTSP parser.")
+	parser.add_argument('--count', type=int, default=200000, help="messages per case")
+	parser.add_argument('--fuzz', type=int, default=0, metavar='N', help="also feed N random/mutated inputs")
+	parser.add_argument('--seed', type=int, default=1)
+	args = parser.parse_args()
+	rng = random.Random(args.seed)
+
+	cases = [
+		("whole request per read", REQUEST, chunksWhole, 1),
+		("one byte per read", REQUEST, chunksBytes, 1),
+		("random 1-64 byte reads", REQUEST, chunksRandom, 1),
+		("16 pipelined per read", REQUEST, chunksWhole, 16),
+		("request with body", BODY_REQUEST, chunksWhole, 1),
+		("16 interleaved RTP frames per read", RTP_FRAME, chunksWhole, 16),
+	]
+	print("%-40s %12s" % ("case", "messages/s"))
+	for name, message, split, pipeline in cases:
+		# Byte-at-a-time feeding is much slower; keep its run short
+		count = args.count // 20 if split is chunksBytes else args.count
+		print("%-40s %12.0f" % (name, measure(message, split, count, pipeline, rng)))
+
+	if args.fuzz:
+		start = time.perf_counter()
+		rejected = fuzz(args.fuzz, rng)
+		print("fuzz: %d inputs, %d rejected, no other errors (%.1fs)" % (args.fuzz, rejected, time.perf_counter() - start))
+
+if __name__ == "__main__":
+	main()
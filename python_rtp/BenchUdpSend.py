@@ -0,0 +1,97 @@
+import socket, threading, time, argparse
+
+from UdpBatchSender import UdpBatchSender, SEND_MODES
+
+class Receiver:
+	"""Drain a loopback UDP socket and count datagrams."""
+
+	def __init__(self):
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+		self.sock.bind(('127.0.0.1', 0))
+		self.sock.settimeout(0.2)
+		self.address = self.sock.getsockname()
+		self.count = 0
+		self.running = True
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def run(self):
+		buf = bytearray(65536)
+		while self.running:
+			try:
+				self.sock.recv_into(buf)
+				self.count += 1
+			except socket.timeout:
+				pass
+
+	def stop(self):
+		self.running = False
+		self.thread.join()
+		self.sock.close()
+
+def makeFrames(frameSize, mtu):
+	"""Return the datagrams of one fragmented frame."""
+	count, last = divmod(frameSize, mtu)
+	packets = [bytes(mtu) for _ in range(count)]
+	if last:
+		packets.append(bytes(last))
+	return packets
+
+def runPerPacket(packets, receivers, duration):
+	"""Baseline: one sendto syscall per datagram, one socket per session (as before)."""
+	socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in receivers]
+	sent = 0
+	end = time.perf_counter() + duration
+	start = time.perf_counter()
+	while time.perf_counter() < end:
+		for sock, receiver in zip(socks, receivers):
+			for packet in packets:
+				sock.sendto(packet, receiver.address)
+			sent += len(packets)
+	elapsed = time.perf_counter() - start
+	for sock in socks:
+		sock.close()
+	return sent, sent, elapsed
+
+def runBatched(mode, packets, receivers, duration):
+	"""One shared socket; every frame tick queues all sessions and flushes once."""
+	sender = UdpBatchSender(mode=mode)
+	end = time.perf_counter() + duration
+	start = time.perf_counter()
+	while time.perf_counter() < end:
+		for receiver in receivers:
+			for packet in packets:
+				sender.queue(packet, receiver.address)
+		sender.flush()
+	elapsed = time.perf_counter() - start
+	sender.close()
+	return sender.sent, sender.syscalls, elapsed
+
+def main():
+	parser = argparse.ArgumentParser(description="Loopback packets/sec benchmark of the RTP send path.")
+	parser.add_argument('--sessions', type=int, default=8)
+	parser.add_argument('--frame-size', type=int, default=60000)
+	parser.add_argument('--mtu', type=int, default=1400)
+	parser.add_argument('--duration', type=float, default=2.0)
+	args = parser.parse_args()
+
+	packets = makeFrames(args.frame_size, args.mtu)
+	print("%d sessions, %d packets per frame, MTU %d" % (args.sessions, len(packets), args.mtu))
+	print("%-10s %12s %12s %14s" % ("mode", "packets/s", "syscalls/s", "received"))
+
+	modes = ['per-packet'] + [mode for mode in SEND_MODES if mode != 'auto']
+	for mode in modes:
+		receivers = [Receiver() for _ in range(args.sessions)]
+		if mode == 'per-packet':
+			sent, syscalls, elapsed = runPerPacket(packets, receivers, args.duration)
+		else:
+			sent, syscalls, elapsed = runBatched(mode, packets, receivers, args.duration)
+		time.sleep(0.3)
+		received = sum(r.count for r in receivers)
+		for receiver in receivers:
+			receiver.stop()
+		print("%-10s %12.0f %12.0f %13.1f%%" % (mode, sent / elapsed, syscalls / elapsed, 100.0 * received / max(sent, 1)))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,118 @@
+import socket, struct, threading
+
+from VideoStream import VideoStream
+from JpegPacketizer import JpegPacketizer
+from RtpPacket import HEADER_SIZE
+from Scheduler import PacedStream
+
+# RTP header split for the fan-out: first two bytes (V/P/X/CC, M/PT),
+# sequence number, timestamp, SSRC
+SPLIT_HEADER = struct.Struct('!HHII')
+
+class Subscriber:
+	"""Per-session state of a channel viewer: only what differs between viewers."""
+	__slots__ = ('address', 'ssrc', 'seqnum')
+
+	def __init__(self, address, ssrc):
+		self.address = address
+		self.ssrc = ssrc
+		self.seqnum = 0
+
+class Channel:
+	"""A scheduled program read and packetized once, fanned out to many sessions.
+
+	Frames are paced like a session's, by a PacedStream on the shared
+	scheduler, at the movie's own rate unless 'fps' is given; every packet
+	is charged to the global bandwidth cap once per copy sent. For every
+	subscriber only a 12-byte RTP header carrying its own sequence number
+	and SSRC is built; the payload buffer is shared by all of them and
+	handed to the kernel by scatter/gather. Viewers joining mid-stream
+	start with the next frame. With a multicast group, the packets are
+	also sent once to the group for viewers that asked for multicast."""
+
+	def __init__(self, name, filename, mtu, fps=None, multicast=None, cache=None):
+		self.name = name
+		self.stream = VideoStream(filename, fps, cache)
+		self.packetizer = JpegPacketizer(mtu, fps=self.stream.fps)
+		self.multicast = multicast
+		# False where another process sends the group its copy
+		self.sendMulticast = True
+		self.subscribers = {}
+		# The subscribers the frame being sent goes to
+		self.onAir = []
+		self.lock = threading.Lock()
+		self.sender = None
+		self.pacer = None
+		self.frames = 0
+
+	def subscribe(self, key, address, ssrc):
+		"""Start sending to 'address' from the next frame on."""
+		with self.lock:
+			self.subscribers[key] = Subscriber(address, ssrc)
+
+	def unsubscribe(self, key):
+		with self.lock:
+			self.subscribers.pop(key, None)
+
+	def start(self, scheduler, sender):
+		"""Start broadcasting on 'scheduler'; packets go out through 'sender'."""
+		self.sender = sender
+		if self.multicast:
+			# Keep multicast on the local network and visible to local clients
+			sender.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+			sender.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+		self.pacer = PacedStream(scheduler, self.nextPackets, self.send, self.stream.fps,
+			skipFrame=self.skipFrame, cost=self.cost)
+		self.pacer.start()
+
+	def nextFrame(self):
+		"""Return the next frame of the program, which loops."""
+		data = self.stream.nextFrame()
+		if not data:
+			self.stream.seek(0)
+			data = self.stream.nextFrame()
+		return data
+
+	def nextPackets(self):
+		"""Read and packetize the next frame for the current subscribers."""
+		data = self.nextFrame()
+		if not data:
+			return None
+		with self.lock:
+			self.onAir = list(self.subscribers.values())
+		self.frames += 1
+		return self.packetizer.packetize(data, self.stream.frameNbr())
+
+	def skipFrame(self):
+		self.nextFrame()
+
+	def cost(self, packet):
+		copies = len(self.onAir)
+		if self.multicast and self.sendMulticast:
+			copies += 1
+		return len(packet) * copies
+
+	def send(self, packet):
+		"""Queue one packet for the group and every subscriber; the scheduler flushes."""
+		if self.multicast and self.sendMulticast:
+			self.sender.queue(packet, self.multicast)
+		# Split the packet once into header fields and a shared payload
+		flags, _, timestamp, _ = SPLIT_HEADER.unpack_from(packet)
+		payload = packet[HEADER_SIZE:]
+		pack = SPLIT_HEADER.pack
+		queue = self.sender.queue
+		for sub in self.onAir:
+			queue((pack(flags, sub.seqnum, timestamp, sub.ssrc), payload), sub.address)
+			sub.seqnum = (sub.seqnum + 1) & 0xFFFF
+
+def parseChannel(spec):
+	"""Parse 'NAME=FILE[@GROUP:PORT]' into (name, file, multicast address or None)."""
+	name, _, rest = spec.partition('=')
+	if not name or not rest:
+		raise ValueError("expected NAME=FILE[@GROUP:PORT], got %r" % spec)
+	filename, _, group = rest.partition('@')
+	multicast = None
+	if group:
+		host, _, port = group.rpartition(':')
+		multicast = (host, int(port))
+	return name, filename, multicast
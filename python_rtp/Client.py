@@ -1,39 +1,32 @@
 from tkinter import *
 import tkinter.messagebox
-from PIL import Image, ImageTk
-import socket, threading, sys, traceback, os
+import time
+from PIL import ImageTk
 
-from RtpPacket import RtpPacket
+import Metrics
+from StreamClient import StreamClient
+from FrameSinks import FrameSink
+from FrameDecoder import FrameDecoder
 
-CACHE_FILE_NAME = "cache-"
-CACHE_FILE_EXT = ".jpg"
+# How often the Tk main loop picks up decoded frames (ms)
+DISPLAY_POLL_MS = 10
 
-class Client:
-    INIT = 0
-    READY = 1
-    PLAYING = 2
-    state = INIT
+DISPLAY_SECONDS = Metrics.histogram('rtp_display_seconds', "Time to show one decoded frame in the GUI")
 
-    SETUP = 0
-    PLAY = 1
-    PAUSE = 2
-    TEARDOWN = 3
+class Client(FrameSink):
+    """Tk GUI on top of StreamClient: buttons drive the session and
+    frames handed to the sink are decoded and shown in a label."""
 
     # Initiation..
-    def __init__(self, master, serveraddr, serverport, rtpport, filename):
+    def __init__(self, master, serveraddr, serverport, rtpport, filename, draftSize=None, playoutDelay=0.1, multicast=False):
         self.master = master
         self.master.protocol("WM_DELETE_WINDOW", self.handler)
         self.createWidgets()
-        self.serverAddr = serveraddr
-        self.serverPort = int(serverport)
-        self.rtpPort = int(rtpport)
-        self.fileName = filename
-        self.rtspSeq = 0
-        self.sessionId = 0
-        self.requestSent = -1
-        self.teardownAcked = 0
+        self.stream = StreamClient(serveraddr, serverport, rtpport, filename, [self], playoutDelay, multicast)
+        self.stream.onError = self.showError
         self.connectToServer()
-        self.frameNbr = 0
+        self.decoder = FrameDecoder(draftSize=draftSize)
+        self.master.after(DISPLAY_POLL_MS, self.updateMovie)
 
     def createWidgets(self):
         """Build GUI."""
@@ -65,249 +58,59 @@ class Client:
         self.label = Label(self.master, height=19)
         self.label.grid(row=0, column=0, columnspan=4, sticky=W+E+N+S, padx=5, pady=5)
 
+    def showError(self, title, message):
+        """Warn about a failure in StreamClient's threads; Tk only runs on the main loop."""
+        self.master.after(0, tkinter.messagebox.showwarning, title, message)
+
     def setupMovie(self):
         """Setup button handler."""
-        if self.state == self.INIT:
-            self.sendRtspRequest(self.SETUP)
+        self.send(self.stream.setup)
 
     def exitClient(self):
         """Teardown button handler."""
-        self.sendRtspRequest(self.TEARDOWN)
+        self.send(self.stream.teardown)
+        self.decoder.stop()
         # Close the gui window
         self.master.destroy()
-        # Delete the cache image from video (if exists)
-        cache_path = CACHE_FILE_NAME + str(self.sessionId) + CACHE_FILE_EXT
-        try:
-            if os.path.exists(cache_path):
-                os.remove(cache_path)
-        except Exception:
-            pass
 
     def pauseMovie(self):
         """Pause button handler."""
-        if self.state == self.PLAYING:
-            self.sendRtspRequest(self.PAUSE)
+        self.send(self.stream.pause)
 
     def playMovie(self):
         """Play button handler."""
-        if self.state == self.READY:
-            # Create a new thread to listen for RTP packets
-            threading.Thread(target=self.listenRtp).start()
-            self.playEvent = threading.Event()
-            self.playEvent.clear()
-            self.sendRtspRequest(self.PLAY)
-
-    def listenRtp(self):
-        """Listen for RTP packets."""
-        while True:
-            try:
-                data = self.rtpSocket.recv(20480)
-                if data:
-                    rtpPacket = RtpPacket()
-                    rtpPacket.decode(data)
-
-                    currFrameNbr = rtpPacket.seqNum()
-                    print("Current Seq Num: " + str(currFrameNbr))
-
-                    if currFrameNbr > self.frameNbr: # Discard the late packet
-                        self.frameNbr = currFrameNbr
-                        self.updateMovie(self.writeFrame(rtpPacket.getPayload()))
-            except Exception:
-                # Stop listening upon requesting PAUSE or TEARDOWN
-                if hasattr(self, 'playEvent') and self.playEvent.isSet():
-                    break
-
-                # Upon receiving ACK for TEARDOWN request,
-                # close the RTP socket
-                if self.teardownAcked == 1:
-                    try:
-                        self.rtpSocket.shutdown(socket.SHUT_RDWR)
-                    except Exception:
-                        pass
-                    try:
-                        self.rtpSocket.close()
-                    except Exception:
-                        pass
-                    break
+        self.send(self.stream.play)
 
-    def writeFrame(self, data):
-        """Write the received frame to a temp image file. Return the image file."""
-        cachename = CACHE_FILE_NAME + str(self.sessionId) + CACHE_FILE_EXT
-        with open(cachename, "wb") as file:
-            file.write(data)
-        return cachename
-
-    def updateMovie(self, imageFile):
-        """Update the image file as video frame in the GUI."""
-        photo = ImageTk.PhotoImage(Image.open(imageFile))
-        self.label.configure(image = photo, height=288)
-        self.label.image = photo
-
-    def connectToServer(self):
-        """Connect to the Server. Start a new RTSP/TCP session."""
-        self.rtspSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def send(self, request):
+        """Send an RTSP request, warning if it cannot be sent."""
         try:
-            self.rtspSocket.connect((self.serverAddr, self.serverPort))
-        except Exception:
-            tkinter.messagebox.showwarning('Connection Failed', 'Connection to \'%s\' failed.' %self.serverAddr)
-
-    def sendRtspRequest(self, requestCode):
-        """Send RTSP request to the server."""
-        request = None
-
-        # Setup request
-        if requestCode == self.SETUP and self.state == self.INIT:
-            # Start thread to receive RTSP replies
-            threading.Thread(target=self.recvRtspReply).start()
-
-            # Update RTSP sequence number.
-            self.rtspSeq += 1
-
-            # Write the RTSP request to be sent.
-            request = f"SETUP {self.fileName} RTSP/1.0\r\nCSeq: {self.rtspSeq}\r\nTransport: RTP/UDP; client_port={self.rtpPort}\r\n\r\n"
-
-            # Keep track of the sent request.
-            self.requestSent = self.SETUP
-
-        # Play request
-        elif requestCode == self.PLAY and self.state == self.READY:
-            # Update RTSP sequence number.
-            self.rtspSeq += 1
-
-            # Write the RTSP request to be sent.
-            request = f"PLAY {self.fileName} RTSP/1.0\r\nCSeq: {self.rtspSeq}\r\nSession: {self.sessionId}\r\n\r\n"
-
-            # Keep track of the sent request.
-            self.requestSent = self.PLAY
-
-        # Pause request
-        elif requestCode == self.PAUSE and self.state == self.PLAYING:
-            # Update RTSP sequence number.
-            self.rtspSeq += 1
-
-            # Write the RTSP request to be sent.
-            request = f"PAUSE {self.fileName} RTSP/1.0\r\nCSeq: {self.rtspSeq}\r\nSession: {self.sessionId}\r\n\r\n"
-
-            # Keep track of the sent request.
-            self.requestSent = self.PAUSE
-
-        # Teardown request
-        elif requestCode == self.TEARDOWN and not self.state == self.INIT:
-            # Update RTSP sequence number.
-            self.rtspSeq += 1
-
-            # Write the RTSP request to be sent.
-            request = f"TEARDOWN {self.fileName} RTSP/1.0\r\nCSeq: {self.rtspSeq}\r\nSession: {self.sessionId}\r\n\r\n"
-
-            # Keep track of the sent request.
-            self.requestSent = self.TEARDOWN
-        else:
-            return
-
-        # Send the RTSP request using rtspSocket.
-        try:
-            self.rtspSocket.send(request.encode())
-            print(f"RTP socket bound on UDP port {self.rtpPort}")
-        except Exception:
-            # If send fails, show warning
+            request()
+        except OSError:
             tkinter.messagebox.showwarning('Send Failed', 'Failed to send RTSP request.')
-            return
-
-        print('\nData sent:\n' + request)
-
-    def recvRtspReply(self):
-        """Receive RTSP reply from the server."""
-        while True:
-            try:
-                reply = self.rtspSocket.recv(1024)
-            except Exception:
-                break
-
-            if reply:
-                # Debug: show raw RTSP reply
-                try:
-                    text = reply.decode("utf-8", errors="replace")
-                    print("\nRTSP Reply received:\n" + text)
-                    self.parseRtspReply(text)
-                except Exception:
-                    traceback.print_exc()
-
-            # Close the RTSP socket upon requesting Teardown
-            if self.requestSent == self.TEARDOWN:
-                try:
-                    self.rtspSocket.shutdown(socket.SHUT_RDWR)
-                except Exception:
-                    pass
-                try:
-                    self.rtspSocket.close()
-                except Exception:
-                    pass
-                break
-
-    def parseRtspReply(self, data):
-        """Parse the RTSP reply from the server."""
-        lines = data.split('\n')
-        # basic safety checks
-        if len(lines) < 3:
-            return
-
-        try:
-            seqNum = int(lines[1].split(' ')[1])
-        except Exception:
-            return
 
-        # Process only if the server reply's sequence number is the same as the request's
-        if seqNum == self.rtspSeq:
-            try:
-                session = int(lines[2].split(' ')[1])
-            except Exception:
-                session = 0
-
-            # New RTSP session ID
-            if self.sessionId == 0:
-                self.sessionId = session
-
-            # Process only if the session ID is the same
-            if self.sessionId == session:
-                try:
-                    code = int(lines[0].split(' ')[1])
-                except Exception:
-                    return
-
-                if code == 200:
-                    if self.requestSent == self.SETUP:
-                        # Update RTSP state.
-                        self.state = self.READY
-
-                        # Open RTP port.
-                        self.openRtpPort()
-                    elif self.requestSent == self.PLAY:
-                        self.state = self.PLAYING
-                    elif self.requestSent == self.PAUSE:
-                        self.state = self.READY
-
-                        # The play thread exits. A new thread is created on resume.
-                        if hasattr(self, 'playEvent'):
-                            self.playEvent.set()
-                    elif self.requestSent == self.TEARDOWN:
-                        self.state = self.INIT
-
-                        # Flag the teardownAcked to close the socket.
-                        self.teardownAcked = 1
-
-    def openRtpPort(self):
-        """Open RTP socket binded to a specified port."""
-        # Create a new datagram socket to receive RTP packets from the server
-        self.rtpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-        # Set the timeout value of the socket to 0.5sec
-        self.rtpSocket.settimeout(0.5)
+    def frame(self, timestamp, data):
+        """Frame sink: decode frames off the Tk thread."""
+        self.decoder.submit(data)
+
+    def updateMovie(self):
+        """Show the newest decoded frame in the GUI. Runs on the Tk main loop."""
+        image = self.decoder.latest()
+        if image is not None:
+            if Metrics.enabled:
+                start = time.perf_counter()
+            photo = ImageTk.PhotoImage(image)
+            self.label.configure(image = photo, height=288)
+            self.label.image = photo
+            if Metrics.enabled:
+                DISPLAY_SECONDS.since(start)
+        self.master.after(DISPLAY_POLL_MS, self.updateMovie)
 
+    def connectToServer(self):
+        """Connect to the Server. Start a new RTSP/TCP session."""
         try:
-            # Bind the socket to the address using the RTP port given by the client user
-            self.rtpSocket.bind(('', self.rtpPort))
-        except Exception:
-            tkinter.messagebox.showwarning('Unable to Bind', 'Unable to bind PORT=%d' % self.rtpPort)
+            self.stream.connect()
+        except OSError:
+            tkinter.messagebox.showwarning('Connection Failed', 'Connection to \'%s\' failed.' %self.stream.serverAddr)
 
     def handler(self):
         """Handler on explicitly closing the GUI window."""
@@ -1,6 +1,7 @@
 import sys
 from tkinter import Tk
 from Client import Client
+import Metrics
 
 if __name__ == "__main__":
 	try:
@@ -9,12 +10,22 @@ if __name__ == "__main__":
 		rtpPort = sys.argv[3]
 		fileName = sys.argv[4]	
 	except:
-		print("[Usage: ClientLauncher.py Server_name Server_port RTP_port Video_file]\n")	
+		print("[Usage: ClientLauncher.py Server_name Server_port RTP_port Video_file [Decode_WxH [Metrics_port]]]\n")	
+	
+	# Optional decode size: large frames are scaled down while decoding
+	draftSize = None
+	if len(sys.argv) > 5:
+		draftSize = tuple(int(v) for v in sys.argv[5].lower().split('x'))
+	
+	# Optional port serving the timings and counters at /metrics
+	if len(sys.argv) > 6:
+		Metrics.serve(int(sys.argv[6]))
 	
 	root = Tk()
 	
 	# Create a new client
-	app = Client(root, serverAddr, serverPort, rtpPort, fileName)
+	app = Client(root, serverAddr, serverPort, rtpPort, fileName, draftSize)
 	app.master.title("RTPClient")	
+	Metrics.addCollector(app.stream.collectMetrics)
 	root.mainloop()
 	
\ No newline at end of file
@@ -0,0 +1,258 @@
+import struct
+from collections import deque
+
+from RtpPacket import HEADER_SIZE, RTP_HEADER
+
+# Payload type of the parity packets (dynamic range)
+FEC_PT = 127
+
+# FEC header (RFC 5109 section 7.3) with the long mask (L = 1): E/L/P/X/CC
+# recovery, M/PT recovery, SN base, TS recovery, length recovery; then the
+# level 0 header: protection length and a 48-bit mask (16 + 32 bits)
+FEC_HEADER = struct.Struct('!BBHIH')
+LEVEL_HEADER = struct.Struct('!HHI')
+FEC_HEADER_SIZE = FEC_HEADER.size + LEVEL_HEADER.size
+L_BIT = 0x40
+
+# Packets one parity packet can cover: sequence numbers SN base .. base + 47
+MAX_SPAN = 48
+
+# Media packets a receiver keeps for recovery, and parity packets it keeps
+# waiting for a second loss to be repaired by another group
+HISTORY = 1024
+PENDING = 64
+
+def validLayout(columns, rows):
+	"""Return True if row and column parity over 'columns' x 'rows' packets fits the mask."""
+	if columns < 1 or rows < 1 or columns * rows < 2:
+		return False
+	return columns <= MAX_SPAN and columns * (rows - 1) + 1 <= MAX_SPAN
+
+def parseLayout(value):
+	"""Parse 'columns=C;rows=R' (an X-FEC header value). Return (columns, rows) or None."""
+	params = {}
+	for param in value.split(';'):
+		name, _, v = param.partition('=')
+		params[name.strip().lower()] = v.strip()
+	try:
+		columns = int(params.get('columns', 0))
+		rows = int(params.get('rows', 1))
+	except ValueError:
+		return None
+	return (columns, rows) if validLayout(columns, rows) else None
+
+class ParityGroup:
+	"""XOR of the media packets one parity packet protects.
+
+	Bodies (everything after the fixed RTP header) are XORed as
+	little-endian integers, so shorter packets are zero-padded for free and
+	the XOR of a whole packet runs in C."""
+	__slots__ = ('base', 'mask', 'first', 'second', 'ts', 'length', 'size', 'body')
+
+	def __init__(self, base):
+		self.base = base
+		self.mask = 0
+		self.first = 0
+		self.second = 0
+		self.ts = 0
+		self.length = 0
+		self.size = 0
+		self.body = 0
+
+	def add(self, seq, packet):
+		b0, b1, _, ts, _ = RTP_HEADER.unpack_from(packet)
+		self.mask |= 1 << (MAX_SPAN - 1 - ((seq - self.base) & 0xFFFF))
+		self.first ^= b0
+		self.second ^= b1
+		self.ts ^= ts
+		length = len(packet) - HEADER_SIZE
+		self.length ^= length
+		if length > self.size:
+			self.size = length
+		self.body ^= int.from_bytes(packet[HEADER_SIZE:], 'little')
+
+class FecEncoder:
+	"""Add XOR parity packets to the RTP packets of a session.
+
+	Each frame's packets are laid out in rows of 'columns' packets: every
+	row gets a parity packet and, with rows > 1, every column of a block of
+	'rows' rows gets one too, so two losses in a row can still be repaired
+	through the columns. Groups never span frames, so a frame can be
+	repaired as soon as its last parity packet arrives. Parity packets are
+	sent in the same RTP session (same SSRC) with payload type 'pt' and
+	their own sequence numbers; they are up to FEC_HEADER_SIZE bytes larger
+	than the largest packet they protect."""
+
+	def __init__(self, ssrc, columns, rows=1, pt=FEC_PT):
+		if not validLayout(columns, rows):
+			raise ValueError("bad FEC layout %dx%d" % (columns, rows))
+		self.ssrc = ssrc
+		self.columns = columns
+		self.rows = rows
+		self.pt = pt
+		self.seqnum = 0
+		self.sent = 0
+
+	def overhead(self):
+		"""Return the bandwidth factor of the parity packets, roughly."""
+		return 1 + 1 / self.columns + (1 / self.rows if self.rows > 1 else 0)
+
+	def protect(self, packets):
+		"""Return a frame's packets with their parity packets after them."""
+		out = list(packets)
+		row = None
+		columns = []
+		ts = 0
+		for index, packet in enumerate(packets):
+			seq = RTP_HEADER.unpack_from(packet)[2]
+			ts = RTP_HEADER.unpack_from(packet)[3]
+			position = index % (self.columns * self.rows)
+			column = position % self.columns
+			if column == 0:
+				row = ParityGroup(seq)
+			row.add(seq, packet)
+			if column == self.columns - 1:
+				out.append(self.parity(row, ts))
+				row = None
+			if self.rows > 1:
+				if position < self.columns:
+					columns.append(ParityGroup(seq))
+				columns[column].add(seq, packet)
+				if position == self.columns * self.rows - 1:
+					out.extend(self.parity(group, ts) for group in columns)
+					columns = []
+		if row is not None and row.mask & (row.mask - 1):
+			# Partial last row; a single packet is not worth a parity packet
+			out.append(self.parity(row, ts))
+		out.extend(self.parity(group, ts) for group in columns if group.mask & (group.mask - 1))
+		return out
+
+	def parity(self, group, ts):
+		"""Return the parity packet of a group."""
+		packet = bytearray(HEADER_SIZE + FEC_HEADER_SIZE + group.size)
+		RTP_HEADER.pack_into(packet, 0, 0x80, self.pt, self.seqnum, ts, self.ssrc)
+		FEC_HEADER.pack_into(packet, HEADER_SIZE, L_BIT | (group.first & 0x3F), group.second,
+			group.base, group.ts, group.length)
+		LEVEL_HEADER.pack_into(packet, HEADER_SIZE + FEC_HEADER.size, group.size,
+			group.mask >> 32, group.mask & 0xFFFFFFFF)
+		packet[HEADER_SIZE + FEC_HEADER_SIZE:] = group.body.to_bytes(group.size, 'little')
+		self.seqnum = (self.seqnum + 1) & 0xFFFF
+		self.sent += 1
+		return packet
+
+class Parity:
+	"""A received parity packet, parsed."""
+	__slots__ = ('ssrc', 'seqs', 'first', 'second', 'ts', 'length', 'size', 'body')
+
+	def __init__(self, data):
+		if len(data) < HEADER_SIZE + FEC_HEADER_SIZE:
+			raise ValueError("FEC packet too short")
+		_, _, _, _, self.ssrc = RTP_HEADER.unpack_from(data)
+		first, self.second, base, self.ts, self.length = FEC_HEADER.unpack_from(data, HEADER_SIZE)
+		self.first = first & 0x3F
+		self.size, maskHigh, maskLow = LEVEL_HEADER.unpack_from(data, HEADER_SIZE + FEC_HEADER.size)
+		if not first & L_BIT:
+			# Short mask: 16 bits only
+			maskLow = 0
+		mask = maskHigh << 32 | maskLow
+		self.seqs = [(base + i) & 0xFFFF for i in range(MAX_SPAN) if mask >> (MAX_SPAN - 1 - i) & 1]
+		body = data[HEADER_SIZE + FEC_HEADER_SIZE:HEADER_SIZE + FEC_HEADER_SIZE + self.size]
+		self.body = int.from_bytes(body, 'little')
+
+class FecDecoder:
+	"""Rebuild lost media packets from parity packets (receiver side).
+
+	Keeps copies of the recent media packets; a parity packet whose group
+	misses exactly one packet yields that packet. Groups missing more wait
+	until other groups (e.g. the columns) have repaired enough of them.
+	Recovered packets are returned as bytes, to be handled like received
+	ones."""
+
+	def __init__(self, pt=FEC_PT):
+		self.pt = pt
+		self.packets = {}
+		self.order = deque()
+		self.pending = deque()
+		self.recovered = 0
+		self.parityReceived = 0
+		self.unrecoverable = 0
+
+	def media(self, seq, data):
+		"""Take in a received media packet. Return the packets it lets us recover."""
+		if seq in self.packets:
+			return []
+		self.store(seq, bytes(data))
+		return self.retry() if self.pending else []
+
+	def parity(self, data):
+		"""Take in a received parity packet. Return the packets recovered."""
+		try:
+			parity = Parity(data)
+		except (ValueError, struct.error):
+			return []
+		self.parityReceived += 1
+		packet = self.repair(parity)
+		if packet is None:
+			if self.missing(parity) > 1:
+				self.pending.append(parity)
+				if len(self.pending) > PENDING:
+					self.pending.popleft()
+					self.unrecoverable += 1
+			return []
+		return [packet] + self.retry()
+
+	def retry(self):
+		"""Repair what the pending parity packets now can."""
+		recovered = []
+		progress = True
+		while progress:
+			progress = False
+			for parity in list(self.pending):
+				missing = self.missing(parity)
+				if missing == 0:
+					self.pending.remove(parity)
+				elif missing == 1:
+					self.pending.remove(parity)
+					packet = self.repair(parity)
+					if packet is None:
+						# Corrupt: the length does not fit the parity
+						self.unrecoverable += 1
+					else:
+						recovered.append(packet)
+					progress = True
+		return recovered
+
+	def missing(self, parity):
+		return sum(1 for seq in parity.seqs if seq not in self.packets)
+
+	def repair(self, parity):
+		"""Return the one packet of the group that is missing, or None."""
+		missing = [seq for seq in parity.seqs if seq not in self.packets]
+		if len(missing) != 1:
+			return None
+		seq = missing[0]
+		first, second, ts, length, body = parity.first, parity.second, parity.ts, parity.length, parity.body
+		for other in parity.seqs:
+			if other == seq:
+				continue
+			packet = self.packets[other]
+			b0, b1, _, t, _ = RTP_HEADER.unpack_from(packet)
+			first ^= b0
+			second ^= b1
+			ts ^= t
+			length ^= len(packet) - HEADER_SIZE
+			body ^= int.from_bytes(packet[HEADER_SIZE:], 'little')
+		if length > parity.size:
+			return None
+		packet = bytearray(HEADER_SIZE + length)
+		RTP_HEADER.pack_into(packet, 0, 0x80 | (first & 0x3F), second, seq, ts, parity.ssrc)
+		packet[HEADER_SIZE:] = body.to_bytes(parity.size, 'little')[:length]
+		self.store(seq, bytes(packet))
+		self.recovered += 1
+		return packet
+
+	def store(self, seq, packet):
+		self.packets[seq] = packet
+		self.order.append(seq)
+		if len(self.order) > HISTORY:
+			self.packets.pop(self.order.popleft(), None)
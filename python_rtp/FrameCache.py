@@ -0,0 +1,104 @@
+import threading, queue
+from collections import OrderedDict
+
+DEFAULT_BUDGET = 64 << 20
+DEFAULT_READ_AHEAD = 40
+
+def frameKey(movie, index):
+	"""Return the cache key of a frame; a movie replaced on disk gets new keys."""
+	return (movie.path, movie.fileSize, movie.fileMtime, index)
+
+class FrameCache:
+	"""Process-wide cache of movie frames keyed by (movie file, frame number).
+
+	Frames are copied out of the movie mapping once and then shared by
+	every session, so page faults and copies happen per distinct frame
+	instead of per viewer. The least recently used frames are evicted when
+	the total size exceeds the byte budget. A background thread loads the
+	next frames of active streams (read-ahead) so that the send path
+	rarely misses."""
+
+	def __init__(self, budget=DEFAULT_BUDGET, readAhead=DEFAULT_READ_AHEAD):
+		self.budget = budget
+		self.readAhead = readAhead
+		self.frames = OrderedDict()
+		self.size = 0
+		self.lock = threading.Lock()
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.prefetched = 0
+
+		self.requests = queue.Queue()
+		if readAhead:
+			threading.Thread(target=self.readAheadLoop, daemon=True).start()
+
+	def get(self, movie, index):
+		"""Return frame 'index' of 'movie', loading it on a miss."""
+		key = frameKey(movie, index)
+		with self.lock:
+			frame = self.frames.get(key)
+			if frame is not None:
+				self.frames.move_to_end(key)
+				self.hits += 1
+				return frame
+			self.misses += 1
+		return self.load(movie, index, key)
+
+	def load(self, movie, index, key):
+		"""Copy a frame out of the movie and insert it into the cache."""
+		frame = bytes(movie.getFrame(index))
+		with self.lock:
+			if key in self.frames:
+				return self.frames[key]
+			self.frames[key] = frame
+			self.size += len(frame)
+			while self.size > self.budget and len(self.frames) > 1:
+				_, old = self.frames.popitem(last=False)
+				self.size -= len(old)
+				self.evictions += 1
+		return frame
+
+	def prefetch(self, movie, start, count):
+		"""Ask the read-ahead thread to load frames [start, start + count)."""
+		if self.readAhead:
+			self.requests.put((movie, start, count))
+
+	def readAheadLoop(self):
+		while True:
+			movie, start, count = self.requests.get()
+			end = min(start + count, movie.frameCount())
+			for index in range(start, end):
+				key = frameKey(movie, index)
+				with self.lock:
+					if key in self.frames:
+						continue
+				try:
+					self.load(movie, index, key)
+				except (ValueError, IndexError):
+					# The movie was closed meanwhile
+					break
+				self.prefetched += 1
+
+	def stats(self):
+		"""Return hit/miss counters and memory usage as a dict."""
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'hitRatio': self.hits / lookups if lookups else 0.0,
+				'evictions': self.evictions,
+				'prefetched': self.prefetched,
+				'frames': len(self.frames),
+				'bytes': self.size,
+				'budget': self.budget,
+			}
+
+	def report(self):
+		"""Return a one-line summary of the cache statistics."""
+		s = self.stats()
+		return "Frame cache: %d hits, %d misses (%.1f%% hit), %d prefetched, %d evicted, %d frames, %.1f/%.1f MB" % (
+			s['hits'], s['misses'], 100 * s['hitRatio'], s['prefetched'], s['evictions'], s['frames'],
+			s['bytes'] / 1e6, s['budget'] / 1e6)
@@ -0,0 +1,82 @@
+import io, threading, time
+from collections import deque
+
+from PIL import Image
+
+import Metrics
+
+DECODE_SECONDS = Metrics.histogram('rtp_decode_seconds', "Time to decode one JPEG frame")
+
+class FrameDecoder:
+    """Decode JPEG payloads to images on a worker thread.
+
+    Only the newest undecoded payload is kept: if the decoder falls
+    behind, older payloads are replaced before they are decoded. Decoded
+    images go to a bounded queue that drops the oldest entry when full,
+    so the consumer (the Tk main loop) always finds the newest frame."""
+
+    def __init__(self, maxDecoded=2, draftSize=None):
+        self.draftSize = draftSize
+        self.decoded = deque(maxlen=maxDecoded)
+        self.pending = None
+        self.cond = threading.Condition()
+        self.running = True
+        self.submitted = 0
+        self.skipped = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, payload):
+        """Hand a JPEG payload to the decoder; replaces any payload not yet decoded."""
+        with self.cond:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = payload
+            self.submitted += 1
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                payload = self.pending
+                self.pending = None
+            image = self.decode(payload)
+            if image is not None:
+                self.decoded.append(image)
+
+    def decode(self, payload):
+        """Decode one JPEG from memory; return None if it is corrupt."""
+        if Metrics.enabled:
+            start = time.perf_counter()
+        try:
+            image = Image.open(io.BytesIO(payload))
+            if self.draftSize:
+                # Let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding
+                image.draft('RGB', self.draftSize)
+            image.load()
+        except Exception:
+            self.failed += 1
+            return None
+        if Metrics.enabled:
+            DECODE_SECONDS.since(start)
+        return image
+
+    def latest(self):
+        """Return the newest decoded image (dropping older ones), or None."""
+        image = None
+        try:
+            while True:
+                image = self.decoded.popleft()
+        except IndexError:
+            pass
+        return image
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
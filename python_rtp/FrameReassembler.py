@@ -0,0 +1,102 @@
+from JpegPacketizer import JPEG_HEADER_SIZE
+
+def tsNewer(a, b):
+    """Return True if RTP timestamp a is after b (modulo 2^32)."""
+    return a != b and ((a - b) & 0xFFFFFFFF) < 0x80000000
+
+class PartialFrame:
+    """Fragments received so far for one RTP timestamp.
+
+    Fragments are copied into place as they arrive, so the packet buffer
+    can be reused for the next datagram."""
+    __slots__ = ('data', 'fragments', 'received', 'size')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.fragments = set()
+        self.received = 0
+        # Known once the marker packet has arrived
+        self.size = -1
+
+def parseFragment(rtpPacket):
+    """Return (fragment offset, fragment) of a JPEG RTP packet, or None."""
+    payload = rtpPacket.getPayload()
+    if len(payload) < JPEG_HEADER_SIZE:
+        return None
+    offset = payload[1] << 16 | payload[2] << 8 | payload[3]
+    return offset, payload[JPEG_HEADER_SIZE:]
+
+def addFragment(frame, offset, fragment, marker):
+    """Add a fragment to a PartialFrame. Return True once the frame is complete."""
+    if offset in frame.fragments:
+        # Duplicate packet
+        return False
+    frame.fragments.add(offset)
+    data = frame.data
+    end = offset + len(fragment)
+    if len(data) < end:
+        data.extend(bytes(end - len(data)))
+    memoryview(data)[offset:end] = fragment
+    frame.received += len(fragment)
+    if marker:
+        frame.size = offset + len(fragment)
+    return frame.received == frame.size
+
+def frameBytes(frame):
+    """Return the data of a complete PartialFrame."""
+    return bytes(frame.data)
+
+class FrameReassembler:
+    """Rebuild JPEG frames from fragmented RTP packets.
+
+    Fragments of a frame share the RTP timestamp and carry their byte
+    offset in the JPEG header; they may arrive in any order. A frame is
+    complete when the packet with the marker bit and every byte before it
+    have been received. Incomplete frames are dropped when a newer frame
+    completes or when too many frames are pending."""
+
+    def __init__(self, maxPending=4):
+        self.maxPending = maxPending
+        self.pending = {}
+        self.completed = 0
+        self.dropped = 0
+
+    def push(self, rtpPacket):
+        """Add a packet. Return (timestamp, frame bytes) when a frame completes, else None."""
+        parsed = parseFragment(rtpPacket)
+        if parsed is None:
+            return None
+        offset, fragment = parsed
+        timestamp = rtpPacket.timestamp()
+
+        frame = self.pending.get(timestamp)
+        if frame is None:
+            if len(self.pending) >= self.maxPending:
+                self.dropOldest()
+            frame = self.pending[timestamp] = PartialFrame()
+        if not addFragment(frame, offset, fragment, rtpPacket.marker()):
+            return None
+
+        del self.pending[timestamp]
+        self.dropOlder(timestamp)
+        self.completed += 1
+        return timestamp, frameBytes(frame)
+
+    def dropOlder(self, timestamp):
+        """Drop the incomplete frames that precede a completed one."""
+        for ts in [ts for ts in self.pending if tsNewer(timestamp, ts)]:
+            del self.pending[ts]
+            self.dropped += 1
+
+    def dropOldest(self):
+        """Drop the oldest incomplete frame to make room for a new one."""
+        oldest = None
+        for ts in self.pending:
+            if oldest is None or tsNewer(oldest, ts):
+                oldest = ts
+        del self.pending[oldest]
+        self.dropped += 1
+
+    def reset(self):
+        """Forget all partial frames."""
+        self.pending.clear()
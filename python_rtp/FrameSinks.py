@@ -0,0 +1,119 @@
+import threading, time, zlib
+
+from VideoStream import FRAME_HEADER_SIZE
+
+# Largest frame the 5-digit length prefix of a movie file can describe
+MAX_FRAME_SIZE = 10 ** FRAME_HEADER_SIZE - 1
+
+class FrameSink:
+    """Receives the frames of a StreamClient as they become due.
+
+    frame() is called on the client's playout thread; close() once, when
+    the session is torn down or the client is closed."""
+
+    def frame(self, timestamp, data):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class CallbackSink(FrameSink):
+    """Call 'callback(timestamp, data)' for every frame."""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def frame(self, timestamp, data):
+        self.callback(timestamp, data)
+
+class CountingSink(FrameSink):
+    """Discard frames and count them, e.g. for monitoring probes."""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.first = None
+        self.last = None
+
+    def frame(self, timestamp, data):
+        now = time.monotonic()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.frames += 1
+        self.bytes += len(data)
+
+    def fps(self):
+        """Return the average frame rate so far."""
+        if self.frames < 2:
+            return 0.0
+        return (self.frames - 1) / (self.last - self.first)
+
+class DigestSink(FrameSink):
+    """Keep (timestamp, size, CRC-32) of every frame, to compare two runs frame by frame."""
+
+    def __init__(self):
+        self.entries = []
+
+    def frame(self, timestamp, data):
+        self.entries.append((timestamp, len(data), zlib.crc32(data)))
+
+    def write(self, path):
+        """Write the entries as lines of 'timestamp size crc32'."""
+        with open(path, 'w') as file:
+            for timestamp, size, crc in self.entries:
+                file.write('%d %d %08x\n' % (timestamp, size, crc))
+
+class MjpegFileSink(FrameSink):
+    """Record frames to a movie file in VideoStream's format.
+
+    Frames too large for the 5-digit length prefix are skipped."""
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.skipped = 0
+
+    def frame(self, timestamp, data):
+        if len(data) > MAX_FRAME_SIZE:
+            self.skipped += 1
+            return
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(b'%05d' % len(data))
+            self.file.write(data)
+            self.frames += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class AsyncQueueSink(FrameSink):
+    """Hand frames to an asyncio queue; None marks the end of the stream.
+
+    When the consumer falls behind, the oldest queued frame is dropped."""
+
+    def __init__(self, loop, maxQueued=8):
+        import asyncio
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.maxQueued = maxQueued
+        self.dropped = 0
+
+    def put(self, item):
+        if item is not None and self.queue.qsize() >= self.maxQueued:
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(item)
+
+    def frame(self, timestamp, data):
+        self.loop.call_soon_threadsafe(self.put, (timestamp, data))
+
+    def close(self):
+        try:
+            self.loop.call_soon_threadsafe(self.put, None)
+        except RuntimeError:
+            # The event loop is already closed
+            pass
@@ -0,0 +1,139 @@
+import select, socket, threading, time
+
+import Metrics
+from RtspMessage import interleave
+
+# Bytes waiting for a slow reader before packets are dropped
+MAX_BUFFERED = 256 << 10
+
+# Seconds before trying again to send to a full socket
+RETRY_DELAY = 0.005
+
+# Sends never block the scheduler; without MSG_DONTWAIT (Windows) the
+# socket is polled for room first
+DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+SEND_SECONDS = Metrics.histogram('rtp_interleaved_send_seconds', "Time to send the packets queued on one RTSP connection")
+
+class InterleavedWriter:
+	"""Writes RTP and RTCP packets on an RTSP connection, '$'-framed
+	(RFC 2326 section 10.12), along with the RTSP replies.
+
+	Packets queued during one run of the scheduler are coalesced and
+	sent together right after it, without blocking. What the socket does
+	not take waits here, up to 'maxBuffered' bytes; beyond half of that
+	new frames are dropped whole, and a frame that no longer fits has the
+	rest of its packets dropped, so a slow reader costs a bounded amount
+	of memory and still gets whole frames. Replies are never dropped."""
+
+	def __init__(self, sock, scheduler, maxBuffered=MAX_BUFFERED):
+		self.sock = sock
+		self.scheduler = scheduler
+		self.maxBuffered = maxBuffered
+		self.lock = threading.Lock()
+		self.pending = bytearray()
+		self.flushTimer = None
+		self.closed = False
+		# Dropping the rest of the current frame; the next packet starts a frame
+		self.dropping = False
+		self.frameStart = True
+		self.sentPackets = 0
+		self.droppedPackets = 0
+		self.droppedFrames = 0
+
+	def backlog(self):
+		"""Return the bytes written but not yet taken by the connection."""
+		return len(self.pending)
+
+	def sendPacket(self, channel, packet):
+		"""Queue an RTP packet on 'channel'. Return False if it was dropped."""
+		with self.lock:
+			if self.closed:
+				return False
+			# The marker bit ends a frame
+			last = bool(packet[1] & 0x80)
+			frameStart = self.frameStart
+			self.frameStart = last
+			backlog = self.backlog()
+			if frameStart:
+				self.dropping = backlog > self.maxBuffered // 2
+				if self.dropping:
+					self.droppedFrames += 1
+			elif not self.dropping and backlog + len(packet) > self.maxBuffered:
+				self.dropping = True
+				self.droppedFrames += 1
+			if self.dropping:
+				self.droppedPackets += 1
+				return False
+			self.pending += interleave(channel, packet)
+			self.pending += packet
+			self.sentPackets += 1
+			self.scheduleFlush(time.monotonic())
+			return True
+
+	def sendControl(self, channel, packet):
+		"""Queue an RTCP packet on 'channel', unless the reader is behind."""
+		with self.lock:
+			if self.closed or self.backlog() + len(packet) > self.maxBuffered:
+				return False
+			self.pending += interleave(channel, packet)
+			self.pending += packet
+			self.scheduleFlush(time.monotonic())
+			return True
+
+	def sendReply(self, data):
+		"""Send an RTSP reply after whatever is queued."""
+		with self.lock:
+			if self.closed:
+				return
+			self.pending += data
+			self.flushLocked()
+
+	def scheduleFlush(self, when):
+		if self.flushTimer is None:
+			self.flushTimer = self.scheduler.callAt(when, self.onFlush)
+
+	def onFlush(self, now):
+		with self.lock:
+			self.flushTimer = None
+			self.flushLocked()
+
+	def flushLocked(self):
+		"""Send as much as the socket takes; try the rest again shortly."""
+		if not self.pending:
+			return
+		if Metrics.enabled:
+			start = time.perf_counter()
+		try:
+			if not DONTWAIT and not select.select((), (self.sock,), (), 0)[1]:
+				sent = 0
+			else:
+				sent = self.sock.send(self.pending, DONTWAIT)
+		except (BlockingIOError, InterruptedError):
+			sent = 0
+		except OSError:
+			# The connection is gone; its reader thread cleans up
+			self.closed = True
+			self.pending = bytearray()
+			return
+		del self.pending[:sent]
+		if Metrics.enabled:
+			SEND_SECONDS.since(start)
+		if self.pending:
+			self.scheduleFlush(time.monotonic() + RETRY_DELAY)
+
+	def close(self):
+		with self.lock:
+			self.closed = True
+			self.pending = bytearray()
+			if self.flushTimer is not None:
+				self.scheduler.cancel(self.flushTimer)
+				self.flushTimer = None
+
+	def stats(self):
+		return {
+			'sentPackets': self.sentPackets,
+			'droppedPackets': self.droppedPackets,
+			'droppedFrames': self.droppedFrames,
+			'backlog': self.backlog(),
+		}
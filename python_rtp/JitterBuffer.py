@@ -0,0 +1,298 @@
+import heapq, threading, time
+
+import Metrics
+from FrameReassembler import PartialFrame, parseFragment, addFragment, frameBytes
+
+RTP_CLOCK_RATE = 90000
+SEQ_MOD = 1 << 16
+TS_MOD = 1 << 32
+
+# Missing packets followed for retransmission at most, and NACKs per packet
+MAX_MISSING = 256
+MAX_NACKS = 3
+# Round-trip time assumed until one is measured
+DEFAULT_RTT = 0.05
+
+REASSEMBLY_SECONDS = Metrics.histogram('rtp_reassembly_seconds', "Time to add one packet to its frame")
+
+def extend(value, highest, modulo):
+    """Extend a wrapping counter to the value closest to 'highest'."""
+    delta = (value - highest) % modulo
+    if delta < modulo // 2:
+        return highest + delta
+    return highest - (modulo - delta)
+
+class JitterBuffer:
+    """Reorder RTP packets, rebuild frames and release them on a playout clock.
+
+    Packets are keyed by their extended (wrap-aware) sequence number and
+    grouped into frames by their extended RTP timestamp. A frame is due
+    at  offset + timestamp / clockRate + delay , where offset maps the
+    sender's media clock to local time (taken from the earliest arrival)
+    and delay follows the measured interarrival jitter between minDelay
+    and maxDelay. Frames still incomplete when due are dropped; packets
+    for frames that were already released or dropped count as late.
+
+    With enableNack(), sequence gaps are remembered and nackList() says
+    which missing packets are worth asking for again: only those a
+    retransmission, one round trip away, can bring in before their frame
+    is due."""
+
+    def __init__(self, targetDelay=0.1, minDelay=0.02, maxDelay=1.0, jitterFactor=4.0, clockRate=RTP_CLOCK_RATE):
+        self.targetDelay = targetDelay
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.jitterFactor = jitterFactor
+        self.clockRate = clockRate
+        self.delay = targetDelay
+        self.cond = threading.Condition()
+
+        # Counters
+        self.received = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.late = 0
+        self.framesPlayed = 0
+        self.framesLost = 0
+        self.jitter = 0.0   # RFC 3550 interarrival jitter, in clock units
+
+        self.baseSeq = None
+        self.maxSeq = None
+        self.seen = set()
+
+        # Missing packets by extended sequence number:
+        # [frame timestamp, NACKs sent, time of the first, time of the next]
+        self.nack = False
+        self.missing = {}
+        self.maxMarker = False
+        self.rtt = DEFAULT_RTT
+        self.nacked = 0
+        self.repaired = 0
+        self.reset()
+
+    def enableNack(self, rtt=None):
+        """Follow gaps for retransmission, starting from a round-trip time estimate."""
+        with self.cond:
+            self.nack = True
+            if rtt:
+                self.rtt = rtt
+
+    def reset(self):
+        """Forget buffered frames and the clock mapping (e.g. after PAUSE)."""
+        with self.cond:
+            self.frames = {}
+            self.heap = []
+            self.offset = None
+            self.maxTs = None
+            self.lastTransit = None
+            self.released = None
+            # Gaps in frames that are gone are not worth a NACK
+            self.missing = {}
+            self.maxMarker = False
+            self.cond.notify_all()
+
+    def insert(self, rtpPacket, arrival=None):
+        """Add a received packet."""
+        if arrival is None:
+            arrival = time.monotonic()
+        with self.cond:
+            self.insertLocked(rtpPacket, arrival)
+
+    def insertLocked(self, rtpPacket, arrival):
+        seq = rtpPacket.seqNum()
+        gap = None
+        if self.maxSeq is None:
+            self.baseSeq = self.maxSeq = seq
+            ext = seq
+        else:
+            ext = extend(seq, self.maxSeq, SEQ_MOD)
+            if ext > self.maxSeq:
+                if ext > self.maxSeq + 1:
+                    gap = self.maxSeq + 1
+                self.maxSeq = ext
+            elif ext in self.seen:
+                self.duplicates += 1
+                return
+            else:
+                self.reordered += 1
+                if self.missing:
+                    self.arrivedMissing(ext, arrival)
+        self.received += 1
+        self.seen.add(ext)
+        if len(self.seen) > 4096:
+            # Only recent numbers matter for duplicate detection
+            self.seen = set(s for s in self.seen if s > self.maxSeq - 2048)
+
+        ts = rtpPacket.timestamp()
+        extTs = ts if self.maxTs is None else extend(ts, self.maxTs, TS_MOD)
+        if gap is not None and self.nack and self.maxTs is not None:
+            # The missing packets belong to the frame of the packet before
+            # the gap, unless that one ended its frame; a gap across a reset
+            # (PAUSE and PLAY) belongs to frames already forgotten
+            self.addMissing(gap, ext, extTs if self.maxMarker else self.maxTs, arrival)
+        if ext == self.maxSeq:
+            self.maxMarker = rtpPacket.marker()
+        if self.maxTs is None or extTs > self.maxTs:
+            self.maxTs = extTs
+
+        # Interarrival jitter (RFC 3550 section 6.4.1)
+        transit = arrival * self.clockRate - extTs
+        if self.lastTransit is not None:
+            d = abs(transit - self.lastTransit)
+            self.jitter += (d - self.jitter) / 16.0
+        self.lastTransit = transit
+
+        # Media clock to local clock mapping follows the earliest arrival
+        offset = arrival - extTs / self.clockRate
+        if self.offset is None or offset < self.offset:
+            self.offset = offset
+
+        if self.released is not None and extTs <= self.released:
+            self.late += 1
+            return
+
+        if Metrics.enabled:
+            start = time.perf_counter()
+            self.reassemble(rtpPacket, extTs)
+            REASSEMBLY_SECONDS.since(start)
+        else:
+            self.reassemble(rtpPacket, extTs)
+
+    def reassemble(self, rtpPacket, extTs):
+        """Add a packet's fragment to the frame of timestamp 'extTs'."""
+        parsed = parseFragment(rtpPacket)
+        if parsed is None:
+            return
+        frame = self.frames.get(extTs)
+        if frame is None:
+            frame = self.frames[extTs] = PartialFrame()
+            heapq.heappush(self.heap, extTs)
+            # The earliest deadline may have changed
+            self.cond.notify_all()
+        elif isinstance(frame, bytes):
+            self.duplicates += 1
+            return
+        if addFragment(frame, parsed[0], parsed[1], rtpPacket.marker()):
+            self.frames[extTs] = frameBytes(frame)
+            self.cond.notify_all()
+
+    def addMissing(self, first, end, extTs, arrival):
+        for ext in range(first, end):
+            if len(self.missing) >= MAX_MISSING:
+                break
+            self.missing[ext] = [extTs, 0, None, arrival]
+
+    def arrivedMissing(self, ext, arrival):
+        entry = self.missing.pop(ext, None)
+        if entry is None or not entry[1]:
+            # Only reordered
+            return
+        self.repaired += 1
+        if entry[1] == 1:
+            # Answer to a single NACK: a round-trip time sample
+            self.rtt += (arrival - entry[2] - self.rtt) / 8
+
+    def nackList(self, now=None):
+        """Return the extended sequence numbers to ask for again now; forget
+        the missing packets whose retransmission would come too late."""
+        if now is None:
+            now = time.monotonic()
+        seqs = []
+        with self.cond:
+            for ext, entry in list(self.missing.items()):
+                extTs, nacks, first, due = entry
+                if nacks >= MAX_NACKS or self.offset is None or now + self.rtt > self.playoutTime(extTs):
+                    del self.missing[ext]
+                elif now >= due:
+                    entry[1] += 1
+                    if first is None:
+                        entry[2] = now
+                    # Ask again if nothing came within a round trip and a bit
+                    entry[3] = now + 1.5 * self.rtt
+                    seqs.append(ext)
+            self.nacked += len(seqs)
+        return seqs
+
+    def playoutTime(self, extTs):
+        """Return the local time at which a frame is due."""
+        return self.offset + extTs / self.clockRate + self.delay
+
+    def adaptDelay(self):
+        """Move the playout delay towards a multiple of the measured jitter."""
+        wanted = max(self.targetDelay, self.jitterFactor * self.jitter / self.clockRate)
+        wanted = min(max(wanted, self.minDelay), self.maxDelay)
+        # Grow quickly to stop losses, shrink slowly to avoid oscillation
+        rate = 0.5 if wanted > self.delay else 0.02
+        self.delay += (wanted - self.delay) * rate
+
+    def pop(self, now=None):
+        """Return (timestamp, frame) of the next due frame, or None."""
+        if now is None:
+            now = time.monotonic()
+        with self.cond:
+            return self.popLocked(now)
+
+    def popLocked(self, now):
+        while self.heap:
+            extTs = self.heap[0]
+            if self.playoutTime(extTs) > now:
+                return None
+            heapq.heappop(self.heap)
+            frame = self.frames.pop(extTs)
+            self.released = extTs
+            self.adaptDelay()
+            if isinstance(frame, bytes):
+                self.framesPlayed += 1
+                return extTs % TS_MOD, frame
+            self.framesLost += 1
+        return None
+
+    def nextDeadline(self):
+        """Return the local time at which the next frame is due, or None."""
+        with self.cond:
+            if not self.heap:
+                return None
+            return self.playoutTime(self.heap[0])
+
+    def get(self, timeout=None):
+        """Block until a frame is due or 'timeout' elapses; return it or None."""
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                frame = self.popLocked(now)
+                if frame is not None:
+                    return frame
+                wait = None
+                if self.heap:
+                    wait = self.playoutTime(self.heap[0]) - now
+                if end is not None:
+                    remaining = end - now
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.cond.wait(wait)
+
+    def lost(self):
+        """Return the cumulative number of lost packets."""
+        if self.maxSeq is None:
+            return 0
+        return max(0, self.maxSeq - self.baseSeq + 1 - self.received)
+
+    def stats(self):
+        """Return the counters as a dict."""
+        with self.cond:
+            return {
+                'received': self.received,
+                'lost': self.lost(),
+                'reordered': self.reordered,
+                'duplicates': self.duplicates,
+                'late': self.late,
+                'framesPlayed': self.framesPlayed,
+                'framesLost': self.framesLost,
+                'jitter': self.jitter / self.clockRate,
+                'delay': self.delay,
+                'nacked': self.nacked,
+                'repaired': self.repaired,
+                'rtt': self.rtt,
+            }
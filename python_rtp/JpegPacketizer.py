@@ -0,0 +1,94 @@
+import struct
+
+from RtpPacket import RtpPacket, HEADER_SIZE
+
+# RFC 2435 main JPEG header: type-specific, fragment offset (24 bits),
+# type, Q, width/8, height/8
+JPEG_HEADER = struct.Struct('!BBHBBBB')
+JPEG_HEADER_SIZE = JPEG_HEADER.size
+
+DEFAULT_MTU = 1400
+RTP_CLOCK_RATE = 90000
+MJPEG_PT = 26
+
+# JPEG start-of-frame markers that carry the picture size
+SOF_MARKERS = (0xC0, 0xC1, 0xC2)
+
+def jpegSize(frame):
+	"""Return (width, height) from the SOF segment of a JPEG, or (0, 0)."""
+	pos = 2
+	end = len(frame) - 9
+	while pos < end:
+		if frame[pos] != 0xFF:
+			return 0, 0
+		marker = frame[pos + 1]
+		if marker in SOF_MARKERS:
+			height = frame[pos + 5] << 8 | frame[pos + 6]
+			width = frame[pos + 7] << 8 | frame[pos + 8]
+			return width, height
+		if marker == 0xDA:
+			# Start of scan: no SOF before the image data
+			return 0, 0
+		pos += 2 + (frame[pos + 2] << 8 | frame[pos + 3])
+	return 0, 0
+
+class JpegPacketizer:
+	"""Split JPEG frames into MTU-sized RTP packets (RFC 2435 style).
+
+	Every packet carries the main JPEG header with the byte offset of its
+	fragment; all packets of a frame share the RTP timestamp and the last
+	one has the marker bit set. The complete JPEG file is carried (tables
+	included), so the type field is 0 and Q is 255.
+
+	The packets of a frame are written into one buffer with a single copy
+	of the frame and returned as memoryview slices of it."""
+
+	def __init__(self, mtu=DEFAULT_MTU, ssrc=0, fps=20):
+		self.mtu = mtu
+		self.ssrc = ssrc
+		self.fps = fps
+		self.seqnum = 0
+		self.rtpPacket = RtpPacket()
+		# RTP header bytes in front of each payload (fixed header + extension)
+		self.headerSize = HEADER_SIZE
+		self.fragmentSize = mtu - HEADER_SIZE - JPEG_HEADER_SIZE
+		if self.fragmentSize <= 0:
+			raise ValueError("MTU %d is too small" % mtu)
+
+	def timestamp(self, frameNbr):
+		"""Return the 90 kHz RTP timestamp of a frame."""
+		return int(frameNbr * RTP_CLOCK_RATE // self.fps) & 0xFFFFFFFF
+
+	def packetize(self, frame, frameNbr, extProfile=0, extData=b''):
+		"""Return the list of RTP packets carrying one frame."""
+		timestamp = self.timestamp(frameNbr)
+		frame = memoryview(frame)
+		width, height = jpegSize(frame)
+		width, height = min(width >> 3, 255), min(height >> 3, 255)
+		size = len(frame)
+
+		rtpPacket = self.rtpPacket
+		rtpPacket.encode(2, 0, 0, 0, 0, 0, MJPEG_PT, self.ssrc, b'', timestamp, extProfile=extProfile, extData=extData)
+		self.headerSize = rtpPacket.headerSize()
+		overhead = self.headerSize + JPEG_HEADER_SIZE
+		fragmentSize = self.mtu - overhead
+		count = max(1, -(-size // fragmentSize))
+
+		buf = bytearray(count * overhead + size)
+		view = memoryview(buf)
+		packets = []
+		pos = 0
+		for i in range(count):
+			offset = i * fragmentSize
+			fragment = frame[offset:offset + fragmentSize]
+			rtpPacket.seq = self.seqnum
+			rtpPacket.mark = 1 if i == count - 1 else 0
+			start = pos + rtpPacket.packHeaderInto(buf, pos)
+			JPEG_HEADER.pack_into(buf, start, 0, offset >> 16, offset & 0xFFFF, 0, 255, width, height)
+			start += JPEG_HEADER_SIZE
+			end = start + len(fragment)
+			view[start:end] = fragment
+			packets.append(view[pos:end])
+			pos = end
+			self.seqnum = (self.seqnum + 1) & 0xFFFF
+		return packets
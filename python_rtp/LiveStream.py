@@ -0,0 +1,322 @@
+import os, queue, re, select, socket, threading, time
+from collections import deque
+
+from Channel import Subscriber, SPLIT_HEADER
+from RtpPacket import RtpPacket, HEADER_SIZE, RTP_HEADER
+from JpegPacketizer import MJPEG_PT
+from FrameReassembler import PartialFrame, parseFragment, addFragment, frameBytes
+import Metrics
+
+# Complete frames kept for viewers joining and for the recorder
+RING_FRAMES = 32
+
+# Packets of one frame kept at most; a publisher that never sets the
+# marker bit does not grow the frame forever
+MAX_FRAME_PACKETS = 2048
+
+# Largest datagram read from a publisher, and datagrams relayed together
+# when several are waiting
+RECV_SIZE = 65536
+RECV_BATCH = 64
+RECV_BUFFER = 1 << 21
+
+# Seconds a blocked read waits before looking whether the publisher left
+RECV_TIMEOUT = 1.0
+
+# Largest frame the movie format can hold (5-digit length)
+MAX_RECORDED_FRAME = 99999
+
+RELAY_SECONDS = Metrics.histogram('rtp_live_relay_seconds', "Time from reading a publisher's packets to handing them to the kernel for every viewer")
+
+def recordingPath(directory, name):
+	"""Return the movie file a live stream is recorded to."""
+	return os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]', '_', name).strip('.') + '.Mjpeg')
+
+def parseSdp(body):
+	"""Return the payload types of the first video media in an SDP body, or None."""
+	for line in body.decode('utf-8', 'replace').splitlines():
+		if line.startswith('m=video '):
+			fields = line.split()
+			return [int(pt) for pt in fields[3:] if pt.isdigit()]
+	return None
+
+def fragmentOffset(packet):
+	"""Return the JPEG fragment offset of an RTP/JPEG packet, or -1."""
+	pos = HEADER_SIZE + 4 * (packet[0] & 0x0F)
+	if packet[0] & 0x10:
+		if len(packet) < pos + 4:
+			return -1
+		pos += 4 + 4 * (packet[pos + 2] << 8 | packet[pos + 3])
+	if len(packet) < pos + 4:
+		return -1
+	return packet[pos + 1] << 16 | packet[pos + 2] << 8 | packet[pos + 3]
+
+class LiveFrame:
+	"""The packets of one frame of a live stream, as the publisher sent them."""
+	__slots__ = ('timestamp', 'packets', 'nextSeq', 'intact', 'done', 'size')
+
+	def __init__(self, timestamp, seq):
+		self.timestamp = timestamp
+		self.packets = []
+		self.nextSeq = seq
+		self.intact = True
+		self.done = False
+		self.size = 0
+
+class LiveStream:
+	"""A live feed pushed by a publisher (ANNOUNCE/RECORD), relayed to viewers.
+
+	Packets are relayed as they arrive, without waiting for the frame: like
+	a Channel, every viewer gets a 12-byte header with its own sequence
+	number and SSRC in front of the publisher's payload, which all viewers
+	share. Complete frames go to a ring of the last 'ringFrames' frames; a
+	viewer joining gets the newest of them right away and the live packets
+	from the next frame on. With 'recordPath', complete frames are also
+	appended to that movie file by a background thread. Relayed bytes are
+	charged to 'bucket' (the scheduler's global one), so paced sessions
+	make room for them."""
+
+	def __init__(self, name, sender, recordPath=None, ringFrames=RING_FRAMES, bucket=None):
+		self.name = name
+		self.sender = sender
+		self.bucket = bucket
+		self.ring = deque(maxlen=ringFrames)
+		self.frame = None
+		self.lock = threading.Lock()
+		# Viewers receiving live packets, and those waiting for the next frame;
+		# the relay reads the tuple without locking
+		self.viewers = ()
+		self.joining = []
+		self.publisher = None
+		# Called on every new frame of the publisher, e.g. to renew its session
+		self.touch = None
+		self.recorder = LiveRecorder(recordPath) if recordPath else None
+		self.packets = 0
+		self.frames = 0
+		self.framesIncomplete = 0
+		self.relayed = 0
+
+	def claim(self, publisher):
+		"""Make 'publisher' the one source of the stream. Return False if another one is."""
+		with self.lock:
+			if self.publisher is not None and self.publisher is not publisher:
+				return False
+			self.publisher = publisher
+			return True
+
+	def release(self, publisher):
+		"""The publisher is gone; viewers stay and get the next publisher's frames."""
+		with self.lock:
+			if self.publisher is publisher:
+				self.publisher = None
+				self.touch = None
+
+	def subscribe(self, key, address, ssrc):
+		"""Send the newest complete frame to 'address', then the live frames after it."""
+		viewer = Subscriber(address, ssrc)
+		with self.lock:
+			if self.ring:
+				self.send(self.ring[-1].packets, ((key, viewer),))
+				self.sender.flush()
+			self.joining.append((key, viewer))
+
+	def unsubscribe(self, key):
+		with self.lock:
+			self.joining = [(k, v) for k, v in self.joining if k is not key]
+			self.viewers = tuple((k, v) for k, v in self.viewers if k is not key)
+
+	def admitJoining(self):
+		with self.lock:
+			self.viewers += tuple(self.joining)
+			self.joining = []
+
+	def receive(self, sock, source):
+		"""Relay the packets sent to 'sock' from host 'source' until the socket is closed.
+
+		Datagrams already waiting are read without blocking and relayed
+		together, so a burst costs one flush; nothing waits for more."""
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+		sock.setblocking(False)
+		while True:
+			try:
+				if not select.select((sock,), (), (), RECV_TIMEOUT)[0]:
+					continue
+			except (OSError, ValueError):
+				# Closed: the publisher left
+				return
+			if Metrics.enabled:
+				start = time.perf_counter()
+			packets = []
+			while len(packets) < RECV_BATCH:
+				try:
+					data, address = sock.recvfrom(RECV_SIZE)
+				except (BlockingIOError, InterruptedError):
+					break
+				except OSError:
+					if sock.fileno() < 0:
+						return
+					# e.g. ICMP port unreachable
+					continue
+				if address[0] == source and len(data) >= HEADER_SIZE:
+					packets.append(data)
+			if packets:
+				self.relay(packets)
+				if Metrics.enabled:
+					RELAY_SECONDS.since(start)
+
+	def relay(self, packets):
+		"""Send RTP packets of the publisher to every viewer and keep their frames."""
+		start = 0
+		for i, packet in enumerate(packets):
+			if self.track(packet) and self.joining:
+				# Viewers waiting for a frame start get it and what follows
+				self.send(packets[start:i], self.viewers)
+				start = i
+				self.admitJoining()
+		self.send(packets[start:], self.viewers)
+		self.sender.flush()
+
+	def send(self, packets, viewers):
+		"""Queue 'packets' for each of 'viewers' with their own headers."""
+		if not packets or not viewers:
+			return
+		# Split every packet once into header fields and a shared payload;
+		# the payload is bytes so the sender points at it instead of copying
+		parts = []
+		nbytes = 0
+		for packet in packets:
+			flags, _, timestamp, _ = SPLIT_HEADER.unpack_from(packet)
+			parts.append((flags, timestamp, bytes(packet[HEADER_SIZE:])))
+			nbytes += len(packet)
+		pack = SPLIT_HEADER.pack
+		datagrams = []
+		for _, viewer in viewers:
+			seqnum = viewer.seqnum
+			address = viewer.address
+			ssrc = viewer.ssrc
+			for flags, timestamp, payload in parts:
+				datagrams.append(((pack(flags, seqnum, timestamp, ssrc), payload), address))
+				seqnum = (seqnum + 1) & 0xFFFF
+			viewer.seqnum = seqnum
+		self.sender.queueAll(datagrams)
+		self.relayed += len(datagrams)
+		if self.bucket is not None:
+			self.bucket.charge(nbytes * len(viewers))
+
+	def track(self, packet):
+		"""Add a packet to its frame. Return True if it starts a new frame."""
+		_, b1, seq, timestamp, _ = RTP_HEADER.unpack_from(packet)
+		self.packets += 1
+		frame = self.frame
+		isNew = frame is None or timestamp != frame.timestamp
+		if isNew:
+			if frame is not None and not frame.done:
+				self.framesIncomplete += 1
+			frame = self.frame = LiveFrame(timestamp, seq)
+			if self.touch is not None:
+				self.touch()
+		elif frame.done:
+			# Duplicate of a packet of the frame already kept
+			return False
+		# After a gap (or a packet that is not JPEG) the frame cannot be kept
+		# and the rest of its packets are only relayed
+		if frame.intact:
+			if seq != frame.nextSeq or len(frame.packets) >= MAX_FRAME_PACKETS or b1 & 0x7F != MJPEG_PT:
+				frame.intact = False
+				frame.packets = []
+			else:
+				frame.packets.append(packet)
+				frame.size += len(packet) - HEADER_SIZE
+		frame.nextSeq = (seq + 1) & 0xFFFF
+		if b1 & 0x80:
+			frame.done = True
+			if frame.intact and fragmentOffset(frame.packets[0]) == 0:
+				self.keep(frame)
+			else:
+				self.framesIncomplete += 1
+		return isNew
+
+	def keep(self, frame):
+		"""Add a complete frame to the ring (and the recording)."""
+		with self.lock:
+			self.ring.append(frame)
+		self.frames += 1
+		if self.recorder is not None:
+			self.recorder.write(frame)
+
+	def rate(self):
+		"""Return the bit rate of the stream over the ring, or 0 before two frames."""
+		with self.lock:
+			frames = list(self.ring)
+		if len(frames) < 2:
+			return 0
+		span = ((frames[-1].timestamp - frames[0].timestamp) & 0xFFFFFFFF) / 90000
+		if span <= 0:
+			return 0
+		return int(sum(frame.size for frame in frames[1:]) * 8 / span)
+
+	def stats(self):
+		with self.lock:
+			viewers = len(self.viewers) + len(self.joining)
+			ringBytes = sum(frame.size for frame in self.ring)
+		stats = {
+			'publishing': self.publisher is not None,
+			'viewers': viewers,
+			'packets': self.packets,
+			'frames': self.frames,
+			'framesIncomplete': self.framesIncomplete,
+			'relayed': self.relayed,
+			'ringBytes': ringBytes,
+		}
+		if self.recorder is not None:
+			stats.update(self.recorder.stats())
+		return stats
+
+class LiveRecorder:
+	"""Append the frames of a live stream to a movie file (VideoStream's format).
+
+	Frames are rebuilt from their packets and written by a background
+	thread, so the relay never waits for the disk; if the disk falls
+	behind by more than 'maxQueued' frames, frames are left out."""
+
+	def __init__(self, path, maxQueued=RING_FRAMES):
+		self.path = path
+		self.queue = queue.Queue(maxQueued)
+		self.recorded = 0
+		self.dropped = 0
+		self.tooLarge = 0
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def write(self, frame):
+		try:
+			self.queue.put_nowait(frame)
+		except queue.Full:
+			self.dropped += 1
+
+	def run(self):
+		rtpPacket = RtpPacket()
+		with open(self.path, 'ab') as file:
+			while True:
+				frame = self.queue.get()
+				partial = PartialFrame()
+				data = None
+				for packet in frame.packets:
+					try:
+						rtpPacket.decode(packet)
+					except ValueError:
+						break
+					parsed = parseFragment(rtpPacket)
+					if parsed and addFragment(partial, parsed[0], parsed[1], rtpPacket.marker()):
+						data = frameBytes(partial)
+				if data is None:
+					continue
+				if len(data) > MAX_RECORDED_FRAME:
+					self.tooLarge += 1
+					continue
+				file.write(b'%05d' % len(data))
+				file.write(data)
+				file.flush()
+				self.recorded += 1
+
+	def stats(self):
+		return {'recorded': self.recorded, 'recordDropped': self.dropped, 'recordTooLarge': self.tooLarge}
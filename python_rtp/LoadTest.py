@@ -0,0 +1,362 @@
+import argparse, asyncio, json, os, platform, socket, subprocess, sys, tempfile, time
+
+from RtpPacket import RtpPacket, SEND_TIME_EXT, SEND_TIME
+from JitterBuffer import extend, SEQ_MOD
+from RtspMessage import RtspParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Share of the target frame rate a session must deliver to count as sustained
+SUSTAINED_FPS = 0.9
+# Largest packet loss a sustained session may see
+SUSTAINED_LOSS = 0.01
+
+# Name the movie is published under with --live
+LIVE_NAME = 'loadtest-live'
+
+def makeMovie(path, frames, frameSize, width=640, height=480):
+	"""Write a synthetic MJPEG movie in VideoStream's format (5-digit length + JPEG)."""
+	sof = b'\xff\xc0\x00\x11\x08' + height.to_bytes(2, 'big') + width.to_bytes(2, 'big') + \
+		b'\x03\x01\x22\x00\x02\x11\x01\x03\x11\x01'
+	with open(path, 'wb') as f:
+		for i in range(frames):
+			fill = frameSize - len(sof) - 4
+			# Vary the content a little so frames are not all identical
+			body = b'\xff\xd8' + sof + bytes([i & 0x7F]) * fill + b'\xff\xd9'
+			f.write(b'%05d' % len(body))
+			f.write(body)
+
+def percentile(values, p):
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(p * len(values)))]
+
+class ProcessStats:
+	"""CPU time and memory of a process and its children, e.g. the
+	workers of Server.py --workers, from /proc (Linux only)."""
+
+	def __init__(self, pid):
+		self.pid = pid
+		self.ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+	def stat(self, pid):
+		"""Return the fields of /proc/<pid>/stat after the command name, or None."""
+		try:
+			with open('/proc/%d/stat' % pid) as f:
+				# The command name may contain spaces
+				return f.read().rsplit(')', 1)[1].split()
+		except (OSError, IndexError):
+			return None
+
+	def pids(self):
+		"""Return the process and its direct children."""
+		pids = [self.pid]
+		try:
+			names = os.listdir('/proc')
+		except OSError:
+			return pids
+		for name in names:
+			if name.isdigit():
+				fields = self.stat(int(name))
+				if fields and int(fields[1]) == self.pid:
+					pids.append(int(name))
+		return pids
+
+	def cpuSeconds(self):
+		total = None
+		for pid in self.pids():
+			fields = self.stat(pid)
+			if fields:
+				# utime + stime, and those of the children already waited for
+				total = (total or 0) + sum(int(field) for field in fields[11:15]) / self.ticks
+		return total
+
+	def memory(self):
+		"""Return (RSS, peak RSS) in bytes summed over the processes, or (None, None)."""
+		rss = peak = None
+		for pid in self.pids():
+			try:
+				with open('/proc/%d/status' % pid) as f:
+					for line in f:
+						if line.startswith('VmRSS:'):
+							rss = (rss or 0) + int(line.split()[1]) * 1024
+						elif line.startswith('VmHWM:'):
+							peak = (peak or 0) + int(line.split()[1]) * 1024
+			except OSError:
+				pass
+		return rss, peak
+
+class LoadClient(asyncio.DatagramProtocol):
+	"""Headless RTSP/RTP client that only counts what it receives."""
+
+	def __init__(self):
+		self.rtpPacket = RtpPacket()
+		self.transport = None
+		self.session = None
+		self.timeout = None
+		self.keepAlive = None
+		self.reset()
+
+	def reset(self):
+		"""Start counting afresh (end of the warm-up)."""
+		self.packets = 0
+		self.bytes = 0
+		self.frames = 0
+		self.latencies = []
+		self.firstSeq = None
+		self.highestSeq = None
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def datagram_received(self, data, addr):
+		packet = self.rtpPacket
+		try:
+			packet.decode(data)
+		except ValueError:
+			return
+		self.packets += 1
+		self.bytes += len(data)
+		if self.highestSeq is None:
+			self.firstSeq = self.highestSeq = packet.seqNum()
+		else:
+			self.highestSeq = max(self.highestSeq, extend(packet.seqNum(), self.highestSeq, SEQ_MOD))
+		if packet.marker():
+			self.frames += 1
+			ext = packet.extension()
+			if ext and ext[0] == SEND_TIME_EXT:
+				sent = SEND_TIME.unpack_from(ext[1])[0]
+				self.latencies.append(time.time_ns() // 1000 - sent)
+
+	def lost(self):
+		if self.highestSeq is None:
+			return 0
+		return max(0, self.highestSeq - self.firstSeq + 1 - self.packets)
+
+	async def run(self, host, port, movie):
+		"""Set up a session, play it and keep the control connection open."""
+		loop = asyncio.get_running_loop()
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+		sock.bind((host, 0))
+		await loop.create_datagram_endpoint(lambda: self, sock=sock)
+		rtpPort = sock.getsockname()[1]
+
+		reader, writer = await asyncio.open_connection(host, port)
+		self.writer = writer
+		self.parser = RtspParser()
+		await self.request(reader, 'SETUP', movie, 1, 'Transport: RTP/UDP; client_port=%d' % rtpPort)
+		await self.request(reader, 'PLAY', movie, 2, 'Session: %s' % self.session)
+		if self.timeout:
+			# No RTCP here: renew the session with requests
+			self.keepAlive = asyncio.ensure_future(self.renew(reader, movie))
+
+	async def renew(self, reader, movie):
+		seq = 2
+		while True:
+			await asyncio.sleep(self.timeout / 2)
+			seq += 1
+			await self.request(reader, 'GET_PARAMETER', movie, seq, 'Session: %s' % self.session)
+
+	async def request(self, reader, method, movie, seq, header):
+		self.writer.write(('%s %s RTSP/1.0\r\nCSeq: %d\r\n%s\r\n\r\n' % (method, movie, seq, header)).encode())
+		replies = []
+		while not replies:
+			data = await asyncio.wait_for(reader.read(4096), 10)
+			if not data:
+				raise RuntimeError("%s failed: connection closed" % method)
+			replies = list(self.parser.feed(data))
+		reply = replies[0]
+		if reply.status != 200 or reply.cseq() != seq:
+			raise RuntimeError("%s failed: %r" % (method, str(reply)))
+		self.session = reply.session() or self.session
+		self.timeout = reply.sessionTimeout() or self.timeout
+
+	def close(self):
+		if self.keepAlive:
+			self.keepAlive.cancel()
+		if self.transport:
+			self.transport.close()
+		if getattr(self, 'writer', None):
+			self.writer.close()
+
+class LoadTest:
+	"""Run a server and N headless clients on localhost and measure the server."""
+
+	def __init__(self, args, serverArgs):
+		self.args = args
+		self.serverArgs = serverArgs
+		self.clients = []
+		self.failed = 0
+		self.publisher = None
+		# What the clients play: the movie, or the live stream it is published as
+		self.uri = LIVE_NAME if args.live else os.path.basename(args.movie)
+
+	def startServer(self):
+		command = [sys.executable, os.path.join(HERE, 'Server.py'), str(self.args.port), '--send-timestamps',
+			'--media-root', os.path.dirname(self.args.movie)] + self.serverArgs
+		if self.args.live:
+			command.append('--live')
+		self.server = subprocess.Popen(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		# Wait until the RTSP port accepts connections
+		deadline = time.monotonic() + 10
+		while time.monotonic() < deadline:
+			try:
+				socket.create_connection(('127.0.0.1', self.args.port), 0.2).close()
+				return
+			except OSError:
+				if self.server.poll() is not None:
+					break
+				time.sleep(0.1)
+		self.server.kill()
+		raise RuntimeError("server did not start: %s" % ' '.join(command))
+
+	def startPublisher(self):
+		"""Publish the movie as a live stream from another process; its packets
+		carry their send time, so the latency measured is the relay's,
+		publisher to viewer."""
+		args = self.args
+		command = [sys.executable, os.path.join(HERE, 'Publisher.py'), '127.0.0.1', str(args.port), LIVE_NAME,
+			args.movie, '--fps', str(args.fps), '--timestamps']
+		self.publisher = subprocess.Popen(command, cwd=HERE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+		# It prints a line once the server accepted the stream
+		if not self.publisher.stdout.readline():
+			raise RuntimeError("publisher did not start: %s" % ' '.join(command))
+
+	async def runClients(self):
+		args = self.args
+		for i in range(args.clients):
+			client = LoadClient()
+			try:
+				await client.run('127.0.0.1', args.port, self.uri)
+				self.clients.append(client)
+			except (OSError, RuntimeError, asyncio.TimeoutError) as e:
+				print("client %d: %s" % (i, e))
+				client.close()
+				self.failed += 1
+			if args.ramp:
+				await asyncio.sleep(args.ramp / args.clients)
+
+		await asyncio.sleep(args.warmup)
+		for client in self.clients:
+			client.reset()
+		stats = ProcessStats(self.server.pid)
+		cpuStart = stats.cpuSeconds()
+		start = time.monotonic()
+		await asyncio.sleep(args.duration)
+		elapsed = time.monotonic() - start
+		cpuEnd = stats.cpuSeconds()
+		rss, peak = stats.memory()
+		for client in self.clients:
+			client.close()
+
+		return self.results(elapsed, cpuStart, cpuEnd, rss, peak)
+
+	def results(self, elapsed, cpuStart, cpuEnd, rss, peak):
+		args = self.args
+		sessions = []
+		latencies = []
+		for client in self.clients:
+			lost = client.lost()
+			expected = client.packets + lost
+			sessions.append({
+				'fps': client.frames / elapsed,
+				'loss': lost / expected if expected else 1.0,
+				'kbps': client.bytes * 8 / elapsed / 1000,
+			})
+			latencies.extend(client.latencies)
+		fps = [s['fps'] for s in sessions]
+		sustained = [s for s in sessions if s['fps'] >= SUSTAINED_FPS * args.fps and s['loss'] <= SUSTAINED_LOSS]
+		packets = sum(c.packets for c in self.clients)
+		lost = sum(c.lost() for c in self.clients)
+		ms = lambda us: us / 1000 if us is not None else None
+		return {
+			'sessionsRequested': args.clients,
+			'sessionsStarted': len(self.clients),
+			'sessionsFailed': self.failed,
+			'sessionsSustained': len(sustained),
+			'fpsMean': sum(fps) / len(fps) if fps else 0.0,
+			'fpsMin': min(fps) if fps else 0.0,
+			'packets': packets,
+			'packetLoss': lost / (packets + lost) if packets + lost else 0.0,
+			'throughputMbps': sum(s['kbps'] for s in sessions) / 1000,
+			'latencyMs': {
+				'p50': ms(percentile(latencies, 0.5)),
+				'p90': ms(percentile(latencies, 0.9)),
+				'p99': ms(percentile(latencies, 0.99)),
+				'max': ms(max(latencies) if latencies else None),
+			},
+			'serverCpuPercent': 100 * (cpuEnd - cpuStart) / elapsed if cpuStart is not None and cpuEnd is not None else None,
+			'serverRssBytes': rss,
+			'serverPeakRssBytes': peak,
+			'duration': elapsed,
+		}
+
+	def run(self):
+		args = self.args
+		if args.generate:
+			frames = int(args.fps * (args.warmup + args.duration + args.ramp + 5))
+			makeMovie(args.movie, frames, args.frame_size)
+		self.startServer()
+		try:
+			if args.live:
+				self.startPublisher()
+			results = asyncio.run(self.runClients())
+		finally:
+			if self.publisher:
+				self.publisher.terminate()
+				self.publisher.wait()
+			self.server.terminate()
+			self.server.wait()
+		return {
+			'config': {
+				'clients': args.clients,
+				'duration': args.duration,
+				'warmup': args.warmup,
+				'fps': args.fps,
+				'frameSize': args.frame_size,
+				'live': args.live,
+				'serverArgs': self.serverArgs,
+				'python': platform.python_version(),
+				'platform': platform.platform(),
+				'cpus': os.cpu_count(),
+				'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			},
+			'results': results,
+		}
+
+def main():
+	parser = argparse.ArgumentParser(description="Load test Server.py on localhost with headless clients. "
+		"Arguments not listed here are passed on to Server.py, e.g. --mode async.")
+	parser.add_argument('--clients', type=int, default=10, help="number of sessions (default %(default)s)")
+	parser.add_argument('--duration', type=float, default=10, help="seconds measured (default %(default)s)")
+	parser.add_argument('--warmup', type=float, default=2, help="seconds before measuring (default %(default)s)")
+	parser.add_argument('--ramp', type=float, default=0, help="seconds over which clients are started (default %(default)s)")
+	parser.add_argument('--port', type=int, default=8554, help="RTSP port of the server (default %(default)s)")
+	parser.add_argument('--fps', type=float, default=20, help="frame rate the server plays at (default %(default)s)")
+	parser.add_argument('--movie', default=os.path.join(tempfile.gettempdir(), 'loadtest.Mjpeg'),
+		help="movie to stream, generated unless --no-generate (default %(default)s)")
+	parser.add_argument('--no-generate', dest='generate', action='store_false', help="stream an existing --movie")
+	parser.add_argument('--frame-size', type=int, default=6000, help="bytes per generated frame (default %(default)s)")
+	parser.add_argument('--live', action='store_true',
+		help="publish the movie as a live stream (Publisher.py) and play that: measures the relay latency")
+	parser.add_argument('--output', help="write the results as JSON to this file")
+	args, serverArgs = parser.parse_known_args()
+	args.movie = os.path.abspath(args.movie)
+
+	report = LoadTest(args, serverArgs).run()
+	r = report['results']
+	lat = r['latencyMs']
+	print("sessions: %d requested, %d started, %d sustained" % (r['sessionsRequested'], r['sessionsStarted'], r['sessionsSustained']))
+	print("fps: mean %.2f, min %.2f; packet loss %.3f%%; %.1f Mbit/s" % (r['fpsMean'], r['fpsMin'], 100 * r['packetLoss'], r['throughputMbps']))
+	if lat['p50'] is not None:
+		print("frame latency: p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms" % (lat['p50'], lat['p90'], lat['p99'], lat['max']))
+	if r['serverCpuPercent'] is not None:
+		print("server: %.1f%% CPU, RSS %.1f MB (peak %.1f MB)" % (r['serverCpuPercent'], r['serverRssBytes'] / 1e6, r['serverPeakRssBytes'] / 1e6))
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+	main()
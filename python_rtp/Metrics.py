@@ -0,0 +1,268 @@
+import bisect, os, sys, threading, time
+from collections import Counter
+
+# Instrumentation is off until enable(); hot paths test this flag first
+# and only then read the clock, so switched off it costs one lookup:
+#     if Metrics.enabled:
+#         start = time.perf_counter()
+enabled = False
+
+# Upper bounds of the timing histogram buckets, in seconds (10 us to 1 s)
+TIME_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+	1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+# Seconds between two stack samples of the profiler
+PROFILE_INTERVAL = 0.005
+# Frames kept of each sampled stack, from the innermost
+PROFILE_DEPTH = 40
+# Leaf frames of threads blocked waiting, left out of the profile
+IDLE_FILES = ('threading.py', 'selectors.py', 'queue.py', 'socketserver.py', 'base_events.py')
+
+def threadCpuTime(ident):
+	"""Return the CPU time used by thread 'ident', or None where it cannot be read."""
+	try:
+		return time.clock_gettime(time.pthread_getcpuclockid(ident))
+	except (AttributeError, OSError):
+		return None
+
+def enable(on=True):
+	global enabled
+	enabled = on
+
+def formatValue(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+def formatLabels(labels):
+	if not labels:
+		return ''
+	return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+		for name, value in labels.items())
+
+class Histogram:
+	"""Distribution of a duration (or any value) over fixed buckets."""
+
+	def __init__(self, name, help, buckets=TIME_BUCKETS):
+		self.name = name
+		self.help = help
+		self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def observe(self, value):
+		i = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			self.counts[i] += 1
+			self.sum += value
+			self.count += 1
+
+	def since(self, start):
+		"""Observe the time elapsed since 'start' (a time.perf_counter() value)."""
+		self.observe(time.perf_counter() - start)
+
+	def quantile(self, q):
+		"""Return the upper bound of the bucket holding quantile 'q', or None if empty."""
+		rank = q * self.count
+		seen = 0
+		for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+			seen += count
+			if count and seen >= rank:
+				return bound
+		return None
+
+	def render(self):
+		lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+		with self.lock:
+			counts = list(self.counts)
+			total, count = self.sum, self.count
+		cumulative = 0
+		for bound, n in zip(self.buckets + (float('inf'),), counts):
+			cumulative += n
+			lines.append('%s_bucket{le="%s"} %d' % (self.name, formatValue(bound), cumulative))
+		lines.append('%s_sum %r' % (self.name, total))
+		lines.append('%s_count %d' % (self.name, count))
+		return lines
+
+	def summary(self):
+		"""Return a one-line summary: count, mean and bucketed p50/p99."""
+		if not self.count:
+			return "%s: no samples" % self.name
+		return "%s: %d samples, mean %.3f ms, p50 < %.3f ms, p99 < %.3f ms" % (self.name, self.count,
+			1e3 * self.sum / self.count, 1e3 * self.quantile(0.5), 1e3 * self.quantile(0.99))
+
+class Registry:
+	"""The metrics of the process, rendered in the Prometheus text format.
+
+	Histograms are updated on the hot paths. Everything that is already
+	counted elsewhere (sessions, packets, losses) is read by collectors
+	when the metrics are scraped: a collector returns (name, type, help,
+	[(labels, value), ...]) tuples."""
+
+	def __init__(self):
+		self.histograms = []
+		self.collectors = []
+		self.lock = threading.Lock()
+
+	def histogram(self, name, help, buckets=TIME_BUCKETS):
+		histogram = Histogram(name, help, buckets)
+		with self.lock:
+			self.histograms.append(histogram)
+		return histogram
+
+	def addCollector(self, collector):
+		with self.lock:
+			self.collectors.append(collector)
+
+	def render(self):
+		lines = []
+		with self.lock:
+			histograms = list(self.histograms)
+			collectors = list(self.collectors)
+		for histogram in histograms:
+			lines.extend(histogram.render())
+		for collector in collectors:
+			for name, kind, help, samples in collector():
+				lines.append('# HELP %s %s' % (name, help))
+				lines.append('# TYPE %s %s' % (name, kind))
+				for labels, value in samples:
+					lines.append('%s%s %s' % (name, formatLabels(labels), formatValue(value)))
+		return '\n'.join(lines) + '\n'
+
+	def summary(self):
+		"""Return one line per histogram that has samples."""
+		with self.lock:
+			histograms = list(self.histograms)
+		return '\n'.join(h.summary() for h in histograms if h.count)
+
+REGISTRY = Registry()
+
+def histogram(name, help, buckets=TIME_BUCKETS):
+	"""Return a new histogram of the process registry."""
+	return REGISTRY.histogram(name, help, buckets)
+
+def addCollector(collector):
+	REGISTRY.addCollector(collector)
+
+class SamplingProfiler:
+	"""Statistical profiler: samples the stack of every thread at a fixed
+	interval and counts where they are. Cheap enough to leave on under
+	load. Threads waiting are left out: those in Python-level waits, and
+	where the CPU time of threads can be read, those that used none since
+	the previous sample (blocked in recv, accept, sleep...).
+
+	report() lists the functions seen most, by own and by total samples;
+	dump() writes the stacks in the collapsed format of flame graph tools."""
+
+	def __init__(self, interval=PROFILE_INTERVAL, depth=PROFILE_DEPTH):
+		self.interval = interval
+		self.depth = depth
+		self.stacks = Counter()
+		self.samples = 0
+		self.running = False
+		self.thread = None
+		self.lock = threading.Lock()
+
+	def start(self):
+		self.running = True
+		self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.running = False
+
+	def run(self):
+		own = threading.get_ident()
+		cpuTimes = {}
+		while self.running:
+			previous, cpuTimes = cpuTimes, {}
+			for ident, frame in sys._current_frames().items():
+				if ident == own:
+					continue
+				cpuTime = cpuTimes[ident] = threadCpuTime(ident)
+				if cpuTime is not None and cpuTime == previous.get(ident):
+					continue
+				if os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+					continue
+				stack = self.collapse(frame)
+				with self.lock:
+					self.stacks[stack] += 1
+					self.samples += 1
+			time.sleep(self.interval)
+
+	def collapse(self, frame):
+		"""Return a stack as 'outer;...;inner' of 'file:function' names."""
+		names = []
+		while frame is not None and len(names) < self.depth:
+			code = frame.f_code
+			names.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+			frame = frame.f_back
+		return ';'.join(reversed(names))
+
+	def report(self, top=20):
+		"""Return the functions with the most samples, own and including callees."""
+		with self.lock:
+			stacks = dict(self.stacks)
+			samples = self.samples
+		if not samples:
+			return "Profile: no samples\n"
+		own = Counter()
+		total = Counter()
+		for stack, count in stacks.items():
+			names = stack.split(';')
+			own[names[-1]] += count
+			for name in set(names):
+				total[name] += count
+		lines = ["Profile: %d samples, %.0f ms apart" % (samples, 1e3 * self.interval), "  own%    total%  function"]
+		for name, count in own.most_common(top):
+			lines.append("%6.1f%%  %6.1f%%  %s" % (100 * count / samples, 100 * total[name] / samples, name))
+		return '\n'.join(lines) + '\n'
+
+	def dump(self, path):
+		"""Write the sampled stacks to 'path', one 'stack count' line each."""
+		with self.lock:
+			stacks = sorted(self.stacks.items())
+		with open(path, 'w') as f:
+			for stack, count in stacks:
+				f.write('%s %d\n' % (stack, count))
+
+class MetricsHandler:
+	"""GET /metrics (Prometheus text format) and, with a profiler, /profile.
+
+	Mixed into http.server's request handler by serve(), so that only a
+	server exporting metrics imports the HTTP stack."""
+	profiler = None
+
+	def do_GET(self):
+		path = self.path.split('?', 1)[0]
+		if path == '/metrics':
+			body = REGISTRY.render()
+			contentType = 'text/plain; version=0.0.4'
+		elif path == '/profile' and self.profiler is not None:
+			body = self.profiler.report(50)
+			contentType = 'text/plain'
+		else:
+			self.send_error(404)
+			return
+		data = body.encode()
+		self.send_response(200)
+		self.send_header('Content-Type', contentType)
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, format, *args):
+		# Scrapes are not worth a line each
+		pass
+
+def serve(port, host='127.0.0.1', profiler=None):
+	"""Enable the metrics and serve them over HTTP on a background thread. Return the server."""
+	import http.server
+	enable()
+	handler = type('Handler', (MetricsHandler, http.server.BaseHTTPRequestHandler), {'profiler': profiler})
+	server = http.server.ThreadingHTTPServer((host, port), handler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+	return server
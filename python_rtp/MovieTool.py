@@ -0,0 +1,347 @@
+import argparse, io, mmap, os, re, time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from VideoStream import FRAME_HEADER_SIZE, DEFAULT_FPS, INDEX_EXT, TIMING_EXT, writeIndex, writeTiming, readIndex, readTiming
+
+# Largest frame the 5-digit length prefix of a movie file can describe
+MAX_FRAME_SIZE = 10 ** FRAME_HEADER_SIZE - 1
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+
+# Files of a directory taken as frames, in name order
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp', '.ppm', '.pgm')
+
+# A frame too large for the format is encoded again this much worse, down to MIN_QUALITY
+QUALITY_STEP = 10
+MIN_QUALITY = 20
+
+# Frames handed to the pool ahead of the one being written, per worker
+QUEUED_PER_WORKER = 4
+
+# A frame header: 5 ASCII digits and the JPEG start
+FRAME_START = re.compile(rb'\d{%d}\xff\xd8' % FRAME_HEADER_SIZE)
+# A length header of any number of digits and the JPEG start
+ANY_FRAME_START = re.compile(rb'\d*\xff\xd8')
+
+def isMovie(path):
+	"""Return True if 'path' looks like a movie in VideoStream's format."""
+	try:
+		with open(path, 'rb') as file:
+			head = file.read(FRAME_HEADER_SIZE + 2)
+	except OSError:
+		return False
+	return FRAME_START.match(head) is not None
+
+def imageFrames(directory):
+	"""Yield (job, duration) for the images of a directory, in name order."""
+	names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+	for name in names:
+		yield ('path', os.path.join(directory, name)), None
+
+def movieFrames(path):
+	"""Yield (job, duration) for the frames of a movie, read as they are needed."""
+	with open(path, 'rb') as file:
+		while True:
+			header = file.read(FRAME_HEADER_SIZE)
+			if len(header) < FRAME_HEADER_SIZE or not header.isdigit():
+				return
+			data = file.read(int(header))
+			if len(data) < int(header):
+				return
+			yield ('jpeg', data), None
+
+def videoFrames(path):
+	"""Yield (job, duration in ms or None) for the frames of anything Pillow
+	opens with several frames (GIF, APNG, WebP, TIFF, ...), decoded here."""
+	from PIL import Image, ImageSequence
+	with Image.open(path) as video:
+		for frame in ImageSequence.Iterator(video):
+			yield ('image', frame.convert('RGB')), frame.info.get('duration')
+
+def encodeFrame(job, size=None, quality=85, reencode=False):
+	"""Return (JPEG data or None, quality used or None, error) for one frame.
+
+	Runs in the pool. A JPEG that fits is kept byte for byte unless it has
+	to be resized or 'reencode' is set; a frame that encodes larger than
+	the format allows is encoded again at lower quality."""
+	kind, value = job
+	data = None
+	try:
+		if kind == 'path':
+			with open(value, 'rb') as file:
+				data = file.read()
+		elif kind == 'jpeg':
+			data = value
+		if data is not None and data.startswith(SOI) and size is None and not reencode and len(data) <= MAX_FRAME_SIZE:
+			return data, None, None
+		from PIL import Image
+		if data is not None:
+			image = Image.open(io.BytesIO(data))
+			if size is not None:
+				# Let the JPEG decoder scale down while decoding
+				image.draft('RGB', size)
+			image = image.convert('RGB')
+		else:
+			image = value
+		if size is not None:
+			image.thumbnail(size, Image.LANCZOS)
+		while True:
+			out = io.BytesIO()
+			image.save(out, 'JPEG', quality=quality)
+			if out.tell() <= MAX_FRAME_SIZE or quality <= MIN_QUALITY:
+				break
+			quality = max(MIN_QUALITY, quality - QUALITY_STEP)
+		if out.tell() > MAX_FRAME_SIZE:
+			return None, quality, "%d bytes even at quality %d (try --size)" % (out.tell(), quality)
+		return out.getvalue(), quality, None
+	except Exception as e:
+		return None, None, str(e) or e.__class__.__name__
+
+def buildMovie(output, frames, fps=DEFAULT_FPS, workers=None, size=None, quality=85, reencode=False):
+	"""Write a movie from (job, duration) pairs, with its index and timing sidecars.
+
+	Frames are encoded by a pool of 'workers' processes and written in
+	order as they come back, with a bounded number in flight, so the
+	movie is never held in memory. A duration (ms) given with a frame
+	overrides 1/fps. Return a dict of counters and the frames skipped."""
+	workers = workers or os.cpu_count() or 1
+	offsets = array('Q')
+	lengths = array('I')
+	times = array('I')
+	clock = 0.0
+	result = {'frames': 0, 'kept': 0, 'encoded': 0, 'lowered': 0, 'largest': 0, 'skipped': []}
+	tmp = output + '.tmp'
+	pos = 0
+
+	def write(number, future, duration):
+		nonlocal clock, pos
+		data, used, error = future.result()
+		if data is None:
+			result['skipped'].append((number, error))
+			return
+		out.write(b'%05d' % len(data))
+		out.write(data)
+		offsets.append(pos + FRAME_HEADER_SIZE)
+		lengths.append(len(data))
+		times.append(round(clock))
+		clock += duration if duration else 1000 / fps
+		pos += FRAME_HEADER_SIZE + len(data)
+		result['frames'] += 1
+		result['largest'] = max(result['largest'], len(data))
+		if used is None:
+			result['kept'] += 1
+		else:
+			result['encoded'] += 1
+			if used < quality:
+				result['lowered'] += 1
+
+	try:
+		with ProcessPoolExecutor(workers) as pool, open(tmp, 'wb') as out:
+			pending = deque()
+			for number, (job, duration) in enumerate(frames):
+				pending.append((number, pool.submit(encodeFrame, job, size, quality, reencode), duration))
+				if len(pending) >= workers * QUEUED_PER_WORKER:
+					write(*pending.popleft())
+			while pending:
+				write(*pending.popleft())
+	except BaseException:
+		# Never leave half a movie behind
+		try:
+			os.remove(tmp)
+		except OSError:
+			pass
+		raise
+	times.append(round(clock))
+	os.replace(tmp, output)
+
+	# The sidecars match the movie by its size and mtime
+	stat = os.stat(output)
+	writeIndex(output, stat.st_size, stat.st_mtime_ns, offsets, lengths)
+	if result['frames']:
+		writeTiming(output, stat.st_size, stat.st_mtime_ns, result['frames'] * 1000 / clock, times)
+	return result
+
+def frameEnd(data, start):
+	"""Return where the JPEG at 'start' really ends: after the first EOI
+	followed by the next frame header or the end of the file, or -1."""
+	pos = start + 2
+	while True:
+		eoi = data.find(EOI, pos)
+		if eoi < 0:
+			return -1
+		end = eoi + 2
+		if end == len(data) or FRAME_START.match(data, end):
+			return end
+		pos = eoi + 1
+
+def checkMovie(path):
+	"""Check the frame boundaries and JPEG markers of a movie.
+
+	Return (offsets, lengths, problems): the frames found and a list of
+	(frame number, offset, message). A frame whose length header does not
+	match its JPEG, e.g. one over the 99,999 bytes the format can hold,
+	is measured from its markers so the check goes on after it."""
+	offsets = array('Q')
+	lengths = array('I')
+	problems = []
+	with open(path, 'rb') as file:
+		size = os.fstat(file.fileno()).st_size
+		data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+		try:
+			pos = 0
+			number = -1
+			while pos < size:
+				number += 1
+				header = data[pos:pos + FRAME_HEADER_SIZE]
+				start = pos + FRAME_HEADER_SIZE
+				if len(header) == FRAME_HEADER_SIZE and header.isdigit():
+					length = int(header)
+					if start + length <= size and data[start:start + 2] == SOI and data[start + length - 2:start + length] == EOI:
+						offsets.append(start)
+						lengths.append(length)
+						pos = start + length
+						continue
+					if start + length > size and FRAME_START.match(data, pos) and frameEnd(data, start) < 0:
+						problems.append((number, pos, "truncated: %d bytes of %d" % (size - start, length)))
+						break
+				# The JPEG starts after the header digits, however many there are
+				match = ANY_FRAME_START.match(data, pos)
+				if match is None:
+					problems.append((number, pos, "no frame header and JPEG start (SOI) here; %d bytes left unchecked" % (size - pos)))
+					break
+				start = match.end() - 2
+				end = frameEnd(data, start)
+				if end < 0:
+					problems.append((number, pos, "no JPEG end (EOI); %d bytes left unchecked" % (size - pos)))
+					break
+				length = end - start
+				if length > MAX_FRAME_SIZE:
+					problems.append((number, pos, "%d bytes, over the %d bytes the format can hold (length header %r)" % (
+						length, MAX_FRAME_SIZE, bytes(data[pos:start]).decode('ascii', 'replace'))))
+				else:
+					problems.append((number, pos, "length header %r, but the JPEG is %d bytes" % (
+						bytes(data[pos:start]).decode('ascii', 'replace'), length)))
+				pos = end
+		finally:
+			if isinstance(data, mmap.mmap):
+				data.close()
+	return offsets, lengths, problems
+
+def checkSidecars(path, offsets, lengths):
+	"""Return notes on the index and timing sidecars of a checked movie."""
+	stat = os.stat(path)
+	notes = []
+	if not os.path.exists(path + INDEX_EXT):
+		notes.append("no index: the server scans the movie when it first opens it")
+	else:
+		index = readIndex(path, stat.st_size, stat.st_mtime_ns)
+		if index is None:
+			notes.append("stale index: the server scans the movie again")
+		elif index != (offsets, lengths):
+			notes.append("the index does not match the frames (%d frames, %d indexed)" % (len(offsets), len(index[0])))
+	if os.path.exists(path + TIMING_EXT) and readTiming(path, stat.st_size, stat.st_mtime_ns, len(offsets)) is None:
+		notes.append("stale timing: the server ignores it")
+	return notes
+
+def main():
+	parser = argparse.ArgumentParser(description="Build, check and index MJPEG movies in VideoStream's format "
+		"(5-digit length + JPEG per frame).")
+	commands = parser.add_subparsers(dest='command', required=True)
+	build = commands.add_parser('build', help="build a movie from a directory of images, a movie or a video Pillow reads")
+	build.add_argument('output')
+	build.add_argument('input', help="directory of images (in name order), movie, or animated GIF/PNG/WebP/TIFF")
+	build.add_argument('--fps', type=float, default=DEFAULT_FPS, help="frame rate, unless the input has frame durations "
+		"(default %(default)s)")
+	build.add_argument('--size', metavar='WxH', help="scale frames down to fit WxH, keeping the aspect ratio")
+	build.add_argument('--quality', type=int, default=85, help="JPEG quality of encoded frames (default %(default)s); "
+		"lowered for frames that would not fit the format")
+	build.add_argument('--reencode', action='store_true', help="encode JPEG input again instead of copying it")
+	build.add_argument('--workers', type=int, help="encoding processes (default: one per CPU)")
+	check = commands.add_parser('check', help="check frame boundaries, JPEG markers, oversize frames and sidecars")
+	check.add_argument('movies', nargs='+')
+	index = commands.add_parser('index', help="write the index and timing sidecars of a valid movie")
+	index.add_argument('movies', nargs='+')
+	index.add_argument('--fps', type=float, default=DEFAULT_FPS, help="frame rate (default %(default)s)")
+	args = parser.parse_args()
+
+	if args.command == 'build':
+		size = None
+		if args.size:
+			try:
+				size = tuple(int(n) for n in args.size.lower().split('x'))
+			except ValueError:
+				size = ()
+			if len(size) != 2 or min(size) < 8:
+				parser.error("--size takes WxH, e.g. 640x480")
+		if not 1 <= args.quality <= 95:
+			parser.error("--quality must be 1-95")
+		if os.path.isdir(args.input):
+			frames = imageFrames(args.input)
+		elif isMovie(args.input):
+			frames = movieFrames(args.input)
+		else:
+			try:
+				import PIL
+			except ImportError:
+				raise SystemExit("%s is not a movie; reading other videos needs Pillow" % args.input)
+			frames = videoFrames(args.input)
+		start = time.monotonic()
+		try:
+			result = buildMovie(args.output, frames, args.fps, args.workers, size, args.quality, args.reencode)
+		except OSError as e:
+			raise SystemExit(str(e))
+		elapsed = time.monotonic() - start
+		for number, error in result['skipped']:
+			print("frame %d skipped: %s" % (number, error))
+		print("%s: %d frames (%d copied, %d encoded, %d at lower quality to fit), %d skipped; largest %d bytes; "
+			"%.1f s (%.0f frames/s)" % (args.output, result['frames'], result['kept'], result['encoded'],
+			result['lowered'], len(result['skipped']), result['largest'], elapsed,
+			(result['frames'] + len(result['skipped'])) / elapsed if elapsed else 0))
+		if result['skipped']:
+			raise SystemExit(1)
+
+	elif args.command == 'check':
+		failed = False
+		for path in args.movies:
+			try:
+				offsets, lengths, problems = checkMovie(path)
+				notes = [] if problems else checkSidecars(path, offsets, lengths)
+			except OSError as e:
+				print("%s: %s" % (path, e))
+				failed = True
+				continue
+			print("%s: %d frames, %s" % (path, len(offsets), "%d problems" % len(problems) if problems else "ok"))
+			for number, offset, message in problems:
+				print("  frame %d at offset %d: %s" % (number, offset, message))
+			for note in notes:
+				print("  " + note)
+			failed = failed or bool(problems)
+		if failed:
+			raise SystemExit(1)
+
+	elif args.command == 'index':
+		failed = False
+		for path in args.movies:
+			try:
+				offsets, lengths, problems = checkMovie(path)
+				if problems:
+					print("%s: %d problems, not indexed (see check)" % (path, len(problems)))
+					failed = True
+					continue
+				stat = os.stat(path)
+				times = array('I', (round(i * 1000 / args.fps) for i in range(len(offsets) + 1)))
+				writeIndex(path, stat.st_size, stat.st_mtime_ns, offsets, lengths)
+				writeTiming(path, stat.st_size, stat.st_mtime_ns, args.fps, times)
+			except OSError as e:
+				print("%s: %s" % (path, e))
+				failed = True
+				continue
+			print("%s: %d frames indexed at %g fps" % (path, len(offsets), args.fps))
+		if failed:
+			raise SystemExit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,157 @@
+import argparse, random, socket, time
+
+from VideoStream import VideoStream
+from JpegPacketizer import JpegPacketizer, DEFAULT_MTU, MJPEG_PT
+from RtpPacket import SEND_TIME_EXT, SEND_TIME
+from RtspMessage import RtspParser, interleave
+from Rtcp import bindPortPair
+
+class Publisher:
+	"""Push an MJPEG movie to a server as a live stream (ANNOUNCE/RECORD).
+
+	The movie is read at its frame rate, looping, like a camera would
+	deliver frames; every frame is packetized and sent at once, over UDP
+	or interleaved on the RTSP connection. With 'timestamps' every packet
+	carries its send time, for latency measurements on one host."""
+
+	def __init__(self, host, port, name, filename, fps=None, mtu=DEFAULT_MTU, interleaved=False, timestamps=False):
+		self.host = host
+		self.port = port
+		self.name = name
+		self.stream = VideoStream(filename, fps)
+		self.fps = self.stream.fps
+		self.packetizer = JpegPacketizer(mtu, random.randint(0, 0xFFFFFFFF), self.fps)
+		self.interleaved = interleaved
+		self.timestamps = timestamps
+		self.rtsp = None
+		self.parser = RtspParser()
+		self.cseq = 0
+		self.session = None
+		self.rtpSocket = None
+		self.rtcpSocket = None
+		self.serverAddress = None
+		self.running = False
+		self.frames = 0
+		self.packets = 0
+
+	def request(self, method, headers=(), body=b''):
+		"""Send a request and return its reply; raise RuntimeError unless it is 200 OK."""
+		self.cseq += 1
+		lines = ['%s %s RTSP/1.0' % (method, self.name), 'CSeq: %d' % self.cseq]
+		if self.session:
+			lines.append('Session: %s' % self.session)
+		lines.extend(headers)
+		if body:
+			lines.append('Content-Length: %d' % len(body))
+		self.rtsp.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+		while True:
+			data = self.rtsp.recv(4096)
+			if not data:
+				raise RuntimeError("%s failed: connection closed" % method)
+			for reply in self.parser.feed(data):
+				if reply.isRequest() or reply.cseq() != self.cseq:
+					continue
+				if reply.status != 200:
+					raise RuntimeError("%s failed: %d %s" % (method, reply.status, reply.reason))
+				self.session = reply.session() or self.session
+				return reply
+
+	def sdp(self):
+		return ('v=0\r\no=- 0 0 IN IP4 %s\r\ns=%s\r\nt=0 0\r\nm=video 0 RTP/AVP %d\r\na=framerate:%g\r\n' % (
+			self.host, self.name, MJPEG_PT, self.fps)).encode()
+
+	def start(self):
+		"""Announce the stream, set it up and start recording."""
+		self.rtsp = socket.create_connection((self.host, self.port))
+		self.request('ANNOUNCE', ['Content-Type: application/sdp'], self.sdp())
+		if self.interleaved:
+			self.request('SETUP', ['Transport: RTP/AVP/TCP;unicast;interleaved=0-1;mode=record'])
+		else:
+			self.rtpSocket, self.rtcpSocket = bindPortPair()
+			port = self.rtpSocket.getsockname()[1]
+			reply = self.request('SETUP', ['Transport: RTP/AVP;unicast;client_port=%d-%d;mode=record' % (port, port + 1)])
+			serverPort = None
+			for param in reply.header('transport', '').split(';'):
+				name, _, value = param.partition('=')
+				if name.strip() == 'server_port':
+					serverPort = int(value.split('-')[0])
+			if serverPort is None:
+				raise RuntimeError("SETUP reply without server_port")
+			self.serverAddress = (self.rtsp.getpeername()[0], serverPort)
+		self.request('RECORD')
+
+	def run(self, duration=None):
+		"""Send frames at the frame rate until stop() or 'duration' seconds."""
+		self.running = True
+		interval = 1.0 / self.fps
+		deadline = time.monotonic()
+		end = deadline + duration if duration else None
+		while self.running and (end is None or deadline < end):
+			self.sendFrame()
+			deadline += interval
+			delay = deadline - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+			elif delay < -interval:
+				# Too far behind: skip ahead instead of bursting
+				deadline = time.monotonic()
+
+	def sendFrame(self):
+		data = self.stream.nextFrame()
+		if not data:
+			# The movie loops
+			self.stream.seek(0)
+			data = self.stream.nextFrame()
+			if not data:
+				return
+		self.frames += 1
+		if self.timestamps:
+			packets = self.packetizer.packetize(data, self.frames, SEND_TIME_EXT, SEND_TIME.pack(time.time_ns() // 1000))
+		else:
+			packets = self.packetizer.packetize(data, self.frames)
+		if self.interleaved:
+			self.rtsp.sendall(b''.join(interleave(0, packet) + bytes(packet) for packet in packets))
+		else:
+			for packet in packets:
+				self.rtpSocket.sendto(packet, self.serverAddress)
+		self.packets += len(packets)
+
+	def stop(self):
+		self.running = False
+
+	def close(self):
+		"""Tear the stream down and close the sockets."""
+		try:
+			self.request('TEARDOWN')
+		except (OSError, RuntimeError):
+			pass
+		for sock in (self.rtsp, self.rtpSocket, self.rtcpSocket):
+			if sock is not None:
+				sock.close()
+		self.stream.close()
+
+def main():
+	parser = argparse.ArgumentParser(description="Publish an MJPEG movie to Server.py --live as a live stream.")
+	parser.add_argument('server')
+	parser.add_argument('port', type=int)
+	parser.add_argument('name', help="name viewers play the stream by")
+	parser.add_argument('file', help="movie sent in a loop")
+	parser.add_argument('--fps', type=float, help="frames per second (default: the movie's own rate, else 20)")
+	parser.add_argument('--mtu', type=int, default=DEFAULT_MTU, help="largest RTP packet (default %(default)s)")
+	parser.add_argument('--duration', type=float, help="seconds to publish (default: until interrupted)")
+	parser.add_argument('--tcp', action='store_true', help="send RTP on the RTSP connection (interleaved)")
+	parser.add_argument('--timestamps', action='store_true', help="stamp every packet with its send time (for LoadTest)")
+	args = parser.parse_args()
+
+	publisher = Publisher(args.server, args.port, args.name, args.file, args.fps, args.mtu, args.tcp, args.timestamps)
+	publisher.start()
+	print("Publishing %s as %s" % (args.file, args.name), flush=True)
+	try:
+		publisher.run(args.duration)
+	except KeyboardInterrupt:
+		pass
+	publisher.close()
+	print("%d frames, %d packets sent" % (publisher.frames, publisher.packets))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,202 @@
+import argparse, io, os, queue, threading
+
+from VideoStream import FRAME_HEADER_SIZE, openMovie, releaseMovie
+
+# Renditions below the original (level 0), best first: name, scale, JPEG quality
+LADDER = (
+	('q60', 1.0, 60),
+	('half', 0.5, 50),
+	('quarter', 0.25, 40),
+)
+
+# Largest frame the 5-digit length prefix of a movie file can describe
+MAX_FRAME_SIZE = 10 ** FRAME_HEADER_SIZE - 1
+
+# Receiver loss above which a session steps down at once, and below which
+# it may step back up after CLEAN_REPORTS reports in a row
+LOSS_HIGH = 0.08
+LOSS_LOW = 0.02
+CLEAN_REPORTS = 2
+
+def renditionFilename(filename, name):
+	"""Return the path of a rendition, stored next to the movie."""
+	return '%s.%s.Mjpeg' % (filename, name)
+
+def transcodeFrame(frame, scale, quality):
+	"""Re-encode one JPEG frame smaller; return the original if that does not help."""
+	from PIL import Image
+	try:
+		image = Image.open(io.BytesIO(frame))
+		size = (max(8, int(image.width * scale)), max(8, int(image.height * scale)))
+		if scale < 1:
+			# Let the JPEG decoder scale down while decoding
+			image.draft('RGB', size)
+		image = image.convert('RGB')
+		if image.size != size:
+			image = image.resize(size)
+		out = io.BytesIO()
+		image.save(out, 'JPEG', quality=quality)
+		data = out.getvalue()
+	except Exception:
+		return bytes(frame)
+	return data if len(data) < len(frame) else bytes(frame)
+
+def buildRendition(filename, name, scale, quality):
+	"""Write one rendition of a movie, frame for frame. Return its path."""
+	path = renditionFilename(filename, name)
+	tmp = path + '.tmp'
+	movie = openMovie(filename)
+	try:
+		with open(tmp, 'wb') as f:
+			for index in range(movie.frameCount()):
+				data = transcodeFrame(movie.getFrame(index), scale, quality)
+				f.write(b'%05d' % len(data))
+				f.write(data)
+		# Sessions only ever see a complete file
+		os.replace(tmp, path)
+	finally:
+		releaseMovie(movie)
+	return path
+
+class RenditionLadder:
+	"""Lower-quality renditions of the movies served, built with Pillow.
+
+	Level 0 is the movie itself; level n is LADDER[n - 1]. Renditions are
+	built offline (see main) or, on first use of a movie, by one
+	background thread; a rendition is used once its file exists and is
+	newer than the movie. Without Pillow only level 0 exists."""
+
+	def __init__(self, ladder=LADDER):
+		self.ladder = ladder
+		self.lock = threading.Lock()
+		self.queue = queue.Queue()
+		self.queued = set()
+		self.worker = None
+		try:
+			import PIL
+			self.available = True
+		except ImportError:
+			print("Pillow is not installed: renditions are disabled")
+			self.available = False
+
+	def levels(self):
+		return 1 + len(self.ladder)
+
+	def path(self, filename, level):
+		if level == 0:
+			return filename
+		return renditionFilename(filename, self.ladder[level - 1][0])
+
+	def ready(self, filename, level):
+		"""Return True if the rendition at 'level' of a movie can be used."""
+		if level == 0:
+			return True
+		try:
+			return os.path.getmtime(self.path(filename, level)) >= os.path.getmtime(filename)
+		except OSError:
+			return False
+
+	def sizeFactor(self, level):
+		"""Rough size of a level's frames relative to the original, until it is built."""
+		if level == 0:
+			return 1.0
+		_, scale, quality = self.ladder[level - 1]
+		return scale * scale * quality / 100
+
+	def request(self, filename):
+		"""Queue the missing renditions of a movie for building."""
+		if not self.available:
+			return
+		with self.lock:
+			for level in range(1, self.levels()):
+				key = (os.path.realpath(filename), level)
+				if key not in self.queued and not self.ready(filename, level):
+					self.queued.add(key)
+					self.queue.put((filename, level))
+			if self.worker is None:
+				self.worker = threading.Thread(target=self.run, daemon=True)
+				self.worker.start()
+
+	def run(self):
+		while True:
+			filename, level = self.queue.get()
+			name, scale, quality = self.ladder[level - 1]
+			try:
+				buildRendition(filename, name, scale, quality)
+				print("Rendition %s of %s ready" % (name, filename))
+			except Exception as e:
+				print("Rendition %s of %s failed: %s" % (name, filename, e))
+			finally:
+				with self.lock:
+					self.queued.discard((os.path.realpath(filename), level))
+
+class QualityController:
+	"""Choose the rendition level of a session from receiver feedback.
+
+	'rate(level)' gives the bit rate of a level. A report with heavy loss,
+	or frames the pacer had to drop, moves the session down at least one
+	level, to one that fits what actually got through; after a few clean
+	reports it tries the next better level. A client cap (bits/s) bounds
+	the choice."""
+
+	def __init__(self, levels, rate, cap=None):
+		self.levels = levels
+		self.rate = rate
+		self.cap = cap
+		self.level = self.fit(cap) if cap else 0
+		self.clean = 0
+		self.octets = None
+		self.time = None
+		self.switches = 0
+
+	def fit(self, budget):
+		"""Return the best level whose bit rate is within 'budget'."""
+		for level in range(self.levels):
+			if self.rate(level) <= budget:
+				return level
+		return self.levels - 1
+
+	def report(self, fractionLost, octets, now, framesDropped=0):
+		"""Take in a receiver report; return the level to use from the next frame on."""
+		delivered = None
+		if self.octets is not None and now > self.time:
+			delivered = (octets - self.octets) * 8 * (1 - fractionLost) / (now - self.time)
+		self.octets = octets
+		self.time = now
+
+		level = self.level
+		if fractionLost > LOSS_HIGH or framesDropped:
+			self.clean = 0
+			level += 1
+			if delivered:
+				level = max(level, self.fit(0.9 * delivered))
+		elif fractionLost < LOSS_LOW:
+			self.clean += 1
+			if self.clean >= CLEAN_REPORTS and level > 0:
+				self.clean = 0
+				level -= 1
+		else:
+			self.clean = 0
+		if self.cap:
+			level = max(level, self.fit(self.cap))
+		level = min(level, self.levels - 1)
+		if level != self.level:
+			self.switches += 1
+			self.level = level
+		return level
+
+def main():
+	parser = argparse.ArgumentParser(description="Build the lower-quality renditions of MJPEG movies for Server.py --renditions.")
+	parser.add_argument('movies', nargs='+')
+	args = parser.parse_args()
+	ladder = RenditionLadder()
+	if not ladder.available:
+		raise SystemExit(1)
+	for filename in args.movies:
+		for level in range(1, ladder.levels()):
+			name, scale, quality = ladder.ladder[level - 1]
+			path = buildRendition(filename, name, scale, quality)
+			print("%s: %d bytes" % (path, os.path.getsize(path)))
+
+if __name__ == "__main__":
+	main()
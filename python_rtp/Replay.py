@@ -0,0 +1,183 @@
+import argparse, json, time
+
+from RtpPacket import RtpPacket
+from StreamClient import StreamClient
+from FrameSinks import CallbackSink, DigestSink, MjpegFileSink
+from Fec import FecDecoder
+from RtpCapture import readCapture, NetworkModel, RTP, RTCP, SESSION
+import Metrics
+
+class Replay:
+	"""Feed a capture (StreamClient --capture) through StreamClient's receive path.
+
+	Packets go to receiveRtp/receiveRtcp with their captured arrival times
+	(after 'model', a NetworkModel, if given) and frames are taken from
+	the jitter buffer when due, all on a virtual clock: the same capture
+	and model always give the same frames. 'speed' paces the virtual
+	clock against the wall clock (1 is the original timing, 10 ten times
+	faster); 0 runs as fast as possible."""
+
+	def __init__(self, path, sinks=(), model=None, speed=0, playoutDelay=None):
+		self.path = path
+		self.model = model
+		self.speed = speed
+		self.playoutDelay = playoutDelay
+		self.client = StreamClient('replay', 0, 0, path, sinks, playoutDelay or 0.1)
+		self.packets = 0
+		self.rtcp = 0
+		self.malformed = 0
+		self.elapsed = 0.0
+		self.wallStart = None
+
+	def run(self):
+		"""Replay the whole capture; return the client's reception counters."""
+		records = readCapture(self.path)
+		if self.model is not None:
+			records = self.model.apply(records)
+		client = self.client
+		rtpPacket = RtpPacket()
+		repaired = RtpPacket()
+		self.wallStart = time.perf_counter()
+		for arrival, kind, data in records:
+			self.advance(arrival)
+			try:
+				if kind == RTP:
+					self.packets += 1
+					client.receiveRtp(rtpPacket, repaired, data, len(data), arrival)
+				elif kind == RTCP:
+					self.rtcp += 1
+					client.receiveRtcp(data)
+				elif kind == SESSION:
+					self.startSession(json.loads(data))
+			except ValueError:
+				self.malformed += 1
+		# Frames still buffered come due after the last packet
+		self.advance(float('inf'))
+		self.elapsed = time.perf_counter() - self.wallStart
+		client.closeSinks()
+		return client.stats()
+
+	def startSession(self, info):
+		"""Set the receive path up as the captured session was."""
+		client = self.client
+		if info.get('fecPt') is not None:
+			client.fecDecoder = FecDecoder(info['fecPt'])
+		if self.playoutDelay is None and info.get('playoutDelay'):
+			client.jitterBuffer.targetDelay = client.jitterBuffer.delay = info['playoutDelay']
+
+	def advance(self, until):
+		"""Release the frames due up to virtual time 'until', then wait for it."""
+		jitterBuffer = self.client.jitterBuffer
+		while True:
+			due = jitterBuffer.nextDeadline()
+			if due is None or due > until:
+				break
+			self.wait(due)
+			frame = jitterBuffer.pop(due)
+			if frame is not None:
+				self.client.deliverFrame(frame[0], frame[1])
+		if until != float('inf'):
+			self.wait(until)
+
+	def wait(self, when):
+		if self.speed > 0:
+			delay = self.wallStart + when / self.speed - time.perf_counter()
+			if delay > 0:
+				time.sleep(delay)
+
+def readFrameLog(path):
+	"""Read a DigestSink log into a dict {timestamp: (size, crc32)}."""
+	frames = {}
+	with open(path) as file:
+		for line in file:
+			timestamp, size, crc = line.split()
+			frames[int(timestamp)] = (int(size), int(crc, 16))
+	return frames
+
+def compareFrames(entries, reference):
+	"""Compare DigestSink entries with a reference log; return (same, different, missing, extra)."""
+	same = different = extra = 0
+	seen = set()
+	for timestamp, size, crc in entries:
+		seen.add(timestamp)
+		expected = reference.get(timestamp)
+		if expected is None:
+			extra += 1
+		elif expected == (size, crc):
+			same += 1
+		else:
+			different += 1
+	missing = len(set(reference) - seen)
+	return same, different, missing, extra
+
+def main():
+	parser = argparse.ArgumentParser(description="Replay an RTP capture (StreamClient.py --capture) through the client's "
+		"receive path, with optional loss, reordering and delay, without a network.")
+	parser.add_argument('capture')
+	parser.add_argument('--speed', type=float, default=0, help="1 replays at the original timing, N N times faster, "
+		"0 as fast as possible (default)")
+	parser.add_argument('--loss', type=float, default=0, help="share of packets lost, 0-1 (default %(default)s)")
+	parser.add_argument('--burst', type=float, default=1, help="mean length of a loss burst in packets (default %(default)s: independent)")
+	parser.add_argument('--delay', type=float, default=0, help="ms added to every packet (default %(default)s)")
+	parser.add_argument('--jitter', type=float, default=0, help="up to this many ms more, uniformly at random (default %(default)s)")
+	parser.add_argument('--reorder', type=float, default=0, help="share of packets held back behind the next ones, 0-1 (default %(default)s)")
+	parser.add_argument('--reorder-delay', type=float, default=10, help="ms a reordered packet is held back (default %(default)s)")
+	parser.add_argument('--seed', type=int, default=0, help="seed of the loss and delay model (default %(default)s)")
+	parser.add_argument('--playout-delay', type=float, help="jitter buffer delay in seconds (default: the captured session's)")
+	parser.add_argument('--decode', action='store_true', help="decode every frame, as the GUI does (needs Pillow)")
+	parser.add_argument('--record', metavar='MJPEG', help="write the frames to this movie file")
+	parser.add_argument('--frames', metavar='LOG', help="write 'timestamp size crc32' of every frame to LOG")
+	parser.add_argument('--compare', metavar='LOG', help="compare the frames with a --frames LOG of another run; "
+		"exit with status 1 if they differ")
+	parser.add_argument('--metrics', action='store_true', help="time the receive path and print the timings at the end")
+	args = parser.parse_args()
+
+	model = None
+	if args.loss or args.delay or args.jitter or args.reorder:
+		try:
+			model = NetworkModel(args.loss, args.burst, args.delay / 1000, args.jitter / 1000, args.reorder,
+				args.reorder_delay / 1000, args.seed)
+		except ValueError as e:
+			parser.error(str(e))
+	if args.metrics:
+		Metrics.enable()
+
+	digests = DigestSink()
+	sinks = [digests]
+	if args.record:
+		sinks.append(MjpegFileSink(args.record))
+	decoder = None
+	if args.decode:
+		from FrameDecoder import FrameDecoder
+		decoder = FrameDecoder()
+		sinks.append(CallbackSink(lambda timestamp, data: decoder.decode(data)))
+
+	replay = Replay(args.capture, sinks, model, args.speed, args.playout_delay)
+	try:
+		stats = replay.run()
+	except (OSError, ValueError) as e:
+		raise SystemExit(str(e))
+	if decoder is not None:
+		decoder.stop()
+	if args.frames:
+		digests.write(args.frames)
+
+	print("%d RTP and %d RTCP packets replayed in %.3f s (%.0f packets/s)" % (replay.packets, replay.rtcp,
+		replay.elapsed, replay.packets / replay.elapsed if replay.elapsed else 0))
+	if model is not None:
+		print("model: %d packets lost, %d held back" % (model.lost, model.reordered))
+	print("%d frames played, %d lost; %d packets lost, %d reordered, %d late, %d duplicates, %d recovered by FEC%s" % (
+		stats['framesPlayed'], stats['framesLost'], stats['lost'], stats['reordered'], stats['late'],
+		stats['duplicates'], stats['recovered'], ", %d malformed" % replay.malformed if replay.malformed else ""))
+	if decoder is not None:
+		print("%d frames failed to decode" % decoder.failed)
+	if args.metrics:
+		print(Metrics.REGISTRY.summary())
+	if args.compare:
+		same, different, missing, extra = compareFrames(digests.entries, readFrameLog(args.compare))
+		print("compared with %s: %d frames identical, %d different, %d missing, %d extra" % (args.compare, same, different, missing, extra))
+		if different or missing or extra:
+			raise SystemExit(1)
+
+if __name__ == "__main__":
+	main()
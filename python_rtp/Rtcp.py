@@ -0,0 +1,316 @@
+import socket, struct, time
+
+# RTCP packet types (RFC 3550)
+SR = 200
+RR = 201
+SDES = 202
+BYE = 203
+# Transport layer feedback (RFC 4585) and its generic NACK message type
+RTPFB = 205
+FMT_NACK = 1
+
+SDES_CNAME = 1
+
+# V/P/count, packet type, length in 32-bit words minus one
+RTCP_HEADER = struct.Struct('!BBH')
+# Sender info: SSRC, NTP timestamp (2 words), RTP timestamp, packet and octet counts
+SENDER_INFO = struct.Struct('!IIIIII')
+# Report block: SSRC, fraction lost + cumulative lost, extended highest
+# sequence number, interarrival jitter, last SR, delay since last SR
+REPORT_BLOCK = struct.Struct('!IIIIII')
+SSRC = struct.Struct('!I')
+# Feedback message: packet sender SSRC, media source SSRC; then per
+# generic NACK a packet ID and a bitmask of the 16 packets following it
+FEEDBACK = struct.Struct('!II')
+NACK_FCI = struct.Struct('!HH')
+
+# Seconds between two reports of a session (randomized by +-50%)
+RTCP_INTERVAL = 5.0
+
+# Seconds from 1900 (NTP epoch) to 1970 (Unix epoch)
+NTP_EPOCH_OFFSET = 2208988800
+
+def ntpTimestamp(t=None):
+	"""Return the 64-bit NTP timestamp of a wall-clock time (default: now)."""
+	if t is None:
+		t = time.time()
+	return int((t + NTP_EPOCH_OFFSET) * (1 << 32)) & 0xFFFFFFFFFFFFFFFF
+
+def ntpMiddle(ntp):
+	"""Return the middle 32 bits of an NTP timestamp, as used by LSR and RTT."""
+	return (ntp >> 16) & 0xFFFFFFFF
+
+class ReportBlock:
+	"""Reception statistics about one source."""
+	__slots__ = ('ssrc', 'fractionLost', 'cumulativeLost', 'highestSeq', 'jitter', 'lsr', 'dlsr')
+
+	def __init__(self, ssrc, fractionLost=0, cumulativeLost=0, highestSeq=0, jitter=0, lsr=0, dlsr=0):
+		self.ssrc = ssrc
+		self.fractionLost = fractionLost
+		self.cumulativeLost = cumulativeLost
+		self.highestSeq = highestSeq
+		self.jitter = jitter
+		self.lsr = lsr
+		self.dlsr = dlsr
+
+	def pack(self):
+		# Cumulative loss is a signed 24-bit field
+		lost = max(-0x800000, min(0x7FFFFF, self.cumulativeLost)) & 0xFFFFFF
+		return REPORT_BLOCK.pack(self.ssrc, (self.fractionLost & 0xFF) << 24 | lost,
+			self.highestSeq & 0xFFFFFFFF, int(self.jitter) & 0xFFFFFFFF, self.lsr, self.dlsr & 0xFFFFFFFF)
+
+	@classmethod
+	def unpack(cls, data, offset=0):
+		ssrc, lost, highest, jitter, lsr, dlsr = REPORT_BLOCK.unpack_from(data, offset)
+		cumulative = lost & 0xFFFFFF
+		if cumulative & 0x800000:
+			cumulative -= 1 << 24
+		return cls(ssrc, lost >> 24, cumulative, highest, jitter, lsr, dlsr)
+
+class RtcpPacket:
+	"""One packet of a compound RTCP packet, as returned by parseCompound().
+
+	'count' is the 5-bit count field (report blocks, sources, or the
+	feedback message type); 'body' is everything after the header."""
+	__slots__ = ('pt', 'count', 'ssrc', 'ntp', 'rtpTs', 'packets', 'octets', 'blocks', 'body')
+
+	def __init__(self, pt, count, body):
+		self.pt = pt
+		self.count = count
+		self.body = body
+		self.ssrc = SSRC.unpack_from(body)[0] if len(body) >= 4 else None
+		self.ntp = None
+		self.rtpTs = None
+		self.packets = None
+		self.octets = None
+		self.blocks = []
+
+def packet(pt, count, body):
+	"""Return an RTCP packet with a header in front of a 32-bit aligned body."""
+	return RTCP_HEADER.pack(0x80 | count, pt, len(body) // 4) + body
+
+def senderReport(ssrc, ntp, rtpTs, packets, octets, blocks=()):
+	body = SENDER_INFO.pack(ssrc, ntp >> 32, ntp & 0xFFFFFFFF, rtpTs & 0xFFFFFFFF,
+		packets & 0xFFFFFFFF, octets & 0xFFFFFFFF)
+	return packet(SR, len(blocks), body + b''.join(block.pack() for block in blocks))
+
+def receiverReport(ssrc, blocks=()):
+	return packet(RR, len(blocks), SSRC.pack(ssrc) + b''.join(block.pack() for block in blocks))
+
+def sourceDescription(ssrc, cname):
+	"""Return an SDES packet with the CNAME of one source."""
+	cname = cname.encode()[:255]
+	chunk = SSRC.pack(ssrc) + bytes((SDES_CNAME, len(cname))) + cname + b'\0'
+	# The item list ends with a null byte and is padded to 32 bits
+	chunk += b'\0' * (-len(chunk) % 4)
+	return packet(SDES, 1, chunk)
+
+def bye(ssrc):
+	return packet(BYE, 1, SSRC.pack(ssrc))
+
+def genericNack(ssrc, mediaSsrc, seqs):
+	"""Return a generic NACK asking 'mediaSsrc' for the packets 'seqs' (extended numbers, any order)."""
+	seqs = sorted(set(seqs))
+	fci = []
+	i = 0
+	while i < len(seqs):
+		pid = seqs[i]
+		blp = 0
+		i += 1
+		while i < len(seqs) and seqs[i] - pid <= 16:
+			blp |= 1 << (seqs[i] - pid - 1)
+			i += 1
+		fci.append(NACK_FCI.pack(pid & 0xFFFF, blp))
+	return packet(RTPFB, FMT_NACK, FEEDBACK.pack(ssrc, mediaSsrc) + b''.join(fci))
+
+def parseNack(rtcp):
+	"""Return (media SSRC, sequence numbers) of a generic NACK RtcpPacket. Raises ValueError if malformed."""
+	body = rtcp.body
+	if len(body) < FEEDBACK.size + NACK_FCI.size:
+		raise ValueError("truncated NACK")
+	mediaSsrc = SSRC.unpack_from(body, 4)[0]
+	seqs = []
+	for offset in range(FEEDBACK.size, len(body) - NACK_FCI.size + 1, NACK_FCI.size):
+		pid, blp = NACK_FCI.unpack_from(body, offset)
+		seqs.append(pid)
+		seqs.extend((pid + 1 + i) & 0xFFFF for i in range(16) if blp >> i & 1)
+	return mediaSsrc, seqs
+
+def parseCompound(data):
+	"""Split a compound RTCP packet into RtcpPackets. Raises ValueError if malformed."""
+	data = memoryview(data)
+	packets = []
+	pos = 0
+	while pos + RTCP_HEADER.size <= len(data):
+		first, pt, length = RTCP_HEADER.unpack_from(data, pos)
+		if first >> 6 != 2:
+			raise ValueError("not an RTCP packet")
+		end = pos + 4 * (length + 1)
+		if end > len(data):
+			raise ValueError("truncated RTCP packet")
+		body = data[pos + RTCP_HEADER.size:end]
+		if first & 0x20:
+			# Padding: the last byte counts the padding bytes
+			body = body[:len(body) - body[-1]]
+		rtcp = RtcpPacket(pt, first & 0x1F, body)
+		offset = 4
+		if pt == SR and len(body) >= SENDER_INFO.size:
+			_, msw, lsw, rtcp.rtpTs, rtcp.packets, rtcp.octets = SENDER_INFO.unpack_from(body)
+			rtcp.ntp = msw << 32 | lsw
+			offset = SENDER_INFO.size
+		if pt in (SR, RR):
+			for i in range(rtcp.count):
+				if offset + REPORT_BLOCK.size > len(body):
+					break
+				rtcp.blocks.append(ReportBlock.unpack(body, offset))
+				offset += REPORT_BLOCK.size
+		packets.append(rtcp)
+		pos = end
+	return packets
+
+def cname():
+	"""Return a canonical name for this endpoint."""
+	return 'rtp@%s' % socket.gethostname()
+
+class ReceptionReporter:
+	"""Build a receiver's report blocks from its counters (RFC 3550 A.3).
+
+	Fraction lost covers the interval since the previous report; LSR and
+	DLSR echo the last sender report so the sender can compute the RTT."""
+
+	def __init__(self):
+		self.expectedPrior = 0
+		self.receivedPrior = 0
+		self.lsr = 0
+		self.srArrival = None
+
+	def senderReport(self, report, arrival=None):
+		"""Note a sender report received at monotonic time 'arrival'."""
+		self.lsr = ntpMiddle(report.ntp)
+		self.srArrival = time.monotonic() if arrival is None else arrival
+
+	def block(self, ssrc, baseSeq, maxSeq, received, jitter, now=None):
+		"""Return the ReportBlock for a source from its extended sequence numbers."""
+		if now is None:
+			now = time.monotonic()
+		expected = maxSeq - baseSeq + 1
+		expectedInterval = expected - self.expectedPrior
+		receivedInterval = received - self.receivedPrior
+		self.expectedPrior = expected
+		self.receivedPrior = received
+		lostInterval = expectedInterval - receivedInterval
+		fraction = 0
+		if expectedInterval > 0 and lostInterval > 0:
+			fraction = (lostInterval << 8) // expectedInterval
+		dlsr = int((now - self.srArrival) * 65536) if self.srArrival is not None else 0
+		return ReportBlock(ssrc, fraction, expected - received, maxSeq, jitter, self.lsr, dlsr)
+
+class RtcpSession:
+	"""Sender side RTCP state of one session.
+
+	Counts what was sent for the sender reports, maps the media clock to
+	wall-clock time, and keeps the latest feedback of the receiver:
+	fraction lost, cumulative loss, jitter and the round-trip time."""
+
+	def __init__(self, ssrc, clockRate):
+		self.ssrc = ssrc
+		self.clockRate = clockRate
+		self.packets = 0
+		self.octets = 0
+		# Media timestamp of the last frame and the wall-clock time it was sent
+		self.rtpTs = None
+		self.rtpTime = None
+		self.address = None
+		self.reports = 0
+		self.fractionLost = 0.0
+		self.cumulativeLost = 0
+		self.jitter = 0.0
+		self.rtt = None
+		self.lastReport = None
+		# Monotonic time of the last report, which keeps the session alive
+		self.lastHeard = None
+		# Called with this session after every receiver report
+		self.onReport = None
+		# Packets the receiver asked for again (RTCP NACK) and those resent;
+		# called with this session and the sequence numbers of every NACK
+		self.nacked = 0
+		self.retransmitted = 0
+		self.onNack = None
+
+	def sent(self, payloadBytes):
+		self.packets += 1
+		self.octets += payloadBytes
+
+	def frameSent(self, rtpTs, now=None):
+		self.rtpTs = rtpTs
+		self.rtpTime = time.time() if now is None else now
+
+	def senderReport(self):
+		"""Return a compound SR + SDES packet describing the stream now."""
+		now = time.time()
+		rtpTs = 0
+		if self.rtpTs is not None:
+			rtpTs = self.rtpTs + int((now - self.rtpTime) * self.clockRate)
+		return senderReport(self.ssrc, ntpTimestamp(now), rtpTs, self.packets, self.octets) + \
+			sourceDescription(self.ssrc, cname())
+
+	def receiverReport(self, block, now=None):
+		"""Take in the receiver's report block about this session."""
+		if now is None:
+			now = time.time()
+		self.reports += 1
+		self.lastReport = now
+		self.lastHeard = time.monotonic()
+		self.fractionLost = block.fractionLost / 256
+		self.cumulativeLost = block.cumulativeLost
+		self.jitter = block.jitter / self.clockRate
+		if block.lsr:
+			rtt = (ntpMiddle(ntpTimestamp(now)) - block.lsr - block.dlsr) & 0xFFFFFFFF
+			# A negative RTT (clock steps) shows up as a huge value: ignore it
+			if rtt < 0x80000000:
+				self.rtt = rtt / 65536
+		if self.onReport:
+			self.onReport(self)
+
+	def nack(self, seqs):
+		"""Take in the receiver's NACK for the packets numbered 'seqs'."""
+		self.lastHeard = time.monotonic()
+		self.nacked += len(seqs)
+		if self.onNack:
+			self.onNack(self, seqs)
+
+	def stats(self):
+		return {
+			'ssrc': self.ssrc,
+			'packets': self.packets,
+			'octets': self.octets,
+			'reports': self.reports,
+			'fractionLost': self.fractionLost,
+			'cumulativeLost': self.cumulativeLost,
+			'jitter': self.jitter,
+			'rtt': self.rtt,
+			'nacked': self.nacked,
+			'retransmitted': self.retransmitted,
+		}
+
+def bindPortPair(port=0, host='', tries=32):
+	"""Bind UDP sockets to an even port and the next one, for RTP and RTCP.
+
+	With port 0 a free pair is picked. Return (rtpSocket, rtcpSocket)."""
+	for _ in range(tries if not port else 1):
+		rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		try:
+			rtp.bind((host, port))
+			rtpPort = rtp.getsockname()[1]
+			if rtpPort % 2 == 0:
+				rtcp.bind((host, rtpPort + 1))
+				return rtp, rtcp
+		except OSError:
+			if port:
+				rtp.close()
+				rtcp.close()
+				raise
+		rtp.close()
+		rtcp.close()
+	raise OSError("no free RTP/RTCP port pair")
@@ -0,0 +1,150 @@
+import heapq, json, random, struct, threading, time
+
+# A capture file is MAGIC followed by records: a header (microseconds
+# since the previous record, kind, length) and the datagram as received
+MAGIC = b'RTPCAP\x00\x01'
+RECORD_HEADER = struct.Struct('!IBH')
+
+# Record kinds
+RTP = 0
+RTCP = 1
+# JSON about the session (e.g. the FEC payload type), from the SETUP reply
+SESSION = 2
+
+MAX_DELTA = 0xFFFFFFFF
+
+class CaptureWriter:
+	"""Append received RTP/RTCP datagrams with their arrival times to a capture file.
+
+	Arrival times are relative to the first record, in microseconds, so a
+	capture replays the same wherever it was made. Safe to call from the
+	RTP and RTCP threads at once; writes after close() are ignored."""
+
+	def __init__(self, path):
+		self.file = open(path, 'wb')
+		self.file.write(MAGIC)
+		self.lock = threading.Lock()
+		self.last = None
+		self.records = 0
+
+	def write(self, kind, data, arrival=None):
+		"""Record one datagram (any bytes-like object) that arrived at 'arrival' (time.monotonic())."""
+		if arrival is None:
+			arrival = time.monotonic()
+		with self.lock:
+			if self.file.closed:
+				return
+			if self.last is None:
+				self.last = arrival
+			# Threads may stamp out of order by a hair; never go back in time
+			delta = min(MAX_DELTA, max(0, round((arrival - self.last) * 1e6)))
+			self.last += delta / 1e6
+			self.file.write(RECORD_HEADER.pack(delta, kind, len(data)))
+			self.file.write(data)
+			self.records += 1
+
+	def writeSession(self, info, arrival=None):
+		"""Record what a replay needs to know about the session, as a dict."""
+		self.write(SESSION, json.dumps(info, sort_keys=True).encode(), arrival)
+
+	def close(self):
+		with self.lock:
+			self.file.close()
+
+def readCapture(path):
+	"""Yield (arrival in seconds from the first record, kind, data) from a capture file.
+
+	Raises ValueError if the file is not a capture; a record cut short
+	at the end (the client was killed) ends the capture."""
+	with open(path, 'rb') as file:
+		if file.read(len(MAGIC)) != MAGIC:
+			raise ValueError("%s is not an RTP capture" % path)
+		micros = 0
+		while True:
+			header = file.read(RECORD_HEADER.size)
+			if len(header) < RECORD_HEADER.size:
+				return
+			delta, kind, length = RECORD_HEADER.unpack(header)
+			data = file.read(length)
+			if len(data) < length:
+				return
+			micros += delta
+			yield micros / 1e6, kind, data
+
+class NetworkModel:
+	"""Loss, reordering and delay applied to a capture, reproducibly from 'seed'.
+
+	With 'burst' 1 every packet is lost independently with probability
+	'loss'; above, loss follows a Gilbert model: in the bad state every
+	packet is lost, with bursts of 'burst' packets on average and 'loss'
+	of all packets lost overall, which needs 'burst' of at least
+	loss / (1 - loss). Every packet is delayed
+	by 'delay' plus a uniform random share of 'jitter' (seconds), and with
+	probability 'reorder' by 'reorderDelay' more, which puts it behind the
+	packets that follow. Session records pass untouched."""
+
+	def __init__(self, loss=0.0, burst=1.0, delay=0.0, jitter=0.0, reorder=0.0, reorderDelay=0.01, seed=0):
+		if not 0 <= loss < 1:
+			raise ValueError("loss must be in [0, 1)")
+		if burst < 1:
+			raise ValueError("burst must be at least 1")
+		self.loss = loss
+		self.delay = delay
+		self.jitter = jitter
+		self.reorder = reorder
+		self.reorderDelay = reorderDelay
+		self.random = random.Random(seed)
+		# Leaving the bad state ends a burst; entering it is set so that
+		# the share of time in it is 'loss'
+		self.burst = burst
+		self.recover = 1.0 / burst
+		self.fail = loss * self.recover / (1 - loss)
+		if burst > 1 and self.fail > 1:
+			raise ValueError("loss %g needs bursts of at least %g packets" % (loss, loss / (1 - loss)))
+		self.bad = False
+		self.lost = 0
+		self.reordered = 0
+
+	def dropped(self):
+		if self.loss <= 0:
+			return False
+		if self.burst == 1:
+			return self.random.random() < self.loss
+		if self.bad:
+			self.bad = self.random.random() >= self.recover
+		else:
+			self.bad = self.random.random() < self.fail
+		return self.bad
+
+	def extraDelay(self):
+		delay = self.delay
+		if self.jitter:
+			delay += self.random.random() * self.jitter
+		if self.reorder and self.random.random() < self.reorder:
+			delay += self.reorderDelay
+			self.reordered += 1
+		return delay
+
+	def apply(self, records):
+		"""Yield the (arrival, kind, data) records as they would arrive through the model.
+
+		Packets are held only until no later one can overtake them, so
+		a capture of any length streams through."""
+		pending = []
+		order = 0
+		for arrival, kind, data in records:
+			if kind == SESSION:
+				heapq.heappush(pending, (arrival, order, kind, data))
+			elif self.dropped():
+				self.lost += 1
+				continue
+			else:
+				heapq.heappush(pending, (arrival + self.extraDelay(), order, kind, data))
+			order += 1
+			# Nothing still to come can arrive before arrival + delay
+			while pending and pending[0][0] <= arrival + self.delay:
+				item = heapq.heappop(pending)
+				yield item[0], item[2], item[3]
+		while pending:
+			item = heapq.heappop(pending)
+			yield item[0], item[2], item[3]
@@ -1,74 +1,198 @@
-import sys
+import struct
 from time import time
+
 HEADER_SIZE = 12
+RTP_VERSION = 2
+RTP_CLOCK_RATE = 90000
+
+# V/P/X/CC, M/PT, sequence number, timestamp, SSRC
+RTP_HEADER = struct.Struct('!BBHII')
+# Header extension: profile-defined id and length in 32-bit words
+EXT_HEADER = struct.Struct('!HH')
+CSRC = struct.Struct('!I')
+
+# Header extension carrying the wall-clock send time in microseconds,
+# used to measure end-to-end latency on one host (see LoadTest)
+SEND_TIME_EXT = 0x5354
+SEND_TIME = struct.Struct('!Q')
+
+def mediaTimestamp(seconds, clockRate=RTP_CLOCK_RATE):
+	"""Convert seconds to an RTP timestamp on a 'clockRate' Hz media clock."""
+	return int(seconds * clockRate) & 0xFFFFFFFF
+
+class RtpPacket:
+	"""An RTP packet (RFC 3550).
+
+	Encoding keeps a reference to the payload instead of copying it: use
+	packInto() to write the packet into a preallocated buffer, or scatter()
+	to get [header, payload] for sendmsg. Decoding parses the header in
+	place and exposes the payload as a memoryview of the receive buffer,
+	so one instance can be reused for every datagram read with recv_into."""
+
+	__slots__ = ('ver', 'pad', 'mark', 'pt', 'seq', 'ts', 'ssrcId', 'csrcs',
+		'extProfile', 'extData', 'payload', 'header')
 
-class RtpPacket:	
-	header = bytearray(HEADER_SIZE)
-	
 	def __init__(self):
-		pass
-		
-	def encode(self, version, padding, extension, cc, seqnum, marker, pt, ssrc, payload):
-		"""Encode the RTP packet with header fields and payload."""
-		timestamp = int(time())
-		header = bytearray(HEADER_SIZE)
-		#--------------
-		# TO COMPLETE
-		#--------------
-		# Fill the header bytearray with RTP header fields
-		
-		# header[0] = ...
-		# ...
-		header[0] = ((version & 0x03) << 6) | ((padding & 0x01) << 5) | ((extension & 0x01) << 4) | (cc & 0x0F)
-		header[1] = ((marker & 0x01) << 7) | (pt & 0x7F)
-		header[2] = (seqnum >> 8) & 0xFF
-		header[3] = seqnum & 0xFF
-		header[4] = (timestamp >> 24) & 0xFF
-		header[5] = (timestamp >> 16) & 0xFF
-		header[6] = (timestamp >> 8) & 0xFF
-		header[7] = timestamp & 0xFF
-		header[8]  = (ssrc >> 24) & 0xFF
-		header[9]  = (ssrc >> 16) & 0xFF
-		header[10] = (ssrc >> 8) & 0xFF
-		header[11] = ssrc & 0xFF
-
-		self.header = header
-		
-		# Get the payload from the argument
-		# self.payload = ...
-		if isinstance(payload, bytes):
-			self.payload = bytearray(payload)
+		self.ver = RTP_VERSION
+		self.pad = 0
+		self.mark = 0
+		self.pt = 0
+		self.seq = 0
+		self.ts = 0
+		self.ssrcId = 0
+		self.csrcs = ()
+		self.extProfile = None
+		self.extData = b''
+		self.payload = b''
+		self.header = None
+
+	def encode(self, version, padding, extension, cc, seqnum, marker, pt, ssrc, payload, timestamp=None, csrcs=(), extProfile=0, extData=b''):
+		"""Encode the RTP packet with header fields and payload.
+
+		The timestamp defaults to the current time on the 90 kHz media clock.
+		'extension' and 'cc' are derived from extData and csrcs when given."""
+		if timestamp is None:
+			timestamp = mediaTimestamp(time())
+		self.ver = version
+		self.pad = padding
+		self.mark = marker
+		self.pt = pt
+		self.seq = seqnum & 0xFFFF
+		self.ts = timestamp & 0xFFFFFFFF
+		self.ssrcId = ssrc & 0xFFFFFFFF
+		self.csrcs = tuple(csrcs)[:15]
+		if extension or extData:
+			if len(extData) % 4:
+				raise ValueError("header extension length must be a multiple of 4 bytes")
+			self.extProfile = extProfile
+			self.extData = extData
 		else:
-			self.payload = bytearray(payload)
-		
-	def decode(self, byteStream):
-		"""Decode the RTP packet."""
-		self.header = bytearray(byteStream[:HEADER_SIZE])
-		self.payload = byteStream[HEADER_SIZE:]
-	
+			self.extProfile = None
+			self.extData = b''
+		self.payload = payload
+		self.header = None
+
+	def headerSize(self):
+		"""Return the size of the fixed header, CSRC list and extension."""
+		size = HEADER_SIZE + 4 * len(self.csrcs)
+		if self.extProfile is not None:
+			size += EXT_HEADER.size + len(self.extData)
+		return size
+
+	def packHeaderInto(self, buf, offset=0):
+		"""Write the header into 'buf' at 'offset'. Return its size."""
+		extension = self.extProfile is not None
+		RTP_HEADER.pack_into(buf, offset,
+			(self.ver & 0x03) << 6 | (self.pad & 0x01) << 5 | extension << 4 | len(self.csrcs),
+			(self.mark & 0x01) << 7 | (self.pt & 0x7F),
+			self.seq, self.ts, self.ssrcId)
+		pos = offset + HEADER_SIZE
+		for csrc in self.csrcs:
+			CSRC.pack_into(buf, pos, csrc)
+			pos += 4
+		if extension:
+			EXT_HEADER.pack_into(buf, pos, self.extProfile, len(self.extData) // 4)
+			pos += EXT_HEADER.size
+			buf[pos:pos + len(self.extData)] = self.extData
+			pos += len(self.extData)
+		return pos - offset
+
+	def packInto(self, buf, offset=0):
+		"""Write the whole packet into 'buf' at 'offset'. Return its size."""
+		pos = offset + self.packHeaderInto(buf, offset)
+		end = pos + len(self.payload)
+		# Slice assignment through a memoryview copies straight from the
+		# payload; bytearray slice assignment would first copy it to a temporary
+		memoryview(buf)[pos:end] = self.payload
+		return end - offset
+
+	def scatter(self):
+		"""Return [header, payload] buffers for sendmsg/sendmmsg."""
+		return [self.getHeader(), self.payload]
+
+	def decode(self, byteStream, nbytes=None):
+		"""Decode the RTP packet from the first 'nbytes' of a buffer, without copying."""
+		if nbytes is None:
+			nbytes = len(byteStream)
+		if nbytes < HEADER_SIZE:
+			raise ValueError("RTP packet too short")
+		b0, b1, self.seq, self.ts, self.ssrcId = RTP_HEADER.unpack_from(byteStream)
+		self.ver = b0 >> 6
+		self.pad = (b0 >> 5) & 0x01
+		self.mark = b1 >> 7
+		self.pt = b1 & 0x7F
+		pos = HEADER_SIZE
+		cc = b0 & 0x0F
+		if cc:
+			self.csrcs = struct.unpack_from('!%dI' % cc, byteStream, pos)
+			pos += 4 * cc
+		else:
+			self.csrcs = ()
+		view = memoryview(byteStream)
+		if b0 & 0x10:
+			self.extProfile, words = EXT_HEADER.unpack_from(byteStream, pos)
+			pos += EXT_HEADER.size
+			self.extData = view[pos:pos + 4 * words]
+			pos += 4 * words
+		else:
+			self.extProfile = None
+			self.extData = b''
+		end = nbytes
+		if self.pad:
+			# The last byte counts the padding bytes
+			end -= byteStream[nbytes - 1]
+		if pos > end:
+			raise ValueError("malformed RTP packet")
+		# The header is re-encoded on demand by getHeader()
+		self.header = None
+		self.payload = view[pos:end]
+
 	def version(self):
 		"""Return RTP version."""
-		return int(self.header[0] >> 6)
-	
+		return self.ver
+
 	def seqNum(self):
 		"""Return sequence (frame) number."""
-		seqNum = self.header[2] << 8 | self.header[3]
-		return int(seqNum)
-	
+		return self.seq
+
 	def timestamp(self):
 		"""Return timestamp."""
-		timestamp = self.header[4] << 24 | self.header[5] << 16 | self.header[6] << 8 | self.header[7]
-		return int(timestamp)
-	
+		return self.ts
+
+	def marker(self):
+		"""Return the marker bit."""
+		return self.mark
+
+	def ssrc(self):
+		"""Return the synchronization source identifier."""
+		return self.ssrcId
+
+	def csrcList(self):
+		"""Return the contributing source identifiers."""
+		return self.csrcs
+
+	def extension(self):
+		"""Return (profile, data) of the header extension, or None."""
+		if self.extProfile is None:
+			return None
+		return self.extProfile, self.extData
+
 	def payloadType(self):
 		"""Return payload type."""
-		pt = self.header[1] & 127
-		return int(pt)
-	
+		return self.pt
+
+	def getHeader(self):
+		"""Return the encoded header."""
+		if self.header is None:
+			header = bytearray(self.headerSize())
+			self.packHeaderInto(header)
+			self.header = header
+		return self.header
+
 	def getPayload(self):
 		"""Return payload."""
 		return self.payload
-		
+
 	def getPacket(self):
 		"""Return RTP packet."""
-		return self.header + self.payload
\ No newline at end of file
+		return b''.join((self.getHeader(), self.payload))
@@ -0,0 +1,251 @@
+import re, struct
+
+RTSP_VERSION = 'RTSP/1.0'
+
+# A blank line ends the start line and headers; lines end in CRLF or a bare LF
+HEADER_END = re.compile(rb'\r?\n\r?\n')
+
+MAX_HEADER_SIZE = 16384
+MAX_BODY_SIZE = 1 << 20
+
+# Interleaved binary data (RFC 2326 section 10.12): '$', channel, length
+INTERLEAVED_HEADER = struct.Struct('!cBH')
+INTERLEAVED_MAGIC = 0x24
+
+REASONS = {
+	200: 'OK',
+	400: 'Bad Request',
+	404: 'Not Found',
+	415: 'Unsupported Media Type',
+	453: 'Not Enough Bandwidth',
+	454: 'Session Not Found',
+	455: 'Method Not Valid in This State',
+	461: 'Unsupported Transport',
+	500: 'Internal Server Error',
+	501: 'Not Implemented',
+	503: 'Service Unavailable',
+}
+
+class RtspError(ValueError):
+	"""Malformed RTSP message."""
+
+class RtspMessage:
+	"""An RTSP request (method, uri) or response (status, reason).
+
+	'fields' keeps the headers as sent; 'headers' maps lower-case names
+	to values for lookups."""
+	__slots__ = ('method', 'uri', 'status', 'reason', 'version', 'fields', 'headers', 'body')
+
+	def __init__(self, method=None, uri=None, status=None, reason=None, version=RTSP_VERSION, fields=(), body=b''):
+		self.method = method
+		self.uri = uri
+		self.status = status
+		self.reason = reason
+		self.version = version
+		self.fields = list(fields)
+		self.headers = {name.lower(): value for name, value in self.fields}
+		self.body = body
+
+	def isRequest(self):
+		return self.method is not None
+
+	def header(self, name, default=None):
+		"""Return the value of a header (case-insensitive), or 'default'."""
+		return self.headers.get(name.lower(), default)
+
+	def cseq(self):
+		"""Return the CSeq as an int, or None."""
+		try:
+			return int(self.headers['cseq'])
+		except (KeyError, ValueError):
+			return None
+
+	def session(self):
+		"""Return the session id without parameters such as ';timeout=', or None."""
+		value = self.headers.get('session')
+		if value is None:
+			return None
+		return value.split(';', 1)[0].strip()
+
+	def sessionTimeout(self):
+		"""Return the 'timeout=' parameter of the Session header in seconds, or None."""
+		for param in self.headers.get('session', '').split(';')[1:]:
+			name, _, value = param.partition('=')
+			if name.strip().lower() == 'timeout':
+				try:
+					return int(value)
+				except ValueError:
+					return None
+		return None
+
+	def encode(self):
+		"""Return the message as bytes."""
+		if self.method is not None:
+			start = '%s %s %s' % (self.method, self.uri, self.version)
+		else:
+			start = '%s %d %s' % (self.version, self.status, self.reason)
+		fields = self.fields
+		if self.body and 'content-length' not in self.headers:
+			fields = fields + [('Content-Length', str(len(self.body)))]
+		head = '\r\n'.join([start] + ['%s: %s' % field for field in fields])
+		return head.encode() + b'\r\n\r\n' + bytes(self.body)
+
+	def __str__(self):
+		return self.encode().decode('utf-8', 'replace')
+
+class InterleavedFrame:
+	"""Binary data sent on the RTSP connection, e.g. an RTP or RTCP packet."""
+	__slots__ = ('channel', 'data')
+
+	def __init__(self, channel, data):
+		self.channel = channel
+		self.data = data
+
+	def isRequest(self):
+		return False
+
+def interleave(channel, data):
+	"""Return the header framing 'data' on interleaved 'channel'."""
+	return INTERLEAVED_HEADER.pack(b'$', channel, len(data))
+
+def response(status, cseq, fields=(), body=b''):
+	"""Return the bytes of a response carrying CSeq and the given (name, value) headers."""
+	message = RtspMessage(status=status, reason=REASONS.get(status, 'Unknown'),
+		fields=[('CSeq', str(cseq))] + list(fields), body=body)
+	return message.encode()
+
+def parseHead(data):
+	"""Parse a start line and headers (without the blank line). Return an RtspMessage or None if empty."""
+	lines = data.decode('utf-8', 'replace').split('\n')
+	# Empty lines may precede a message
+	first = 0
+	while first < len(lines) and not lines[first].strip():
+		first += 1
+	if first == len(lines):
+		return None
+	start = lines[first].rstrip('\r').split(' ', 2)
+	if len(start) != 3:
+		raise RtspError("bad start line %r" % lines[first])
+	if start[0].startswith('RTSP/'):
+		try:
+			message = RtspMessage(status=int(start[1]), reason=start[2], version=start[0])
+		except ValueError:
+			raise RtspError("bad status line %r" % lines[first])
+	else:
+		if not start[2].startswith('RTSP/'):
+			raise RtspError("bad request line %r" % lines[first])
+		message = RtspMessage(method=start[0], uri=start[1], version=start[2])
+
+	fields = message.fields
+	for line in lines[first + 1:]:
+		line = line.rstrip('\r')
+		if line[:1] in (' ', '\t') and fields:
+			# Continuation of the previous header
+			name, value = fields[-1]
+			fields[-1] = (name, value + ' ' + line.strip())
+			continue
+		name, sep, value = line.partition(':')
+		if not sep or not name.strip():
+			raise RtspError("bad header line %r" % line)
+		fields.append((name.strip(), value.strip()))
+	message.headers = {name.lower(): value for name, value in fields}
+	return message
+
+def parseMessage(data):
+	"""Parse one complete message from bytes or str."""
+	if isinstance(data, str):
+		data = data.encode()
+	parser = RtspParser()
+	for message in parser.feed(data if HEADER_END.search(data) else data + b'\r\n\r\n'):
+		return message
+	raise RtspError("incomplete message")
+
+class RtspParser:
+	"""Incremental parser for a stream of RTSP messages.
+
+	feed() buffers whatever was received and yields the messages it
+	completed, so requests split over several reads and pipelined
+	requests in one read both come out whole. A body is read when the
+	message has a Content-Length. Interleaved '$' frames between
+	messages come out as InterleavedFrames. Raises RtspError on
+	malformed input; the connection should then be closed."""
+
+	def __init__(self, maxHeaderSize=MAX_HEADER_SIZE, maxBodySize=MAX_BODY_SIZE):
+		self.buffer = bytearray()
+		self.maxHeaderSize = maxHeaderSize
+		self.maxBodySize = maxBodySize
+		# Parsed message waiting for its body
+		self.message = None
+		self.bodyLength = 0
+		# Where to resume looking for the blank line, so a message that
+		# arrives in many small reads is not scanned over and over
+		self.scanned = 0
+
+	def feed(self, data):
+		"""Add received bytes and yield each message completed so far.
+
+		Messages before a malformed one are yielded before the error is raised."""
+		buf = self.buffer
+		buf += data
+		while True:
+			if self.message is None and buf[:1] == b'$':
+				# A run of frames is cut out of the buffer in one go
+				frames = self.frames()
+				for frame in frames:
+					yield frame
+				if buf[:1] == b'$':
+					# Incomplete frame
+					return
+				continue
+			if self.message is None:
+				match = HEADER_END.search(buf, self.scanned)
+				if match is None:
+					if len(buf) > self.maxHeaderSize:
+						raise RtspError("header section too long")
+					# The terminator is at most 4 bytes and may be cut short
+					self.scanned = max(0, len(buf) - 3)
+					return
+				message = parseHead(bytes(buf[:match.start()]))
+				del buf[:match.end()]
+				self.scanned = 0
+				if message is None:
+					continue
+				try:
+					length = int(message.headers.get('content-length', 0))
+				except ValueError:
+					raise RtspError("bad Content-Length")
+				if length < 0 or length > self.maxBodySize:
+					raise RtspError("bad Content-Length %d" % length)
+				self.message = message
+				self.bodyLength = length
+			if len(buf) < self.bodyLength:
+				return
+			message = self.message
+			if self.bodyLength:
+				message.body = bytes(buf[:self.bodyLength])
+				del buf[:self.bodyLength]
+			self.message = None
+			self.bodyLength = 0
+			yield message
+
+	def frames(self):
+		"""Remove the complete interleaved frames at the start of the buffer and return them."""
+		buf = self.buffer
+		frames = []
+		pos = 0
+		end = len(buf)
+		with memoryview(buf) as view:
+			while end - pos >= INTERLEAVED_HEADER.size and buf[pos] == INTERLEAVED_MAGIC:
+				_, channel, length = INTERLEAVED_HEADER.unpack_from(view, pos)
+				start = pos + INTERLEAVED_HEADER.size
+				if end - start < length:
+					break
+				frames.append(InterleavedFrame(channel, bytes(view[start:start + length])))
+				pos = start + length
+		del buf[:pos]
+		self.scanned = 0
+		return frames
+
+	def pending(self):
+		"""Return the number of bytes of an incomplete message, e.g. at EOF."""
+		return len(self.buffer) + (1 if self.message is not None else 0)
@@ -0,0 +1,265 @@
+import heapq, itertools, threading, time, traceback
+from collections import deque
+
+import Metrics
+
+# Share of the frame interval over which a frame's packets are spread
+SPREAD = 0.8
+# Packets sent back to back in one pacing slot
+PACKETS_PER_SLOT = 8
+# A stream this many intervals late starts over instead of bursting to catch up
+RESYNC_INTERVALS = 5
+
+LATENESS_SECONDS = Metrics.histogram('rtp_scheduler_lateness_seconds', "How late scheduled events (frames, packet slots) ran")
+
+class TokenBucket:
+	"""Token bucket bandwidth cap: 'rate' bytes/s with bursts of 'burst' bytes."""
+
+	def __init__(self, rate, burst=None):
+		self.rate = float(rate)
+		self.burst = float(burst if burst is not None else max(rate / 10, 64 * 1024))
+		self.tokens = self.burst
+		self.last = time.monotonic()
+		# Bytes sent by other threads (charge()), taken on the next refill
+		self.owed = 0
+		self.lock = threading.Lock()
+
+	def refill(self, now):
+		if self.owed:
+			with self.lock:
+				self.tokens -= self.owed
+				self.owed = 0
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+
+	def delay(self, nbytes, now):
+		"""Return how long to wait before 'nbytes' may be sent (0: now)."""
+		self.refill(now)
+		# More than a burst goes once the bucket is full and leaves it in debt
+		nbytes = min(nbytes, self.burst)
+		if self.tokens >= nbytes:
+			return 0.0
+		return (nbytes - self.tokens) / self.rate
+
+	def consume(self, nbytes):
+		self.tokens -= nbytes
+
+	def charge(self, nbytes):
+		"""Account for 'nbytes' sent outside the scheduler; safe from any thread."""
+		with self.lock:
+			self.owed += nbytes
+
+class LatenessStats:
+	"""How late scheduled events ran, to see when the server is overloaded."""
+
+	def __init__(self, window=2048):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.recent = deque(maxlen=window)
+
+	def add(self, lateness):
+		self.count += 1
+		self.total += lateness
+		if lateness > self.max:
+			self.max = lateness
+		self.recent.append(lateness)
+
+	def stats(self):
+		recent = sorted(self.recent)
+		def pct(p):
+			return recent[min(len(recent) - 1, int(p * len(recent)))] if recent else 0.0
+		return {
+			'events': self.count,
+			'mean': self.total / self.count if self.count else 0.0,
+			'max': self.max,
+			'p50': pct(0.5),
+			'p99': pct(0.99),
+		}
+
+class PacingScheduler:
+	"""Central timer heap on the monotonic clock.
+
+	Callbacks run at their deadline, either on the scheduler's own thread
+	(start()) or driven from an event loop through runDue(). 'afterRun' is
+	called once after each batch of due callbacks, e.g. to flush a
+	UdpBatchSender, so packets of all sessions due together share a
+	batch. An optional global token bucket caps the total bandwidth."""
+
+	def __init__(self, globalRate=0, afterRun=None):
+		self.heap = []
+		self.counter = itertools.count()
+		self.cond = threading.Condition()
+		self.afterRun = afterRun
+		self.globalBucket = TokenBucket(globalRate) if globalRate else None
+		self.lateness = LatenessStats()
+		# Called when a new earliest deadline is added (event loop mode)
+		self.onWake = None
+
+	def callAt(self, when, callback):
+		"""Run 'callback(now)' at monotonic time 'when'. Return a cancellable handle."""
+		entry = [when, next(self.counter), callback]
+		with self.cond:
+			heapq.heappush(self.heap, entry)
+			earliest = self.heap[0] is entry
+			if earliest:
+				self.cond.notify()
+		if earliest and self.onWake:
+			self.onWake(when)
+		return entry
+
+	def cancel(self, entry):
+		"""Cancel a pending callback."""
+		entry[2] = None
+
+	def nextDeadline(self):
+		with self.cond:
+			while self.heap and self.heap[0][2] is None:
+				heapq.heappop(self.heap)
+			return self.heap[0][0] if self.heap else None
+
+	def runDue(self, now=None):
+		"""Run every callback that is due. Return the next deadline or None."""
+		if now is None:
+			now = time.monotonic()
+		ran = False
+		while True:
+			with self.cond:
+				if not self.heap or self.heap[0][0] > now:
+					break
+				when, _, callback = heapq.heappop(self.heap)
+			if callback is None:
+				continue
+			self.lateness.add(now - when)
+			if Metrics.enabled:
+				LATENESS_SECONDS.observe(now - when)
+			try:
+				callback(now)
+			except Exception:
+				# One broken session must not stop the others
+				traceback.print_exc()
+			ran = True
+		if ran and self.afterRun:
+			self.afterRun()
+		return self.nextDeadline()
+
+	def report(self):
+		"""Return a one-line summary of the scheduling lateness."""
+		s = self.lateness.stats()
+		return "Scheduler: %d events, lateness mean %.2f ms, p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+			s['events'], 1e3 * s['mean'], 1e3 * s['p50'], 1e3 * s['p99'], 1e3 * s['max'])
+
+	def start(self):
+		"""Run the scheduler on its own thread."""
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def run(self):
+		while True:
+			with self.cond:
+				while True:
+					now = time.monotonic()
+					if self.heap and self.heap[0][0] <= now:
+						break
+					self.cond.wait(self.heap[0][0] - now if self.heap else None)
+			self.runDue()
+
+class PacedStream:
+	"""Paces one session's frames and packets on a PacingScheduler.
+
+	Frame n is due at start + n / fps, so scheduling delays never
+	accumulate. The packets of a frame are sent in slots spread over part
+	of the frame interval rather than in one burst. Per-session and
+	global token buckets may hold packets back. A frame that comes due
+	while the previous one is still being sent is skipped with
+	'skipFrame()', so that whole frames arrive; without 'skipFrame' the
+	rest of the previous frame is dropped instead. 'cost(packet)' is what
+	a packet takes from the buckets, its length unless it is sent to
+	several receivers."""
+
+	def __init__(self, scheduler, nextPackets, send, fps, sessionRate=0, skipFrame=None, cost=len):
+		self.scheduler = scheduler
+		self.nextPackets = nextPackets
+		self.skipFrame = skipFrame
+		self.send = send
+		self.cost = cost
+		self.interval = 1.0 / fps
+		self.bucket = TokenBucket(sessionRate) if sessionRate else None
+		self.queue = deque()
+		self.timers = []
+		self.running = False
+		self.framesSent = 0
+		self.framesDropped = 0
+		self.resyncs = 0
+
+	def start(self):
+		self.running = True
+		self.t0 = time.monotonic()
+		self.frameIndex = 1
+		self.schedule(self.t0 + self.interval, self.onFrame)
+
+	def stop(self):
+		self.running = False
+		for timer in self.timers:
+			self.scheduler.cancel(timer)
+		self.timers = []
+
+	def schedule(self, when, callback):
+		self.timers = [t for t in self.timers if t[2] is not None and t[0] > when - self.interval]
+		self.timers.append(self.scheduler.callAt(when, callback))
+
+	def onFrame(self, now):
+		if not self.running:
+			return
+		deadline = self.t0 + self.frameIndex * self.interval
+		if now - deadline > RESYNC_INTERVALS * self.interval:
+			# Far behind (overload or suspend): start over from now
+			self.resyncs += 1
+			self.t0 = now - self.frameIndex * self.interval
+			deadline = now
+
+		if self.queue:
+			# The previous frame could not be sent in time
+			self.framesDropped += 1
+			if self.skipFrame:
+				self.skipFrame()
+				self.frameIndex += 1
+				self.schedule(self.t0 + self.frameIndex * self.interval, self.onFrame)
+				return
+			self.queue.clear()
+		packets = self.nextPackets()
+		if not packets:
+			self.running = False
+			return
+		self.framesSent += 1
+		self.queue.extend(packets)
+
+		self.frameIndex += 1
+		self.schedule(self.t0 + self.frameIndex * self.interval, self.onFrame)
+
+		slots = -(-len(packets) // PACKETS_PER_SLOT)
+		self.slotStep = self.interval * SPREAD / slots
+		self.slotDeadline = deadline
+		self.onSlot(now)
+
+	def onSlot(self, now):
+		if not self.running:
+			return
+		globalBucket = self.scheduler.globalBucket
+		sent = 0
+		while self.queue and sent < PACKETS_PER_SLOT:
+			nbytes = self.cost(self.queue[0])
+			wait = self.bucket.delay(nbytes, now) if self.bucket else 0.0
+			if globalBucket:
+				wait = max(wait, globalBucket.delay(nbytes, now))
+			if wait > 0:
+				self.schedule(now + wait, self.onSlot)
+				return
+			if self.bucket:
+				self.bucket.consume(nbytes)
+			if globalBucket:
+				globalBucket.consume(nbytes)
+			self.send(self.queue.popleft())
+			sent += 1
+		if self.queue:
+			self.slotDeadline += self.slotStep
+			self.schedule(max(self.slotDeadline, now), self.onSlot)
@@ -0,0 +1,78 @@
+from array import array
+
+from RtpPacket import RTP_HEADER
+
+# Seconds of a session's packets kept for retransmission, and the bounds
+# of the ring in packets (powers of two)
+HISTORY_SECONDS = 1.0
+MIN_SLOTS = 64
+MAX_SLOTS = 4096
+
+def historySlots(rate, mtu, seconds=HISTORY_SECONDS):
+	"""Return the ring size holding 'seconds' of a stream of 'rate' bits/s in packets of 'mtu' bytes."""
+	packets = rate / 8 * seconds / mtu
+	slots = MIN_SLOTS
+	while slots < packets and slots < MAX_SLOTS:
+		slots *= 2
+	return slots
+
+class SendHistory:
+	"""Ring buffer of the last RTP packets sent in a session, for retransmission.
+
+	One buffer of 'slots' packets of up to 'size' bytes is allocated up
+	front; packet n goes to slot n % slots, overwriting packet n - slots.
+	With a power-of-two ring this holds across the wrap of the sequence
+	numbers. Storing copies the packet in, so nothing is allocated per
+	packet, and a resend copies it back out without going back to the
+	VideoStream."""
+
+	def __init__(self, size, slots=MIN_SLOTS):
+		if slots & (slots - 1) or not 0 < slots <= 1 << 16:
+			raise ValueError("history slots must be a power of two up to 65536")
+		self.size = size
+		self.slots = slots
+		self.buffer = bytearray(size * slots)
+		self.view = memoryview(self.buffer)
+		self.lengths = array('H', [0]) * slots
+		self.seqs = array('l', [-1]) * slots
+		# When each packet was last resent (monotonic time)
+		self.resent = array('d', [0.0]) * slots
+		self.missed = 0
+		self.held = 0
+
+	def store(self, packet):
+		"""Keep a copy of a packet just sent. Return False if it is too large to keep."""
+		nbytes = len(packet)
+		if nbytes > self.size:
+			return False
+		seq = RTP_HEADER.unpack_from(packet)[2]
+		slot = seq & (self.slots - 1)
+		offset = slot * self.size
+		self.view[offset:offset + nbytes] = packet
+		self.lengths[slot] = nbytes
+		self.seqs[slot] = seq
+		self.resent[slot] = 0.0
+		return True
+
+	def get(self, seq):
+		"""Return a copy of packet 'seq', or None if it is not kept (any more)."""
+		slot = seq & (self.slots - 1)
+		if self.seqs[slot] != seq:
+			return None
+		offset = slot * self.size
+		return bytes(self.view[offset:offset + self.lengths[slot]])
+
+	def resend(self, seq, now, holdoff):
+		"""Return a copy of packet 'seq' to resend, or None if it is gone or
+		was already resent less than 'holdoff' seconds ago."""
+		packet = self.get(seq)
+		if packet is None:
+			self.missed += 1
+			return None
+		slot = seq & (self.slots - 1)
+		if now - self.resent[slot] < holdoff:
+			# The previous resend may still be on its way
+			self.held += 1
+			return None
+		self.resent[slot] = now
+		return packet
@@ -1,25 +1,205 @@
-import sys, socket
+import sys, socket, argparse, threading, time
 
 from ServerWorker import ServerWorker
+from UdpBatchSender import SEND_MODES
+from FrameCache import FrameCache, DEFAULT_READ_AHEAD
+from Channel import Channel, parseChannel
+from Renditions import RenditionLadder
+from SessionManager import SessionManager, DEFAULT_TIMEOUT
+from WorkerPool import WorkerPool, reusePortSupported, STATS_INTERVAL
+import Metrics
+
+# Seconds between two statistics reports (frame cache, scheduler)
+REPORT_INTERVAL = 30
+
+class Server:
 
-class Server:	
-	
 	def main(self):
-		try:
-			SERVER_PORT = int(sys.argv[1])
-		except:
-			print("[Usage: Server.py Server_port]\n")
+		parser = argparse.ArgumentParser(description="RTSP/RTP video streaming server.")
+		parser.add_argument('port', type=int, help="RTSP server port")
+		parser.add_argument('--media-root', default=ServerWorker.MEDIA_ROOT, metavar='DIR',
+			help="directory movies are served from; clients name them relative to it (default: the current directory)")
+		parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+			help="threaded: one thread per client (default); async: all sessions on one asyncio event loop")
+		parser.add_argument('--mtu', type=int, default=ServerWorker.MTU,
+			help="largest RTP packet in bytes; frames are fragmented to fit (default %(default)s)")
+		parser.add_argument('--udp-send', choices=SEND_MODES, default=ServerWorker.SEND_MODE,
+			help="RTP send path: batched with GSO or sendmmsg where available, or plain sendto (default %(default)s)")
+		parser.add_argument('--rtp-port', type=int, default=0,
+			help="even UDP port RTP is sent from, RTCP uses the next one (default: any free pair)")
+		parser.add_argument('--cache-mb', type=int, default=0,
+			help="share a frame cache of this many MB between sessions (default: off)")
+		parser.add_argument('--read-ahead', type=int, default=DEFAULT_READ_AHEAD,
+			help="frames of each active stream kept warm in the cache (default %(default)s)")
+		parser.add_argument('--renditions', action='store_true',
+			help="build lower-quality renditions of each movie with Pillow (cached next to it) "
+				"and switch sessions between them by receiver feedback")
+		parser.add_argument('--channel', action='append', default=[], metavar='NAME=FILE[@GROUP:PORT]',
+			help="broadcast FILE as channel NAME, read and packetized once for all viewers; "
+				"optionally also to a multicast group (repeatable)")
+		parser.add_argument('--live', action='store_true',
+			help="accept live MJPEG streams pushed with ANNOUNCE/RECORD (see Publisher.py) and relay them "
+				"to any number of viewers, who play the announced name")
+		parser.add_argument('--record-live', metavar='DIR',
+			help="also record every live stream to DIR/NAME.Mjpeg (implies --live)")
+		parser.add_argument('--fps', type=float, default=None,
+			help="frame rate of every session (default: the movie's own rate; clients may ask with X-Frame-Rate)")
+		parser.add_argument('--session-kbps', type=int, default=0,
+			help="cap the RTP bandwidth of each session, in kbit/s (default: no cap)")
+		parser.add_argument('--max-kbps', type=int, default=0,
+			help="cap the total RTP bandwidth of all sessions, in kbit/s, and refuse SETUP with 453 "
+				"when a new session would not fit (default: no cap)")
+		parser.add_argument('--max-sessions', type=int, default=0,
+			help="refuse SETUP with 503 beyond this many sessions (default: no limit)")
+		parser.add_argument('--session-timeout', type=int, default=DEFAULT_TIMEOUT,
+			help="seconds a session lives without a request or RTCP report; 0 never expires (default %(default)s)")
+		parser.add_argument('--retransmit-share', type=float, default=ServerWorker.RETRANSMIT_SHARE,
+			help="share of a session's bit rate that packets resent on RTCP NACKs may add, "
+				"for RTP/AVPF clients; 0 never resends (default %(default)s)")
+		parser.add_argument('--send-timestamps', action='store_true',
+			help="add a header extension with the send time to every RTP packet (for LoadTest latency)")
+		parser.add_argument('--workers', type=int, default=1,
+			help="serve from this many processes sharing the port (SO_REUSEPORT), restarted if they crash; "
+				"--max-sessions and --max-kbps are split between them (default %(default)s)")
+		parser.add_argument('--metrics-port', type=int, default=0,
+			help="time the hot paths and serve them with per-session counters on http://127.0.0.1:PORT/metrics "
+				"(Prometheus text format); worker N of a pool uses PORT + N (default: off)")
+		parser.add_argument('--profile', metavar='FILE',
+			help="sample the stacks of all threads and write them to FILE (collapsed, for flame graphs) "
+				"every %d s; also served on /profile with --metrics-port" % REPORT_INTERVAL)
+		parser.add_argument('--verbose', action='store_true', help="print every RTSP request received")
+		args = parser.parse_args()
+
+		if args.workers > 1:
+			if not reusePortSupported():
+				parser.error("--workers needs SO_REUSEPORT (Linux or BSD)")
+			if args.live or args.record_live:
+				# A publisher and its viewers must reach the same process
+				parser.error("--live needs a single worker")
+			WorkerPool(args.workers, runWorker, (args,)).run(REPORT_INTERVAL)
+		else:
+			self.serve(args)
+
+	def serve(self, args, index=0, statsQueue=None):
+		"""Configure the sessions from the arguments and serve forever.
+
+		Worker 'index' of a pool takes its share of the limits and sends
+		its counters to 'statsQueue' instead of printing reports."""
+		def share(limit):
+			return -(-limit // args.workers)
+
+		ServerWorker.MEDIA_ROOT = args.media_root
+		ServerWorker.MTU = args.mtu
+		ServerWorker.SEND_MODE = args.udp_send
+		ServerWorker.RTP_PORT = args.rtp_port + 2 * index if args.rtp_port else 0
+		ServerWorker.FPS = args.fps
+		ServerWorker.SEND_TIMESTAMPS = args.send_timestamps
+		ServerWorker.RETRANSMIT_SHARE = args.retransmit_share
+		ServerWorker.SESSION_RATE = args.session_kbps * 1000 // 8
+		ServerWorker.GLOBAL_RATE = share(args.max_kbps) * 1000 // 8
+		ServerWorker.sessions = SessionManager(share(args.max_sessions), share(args.max_kbps) * 1000, args.session_timeout)
+		if args.cache_mb:
+			ServerWorker.FRAME_CACHE = FrameCache(args.cache_mb << 20, args.read_ahead)
+		if args.renditions:
+			ServerWorker.RENDITIONS = RenditionLadder()
+		ServerWorker.VERBOSE = args.verbose
+		ServerWorker.LIVE_INGEST = args.live or bool(args.record_live)
+		ServerWorker.LIVE_RECORD_DIR = args.record_live
+		profiler = None
+		if args.profile:
+			profiler = Metrics.SamplingProfiler()
+			profiler.start()
+			path = args.profile if args.workers == 1 else '%s.%d' % (args.profile, index)
+			threading.Thread(target=self.dumpProfile, args=(profiler, path), daemon=True).start()
+		if args.metrics_port:
+			Metrics.addCollector(ServerWorker.collectMetrics)
+			Metrics.serve(args.metrics_port + index, profiler=profiler)
+		if statsQueue is None:
+			threading.Thread(target=self.reportStats, daemon=True).start()
+		else:
+			threading.Thread(target=self.sendStats, args=(index, statsQueue), daemon=True).start()
+
+		for spec in args.channel:
+			name, filename, multicast = parseChannel(spec)
+			channel = Channel(name, filename, args.mtu, args.fps, multicast, ServerWorker.FRAME_CACHE)
+			# One copy to the group is enough, whichever worker the viewer is on
+			channel.sendMulticast = index == 0
+			ServerWorker.CHANNELS[name] = channel
+
+		reusePort = args.workers > 1
+		if args.mode == 'async':
+			from AsyncServer import AsyncServer
+			AsyncServer().main(args.port, reusePort)
+		else:
+			for channel in ServerWorker.CHANNELS.values():
+				channel.start(ServerWorker.getScheduler(), ServerWorker.getSender())
+			self.serveThreaded(args.port, reusePort)
+
+	def reportStats(self):
+		"""Print the frame cache, scheduler and session statistics periodically."""
+		while True:
+			time.sleep(REPORT_INTERVAL)
+			if ServerWorker.FRAME_CACHE:
+				print(ServerWorker.FRAME_CACHE.report())
+			if ServerWorker.scheduler:
+				print(ServerWorker.scheduler.report())
+			print(ServerWorker.sessions.report())
+			report = ServerWorker.sessionReport()
+			if report:
+				print(report)
+
+	def dumpProfile(self, profiler, path):
+		"""Write the profile to 'path' and print its top functions periodically."""
+		while True:
+			time.sleep(REPORT_INTERVAL)
+			profiler.dump(path)
+			print(profiler.report())
+
+	def sendStats(self, index, statsQueue):
+		"""Send this worker's counters to the supervisor periodically."""
+		while True:
+			time.sleep(STATS_INTERVAL)
+			statsQueue.put((index, self.stats()))
+
+	def stats(self):
+		"""Return the counters of this process, see WorkerPool.totals."""
+		sessions = ServerWorker.sessions
+		stats = {
+			'sessions': len(sessions.sessions),
+			'opened': sessions.opened,
+			'expired': sessions.expired,
+			'refused': sessions.refused,
+			'reservedKbps': sessions.reserved / 1000,
+		}
+		if ServerWorker.rtpSender:
+			stats['packets'] = ServerWorker.rtpSender.sent
+			stats['dropped'] = ServerWorker.rtpSender.dropped
+		if ServerWorker.scheduler:
+			stats['latenessP99'] = ServerWorker.scheduler.lateness.stats()['p99']
+		return stats
+
+	def serveThreaded(self, SERVER_PORT, reusePort=False):
+		"""Accept clients and start one ServerWorker thread for each."""
 		rtspSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		if reusePort:
+			# The other workers listen on the same port
+			rtspSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 		rtspSocket.bind(('', SERVER_PORT))
-		rtspSocket.listen(5)        
+		rtspSocket.listen(5)
 
 		# Receive client info (address,port) through RTSP/TCP session
 		while True:
 			clientInfo = {}
 			clientInfo['rtspSocket'] = rtspSocket.accept()
-			ServerWorker(clientInfo).run()		
+			ServerWorker(clientInfo).run()
+
+def runWorker(index, statsQueue, args):
+	"""Entry point of a worker process, see WorkerPool."""
+	try:
+		Server().serve(args, index, statsQueue)
+	except KeyboardInterrupt:
+		pass
 
 if __name__ == "__main__":
 	(Server()).main()
 
-
@@ -1,28 +1,120 @@
-from random import randint
-import sys, traceback, threading, socket
+from random import randint, uniform
+import os, sys, traceback, threading, socket, time
 
 from VideoStream import VideoStream
-from RtpPacket import RtpPacket
+from JpegPacketizer import JpegPacketizer, DEFAULT_MTU, RTP_CLOCK_RATE, MJPEG_PT
+from UdpBatchSender import UdpBatchSender
+from RtpPacket import SEND_TIME_EXT, SEND_TIME, HEADER_SIZE
+from Scheduler import PacingScheduler, PacedStream, TokenBucket
+from Rtcp import RtcpSession, RTCP_INTERVAL, RR, SR, RTPFB, FMT_NACK, parseCompound, parseNack, bindPortPair
+from Renditions import QualityController
+from SessionManager import SessionManager, AdmissionError
+from RtspMessage import RtspParser, RtspMessage, RtspError, InterleavedFrame, parseMessage, response
+from Fec import FecEncoder, FEC_PT, FEC_HEADER_SIZE, parseLayout
+from SendHistory import SendHistory, historySlots
+from InterleavedWriter import InterleavedWriter
+from LiveStream import LiveStream, parseSdp, recordingPath
+import Metrics
+
+FRAME_READ_SECONDS = Metrics.histogram('rtp_frame_read_seconds', "Time to read a frame from the movie or the frame cache")
+PACKETIZE_SECONDS = Metrics.histogram('rtp_packetize_seconds', "Time to packetize a frame, parity packets included")
 
 class ServerWorker:
 	SETUP = 'SETUP'
 	PLAY = 'PLAY'
 	PAUSE = 'PAUSE'
 	TEARDOWN = 'TEARDOWN'
+	GET_PARAMETER = 'GET_PARAMETER'
+	OPTIONS = 'OPTIONS'
+	ANNOUNCE = 'ANNOUNCE'
+	RECORD = 'RECORD'
 	
 	INIT = 0
 	READY = 1
 	PLAYING = 2
-	state = INIT
+	RECORDING = 3
 
 	OK_200 = 0
 	FILE_NOT_FOUND_404 = 1
 	CON_ERR_500 = 2
+	BAD_REQUEST_400 = 3
+	METHOD_NOT_VALID_455 = 4
+	NOT_IMPLEMENTED_501 = 5
+	NOT_ENOUGH_BANDWIDTH_453 = 6
+	SESSION_NOT_FOUND_454 = 7
+	SERVICE_UNAVAILABLE_503 = 8
+	UNSUPPORTED_TRANSPORT_461 = 9
+	UNSUPPORTED_MEDIA_TYPE_415 = 10
+	
+	STATUS = {OK_200: 200, FILE_NOT_FOUND_404: 404, CON_ERR_500: 500,
+		BAD_REQUEST_400: 400, METHOD_NOT_VALID_455: 455, NOT_IMPLEMENTED_501: 501,
+		NOT_ENOUGH_BANDWIDTH_453: 453, SESSION_NOT_FOUND_454: 454, SERVICE_UNAVAILABLE_503: 503,
+		UNSUPPORTED_TRANSPORT_461: 461, UNSUPPORTED_MEDIA_TYPE_415: 415}
+	ADMISSION_STATUS = {453: NOT_ENOUGH_BANDWIDTH_453, 503: SERVICE_UNAVAILABLE_503}
+	
+	# Interval between two video frames (20 fps)
+	FRAME_INTERVAL = 0.05
+	
+	# Largest RTP packet sent; bigger frames are fragmented
+	MTU = DEFAULT_MTU
+	
+	# Directory movies are served from; SETUP refuses paths outside it, so
+	# the index and rendition files written next to a movie stay inside too
+	MEDIA_ROOT = '.'
+	
+	# Broadcast channels by name, see Channel
+	CHANNELS = {}
+	
+	# Accept live streams pushed with ANNOUNCE/RECORD, and the directory
+	# they are recorded to (None: not recorded); live streams by name,
+	# see LiveStream
+	LIVE_INGEST = False
+	LIVE_RECORD_DIR = None
+	LIVE = {}
+	liveLock = threading.Lock()
+	
+	# Frame cache shared by every session (None: read the movie directly)
+	FRAME_CACHE = None
+	
+	# Lower-quality renditions sessions switch between (None: off), see Renditions
+	RENDITIONS = None
+	
+	# UDP socket shared by every session, see UdpBatchSender, and the
+	# RTCP socket on the next port (RTP_PORT 0: any free pair)
+	SEND_MODE = 'auto'
+	RTP_PORT = 0
+	rtpSender = None
+	rtcpSocket = None
+	senderLock = threading.Lock()
+	
+	# RTCP state of every session by SSRC, see Rtcp.RtcpSession
+	rtcpSessions = {}
 	
-	clientInfo = {}
+	# Every session by ID, with idle timeout and admission limits
+	sessions = SessionManager()
+	
+	# Scheduler pacing every session, with optional bandwidth caps in bytes/s
+	scheduler = None
+	SESSION_RATE = 0
+	GLOBAL_RATE = 0
+	
+	# Frame rate forced on every session (None: the movie's own rate)
+	FPS = None
+	
+	# Stamp every packet with its send time, for latency measurements
+	SEND_TIMESTAMPS = False
+	
+	# Print every RTSP request received
+	VERBOSE = False
+	
+	# Share of a session's bit rate that retransmissions (RTP/AVPF clients)
+	# may add, and how long a packet is not resent again without an RTT
+	RETRANSMIT_SHARE = 0.1
+	RESEND_HOLDOFF = 0.05
 	
 	def __init__(self, clientInfo):
 		self.clientInfo = clientInfo
+		self.state = self.INIT
 		
 	def run(self):
 		threading.Thread(target=self.recvRtspRequest).start()
@@ -30,63 +122,211 @@ class ServerWorker:
 	def recvRtspRequest(self):
 		"""Receive RTSP request from the client."""
 		connSocket = self.clientInfo['rtspSocket'][0]
-		while True:            
-			data = connSocket.recv(256)
-			if data:
-				print("Data received:\n" + data.decode("utf-8"))
-				self.processRtspRequest(data.decode("utf-8"))
-	
-	def processRtspRequest(self, data):
-		"""Process RTSP request sent from the client."""
+		parser = RtspParser()
+		while True:
+			try:
+				data = connSocket.recv(4096)
+			except OSError:
+				data = b''
+			if not data:
+				# The client closed the connection, possibly without TEARDOWN
+				self.closeSession()
+				self.closeWriter()
+				connSocket.close()
+				break
+			seq = 0
+			try:
+				for request in parser.feed(data):
+					if isinstance(request, InterleavedFrame):
+						self.receiveInterleaved(request)
+						continue
+					if self.VERBOSE:
+						print("Data received:\n" + str(request))
+					seq = request.header('cseq', '0')
+					self.processRtspRequest(request)
+				continue
+			except RtspError as e:
+				print("Bad request: %s" % e)
+				self.replyError(self.BAD_REQUEST_400, 0)
+			except Exception:
+				# A bug must not leave the session (and its reserved bandwidth) and the socket behind
+				traceback.print_exc()
+				self.replyError(self.CON_ERR_500, seq)
+			self.closeSession()
+			self.closeWriter()
+			connSocket.close()
+			break
+	
+	def replyError(self, code, seq):
+		"""Send an error reply before dropping the connection, if it still takes one."""
+		try:
+			self.replyRtsp(code, seq)
+		except OSError:
+			pass
+	
+	def processRtspRequest(self, request):
+		"""Process RTSP request sent from the client (an RtspMessage or its text)."""
+		if not isinstance(request, RtspMessage):
+			request = parseMessage(request)
+		
 		# Get the request type
-		request = data.split('\n')
-		line1 = request[0].split(' ')
-		requestType = line1[0]
+		requestType = request.method
 		
 		# Get the media file name
-		filename = line1[1]
+		filename = request.uri
 		
 		# Get the RTSP sequence number 
-		seq = request[1].split(' ')
+		seq = request.header('cseq', '0')
+		
+		# Requests after SETUP must name this connection's session
+		session = self.clientInfo.get('sessionEntry')
+		if requestType in (self.PLAY, self.PAUSE, self.TEARDOWN, self.GET_PARAMETER, self.RECORD):
+			if session is None or request.session() != str(session.id):
+				self.replyRtsp(self.SESSION_NOT_FOUND_454, seq)
+				return
+			self.sessions.touch(session)
 		
 		# Process SETUP request
 		if requestType == self.SETUP:
 			if self.state == self.INIT:
 				print("processing SETUP\n")
 
+				# The publisher of an announced stream sets up where it sends to
+				announced = self.clientInfo.get('announced')
+				if announced is not None and announced.name == filename:
+					self.setupRecord(request, seq)
+					return
+
+				# A channel or live stream name joins it, anything else is a movie file
+				channel = self.CHANNELS.get(filename)
+				live = self.LIVE.get(filename) if not channel else None
 				try:
-					self.clientInfo['videoStream'] = VideoStream(filename)
-					self.state = self.READY
+					if channel:
+						self.clientInfo['channel'] = channel
+					elif live:
+						self.clientInfo['live'] = live
+					else:
+						path = self.resolveMovie(filename)
+						if path is None:
+							raise IOError("%s is outside the media root" % filename)
+						self.clientInfo['videoStream'] = VideoStream(path, self.parseFrameRate(request) or self.FPS, self.FRAME_CACHE, self.RENDITIONS)
 				except IOError:
-					self.replyRtsp(self.FILE_NOT_FOUND_404, seq[1])
-
-				self.clientInfo['session'] = randint(100000, 999999)
-				self.replyRtsp(self.OK_200, seq[1])
-
-				# === FIX LỖI Ở ĐÂY ===
-				transportLine = request[2]
-				parts = transportLine.split(';')
-				for p in parts:
-					if "client_port" in p:
-						self.clientInfo['rtpPort'] = p.split('=')[1].strip()
-						break
+					self.replyRtsp(self.FILE_NOT_FOUND_404, seq)
+					return
 
+				# RTP to a client UDP port, or RTP and RTCP on this connection for
+				# clients UDP does not reach, or a channel's multicast group
+				transportLine = request.header('transport', '')
+				try:
+					rtpPort = self.parseClientPort(transportLine)
+					interleaved = self.parseInterleaved(transportLine)
+				except ValueError:
+					rtpPort = interleaved = None
+				multicast = bool(channel and channel.multicast and 'multicast' in transportLine)
+				# Channels and live streams are relayed over UDP only
+				if (interleaved is None and rtpPort is None and not multicast) or (interleaved is not None and (channel or live)):
+					print("SETUP refused: no usable transport in %r" % transportLine)
+					self.closeSession()
+					self.replyRtsp(self.UNSUPPORTED_TRANSPORT_461, seq)
+					return
+				if interleaved is not None:
+					self.clientInfo['interleaved'] = interleaved
+					self.clientInfo.pop('rtpPort', None)
+					if 'writer' not in self.clientInfo:
+						self.clientInfo['writer'] = self.makeWriter()
+				elif rtpPort is not None:
+					self.clientInfo['rtpPort'] = rtpPort
+				
+				# The client may cap its bandwidth; the rendition follows the feedback
+				self.clientInfo['bandwidth'] = self.parseBandwidth(request)
+				if 'videoStream' in self.clientInfo:
+					stream = self.clientInfo['videoStream']
+					quality = QualityController(stream.levels(), stream.levelRate, self.clientInfo['bandwidth'])
+					self.clientInfo['quality'] = quality
+					quality.level = stream.setLevel(quality.level)
+					# Parity packets for lossy links, if the client asks for them
+					self.clientInfo['fecLayout'] = self.parseFec(request)
+					# Lost packets are resent on RTCP NACKs if the client uses RTP/AVPF over UDP
+					self.clientInfo['avpf'] = 'RTP/AVPF' in transportLine and interleaved is None
+				
+				# Multicast viewers of a channel are told where to listen
+				if multicast:
+					self.clientInfo['multicast'] = True
+				
+				self.clientInfo['ssrc'] = randint(0, 0xFFFFFFFF)
+				rtcp = RtcpSession(self.clientInfo['ssrc'], RTP_CLOCK_RATE)
+				try:
+					session = self.sessions.open(self, self.reservedRate(), rtcp)
+				except AdmissionError as e:
+					print("SETUP refused: %s" % e)
+					self.closeSession()
+					self.replyRtsp(self.ADMISSION_STATUS[e.status], seq)
+					return
+				self.sessions.start(self.getScheduler())
+				self.clientInfo['sessionEntry'] = session
+				self.clientInfo['session'] = session.id
+				self.state = self.READY
+				
+				fps = self.clientInfo['videoStream'].fps if 'videoStream' in self.clientInfo else round(1 / self.FRAME_INTERVAL)
+				layout = self.clientInfo.get('fecLayout')
+				if layout:
+					# Parity packets carry an FEC header on top of the largest packet
+					self.clientInfo['packetizer'] = JpegPacketizer(self.MTU - FEC_HEADER_SIZE, self.clientInfo['ssrc'], fps)
+					self.clientInfo['fec'] = FecEncoder(self.clientInfo['ssrc'], *layout)
+				else:
+					self.clientInfo['packetizer'] = JpegPacketizer(self.MTU, self.clientInfo['ssrc'], fps)
+				if self.clientInfo.get('avpf') and self.RETRANSMIT_SHARE > 0:
+					rate = self.reservedRate()
+					self.clientInfo['history'] = SendHistory(self.MTU, historySlots(rate, self.MTU))
+					budget = max(rate / 8 * self.RETRANSMIT_SHARE, self.MTU)
+					self.clientInfo['retransmitBucket'] = TokenBucket(budget, max(budget / 10, 8 * self.MTU))
+				
+				# Receiver reports about this session's SSRC end up here
+				self.clientInfo['rtcp'] = rtcp
+				self.rtcpSessions[rtcp.ssrc] = rtcp
+				if 'quality' in self.clientInfo:
+					rtcp.onReport = self.adaptQuality
+				if 'history' in self.clientInfo:
+					rtcp.onNack = self.retransmit
+				
+				headers = None
+				if self.clientInfo.get('multicast'):
+					headers = ['Transport: RTP/AVP;multicast;destination=%s;port=%d' % channel.multicast]
+				elif interleaved is not None:
+					headers = ['Transport: RTP/AVP/TCP;unicast;interleaved=%d-%d' % interleaved]
+				elif 'rtpPort' in self.clientInfo:
+					# RTCP runs on the port after each side's RTP port
+					rtpPort = self.clientInfo['rtpPort']
+					serverPort = self.getSender().sock.getsockname()[1]
+					rtcp.address = (self.clientInfo['rtspSocket'][1][0], rtpPort + 1)
+					headers = ['Transport: %s;unicast;client_port=%d-%d;server_port=%d-%d' % (
+						'RTP/AVPF' if 'history' in self.clientInfo else 'RTP/AVP',
+						rtpPort, rtpPort + 1, serverPort, serverPort + 1)]
+				if headers is not None and layout:
+					headers.append('X-FEC: columns=%d;rows=%d;pt=%d' % (layout + (FEC_PT,)))
+				self.replyRtsp(self.OK_200, seq, headers)
+			else:
+				self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
 		
 		# Process PLAY request 		
 		elif requestType == self.PLAY:
-			if self.state == self.READY:
+			if self.state == self.READY and 'announced' not in self.clientInfo:
 				print("processing PLAY\n")
 				self.state = self.PLAYING
 				
-				# Create a new socket for RTP/UDP
-				self.clientInfo["rtpSocket"] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+				# Seek if the client asked for a start position
+				start = self.parseRange(request)
+				if start is not None and 'videoStream' in self.clientInfo:
+					self.clientInfo['videoStream'].seekTime(start)
 				
-				self.replyRtsp(self.OK_200, seq[1])
+				self.replyRtsp(self.OK_200, seq)
 				
-				# Create a new thread and start sending RTP packets
-				self.clientInfo['event'] = threading.Event()
-				self.clientInfo['worker']= threading.Thread(target=self.sendRtp) 
-				self.clientInfo['worker'].start()
+				if 'channel' in self.clientInfo or 'live' in self.clientInfo:
+					self.joinChannel()
+				else:
+					self.startRtp()
+			else:
+				self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
 		
 		# Process PAUSE request
 		elif requestType == self.PAUSE:
@@ -94,70 +334,576 @@ class ServerWorker:
 				print("processing PAUSE\n")
 				self.state = self.READY
 				
-				self.clientInfo['event'].set()
+				self.leaveChannel()
+				self.stopRtp()
 			
-				self.replyRtsp(self.OK_200, seq[1])
+				self.replyRtsp(self.OK_200, seq)
+			else:
+				self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
 		
 		# Process TEARDOWN request
 		elif requestType == self.TEARDOWN:
 			print("processing TEARDOWN\n")
 
-			self.clientInfo['event'].set()
+			# The reply still names the session it ends
+			sessionId = self.clientInfo.get('session')
+			self.closeSession()
 			
-			self.replyRtsp(self.OK_200, seq[1])
-			
-			# Close the RTP socket
-			self.clientInfo['rtpSocket'].close()
-			
-	def sendRtp(self):
-		"""Send RTP packets over UDP."""
-		while True:
-			self.clientInfo['event'].wait(0.05) 
-			
-			# Stop sending if request is PAUSE or TEARDOWN
-			if self.clientInfo['event'].isSet(): 
-				break 
-				
-			data = self.clientInfo['videoStream'].nextFrame()
-			if data: 
-				frameNumber = self.clientInfo['videoStream'].frameNbr()
-				try:
-					address = self.clientInfo['rtspSocket'][1][0]
-					port = int(self.clientInfo['rtpPort'])
-					self.clientInfo['rtpSocket'].sendto(self.makeRtp(data, frameNumber),(address,port))
-				except:
-					print("Connection Error")
-					#print('-'*60)
-					#traceback.print_exc(file=sys.stdout)
-					#print('-'*60)
-
-	def makeRtp(self, payload, frameNbr):
-		"""RTP-packetize the video data."""
-		version = 2
-		padding = 0
-		extension = 0
-		cc = 0
-		marker = 0
-		pt = 26 # MJPEG type
-		seqnum = frameNbr
-		ssrc = 0 
+			self.replyRtsp(self.OK_200, seq, ['Session: %s' % sessionId])
 		
-		rtpPacket = RtpPacket()
+		# Keep-alive: the session was renewed above
+		elif requestType == self.GET_PARAMETER:
+			self.replyRtsp(self.OK_200, seq)
 		
-		rtpPacket.encode(version, padding, extension, cc, seqnum, marker, pt, ssrc, payload)
+		elif requestType == self.OPTIONS:
+			methods = 'SETUP, PLAY, PAUSE, TEARDOWN, GET_PARAMETER, OPTIONS'
+			if self.LIVE_INGEST:
+				methods += ', ANNOUNCE, RECORD'
+			self.replyRtsp(self.OK_200, seq, ['Public: ' + methods])
 		
-		return rtpPacket.getPacket()
+		# Live ingest: a publisher announces a stream, sets it up and records
+		elif requestType == self.ANNOUNCE and self.LIVE_INGEST:
+			print("processing ANNOUNCE\n")
+			self.announce(request, seq)
 		
-	def replyRtsp(self, code, seq):
-		"""Send RTSP reply to the client."""
-		if code == self.OK_200:
-			#print("200 OK")
-			reply = 'RTSP/1.0 200 OK\nCSeq: ' + seq + '\nSession: ' + str(self.clientInfo['session'])
-			connSocket = self.clientInfo['rtspSocket'][0]
-			connSocket.send(reply.encode())
+		elif requestType == self.RECORD:
+			if self.state == self.READY and 'announced' in self.clientInfo:
+				print("processing RECORD\n")
+				self.state = self.RECORDING
+				self.replyRtsp(self.OK_200, seq)
+				self.startRecord()
+			else:
+				self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
 		
+		else:
+			self.replyRtsp(self.NOT_IMPLEMENTED_501, seq)
+	
+	def reservedRate(self):
+		"""Return the bits/s a new session is expected to take, for admission."""
+		if self.clientInfo.get('multicast'):
+			# Sent to the group once, whoever watches
+			return 0
+		if 'videoStream' in self.clientInfo:
+			rate = self.clientInfo['videoStream'].levelRate(self.clientInfo['quality'].level)
+		elif 'live' in self.clientInfo:
+			# As measured so far; nothing before the publisher's first frames
+			rate = self.clientInfo['live'].rate()
+		else:
+			rate = self.clientInfo['channel'].stream.levelRate(0)
+		if self.clientInfo.get('fecLayout'):
+			columns, rows = self.clientInfo['fecLayout']
+			rate *= 1 + 1 / columns + (1 / rows if rows > 1 else 0)
+		if self.SESSION_RATE:
+			rate = min(rate, self.SESSION_RATE * 8)
+		if self.clientInfo.get('bandwidth'):
+			rate = min(rate, self.clientInfo['bandwidth'])
+		return int(rate)
+	
+	def parseRange(self, request):
+		"""Return the start time (seconds) of a 'Range: npt=<start>-[<end>]' header, or None."""
+		value = request.header('range')
+		if value is None or not value.startswith('npt='):
+			return None
+		start = value[4:].split('-')[0].strip()
+		if not start or start == 'now':
+			return None
+		# npt is either plain seconds or hh:mm:ss[.fraction]
+		try:
+			seconds = 0.0
+			for part in start.split(':'):
+				seconds = seconds * 60 + float(part)
+		except ValueError:
+			return None
+		return seconds
+	
+	def parseFrameRate(self, request):
+		"""Return the frame rate asked for in an 'X-Frame-Rate: <fps>' header, or None."""
+		try:
+			fps = float(request.header('x-frame-rate'))
+		except (TypeError, ValueError):
+			return None
+		return fps if 0 < fps <= 240 else None
+	
+	def parseBandwidth(self, request):
+		"""Return the bits/s of a 'Bandwidth: <bps>' header, or None."""
+		try:
+			bandwidth = int(request.header('bandwidth'))
+		except (TypeError, ValueError):
+			return None
+		return bandwidth if bandwidth > 0 else None
+	
+	def resolveMovie(self, uri):
+		"""Return the real path of movie 'uri' under MEDIA_ROOT, or None if it lies outside."""
+		root = os.path.realpath(self.MEDIA_ROOT)
+		path = os.path.realpath(os.path.join(root, uri.lstrip('/')))
+		if os.path.commonpath((root, path)) != root:
+			return None
+		return path
+	
+	def parseClientPort(self, transportLine):
+		"""Return the RTP port of a 'client_port=<rtp>[-<rtcp>]' transport parameter, or None.
+		Raises ValueError if it is not a usable port."""
+		for param in transportLine.split(';'):
+			name, _, value = param.partition('=')
+			if name.strip().lower() == 'client_port':
+				# Either a single port or an RTP-RTCP port range
+				port = int(value.strip().split('-')[0])
+				if not 0 < port < 65535:
+					raise ValueError("bad client_port %r" % value)
+				return port
+		return None
+	
+	def parseInterleaved(self, transportLine):
+		"""Return the (RTP, RTCP) channels of an 'RTP/AVP/TCP;interleaved=<n>-<m>' transport, or None.
+		Without 'interleaved=' the server picks 0-1; raises ValueError for bad channels."""
+		if 'RTP/AVP/TCP' not in transportLine.upper():
+			return None
+		for param in transportLine.split(';'):
+			name, _, value = param.partition('=')
+			if name.strip().lower() == 'interleaved':
+				channels = [int(n) for n in value.split('-')]
+				rtp = channels[0]
+				rtcp = channels[1] if len(channels) > 1 else rtp + 1
+				if not (0 <= rtp <= 255 and 0 <= rtcp <= 255):
+					raise ValueError("bad interleaved channels %r" % value)
+				return rtp, rtcp
+		return 0, 1
+	
+	def parseFec(self, request):
+		"""Return the (columns, rows) of an 'X-FEC: columns=<C>;rows=<R>' header, or None."""
+		value = request.header('x-fec')
+		if value is None:
+			return None
+		layout = parseLayout(value)
+		if layout is None:
+			print("Ignoring bad X-FEC header %r" % value)
+		return layout
+	
+	def announce(self, request, seq):
+		"""Let this connection publish the stream an ANNOUNCE names, if its SDP offers JPEG video."""
+		if self.state != self.INIT or 'announced' in self.clientInfo:
+			self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
+			return
+		contentType = request.header('content-type', 'application/sdp').split(';')[0].strip().lower()
+		payloadTypes = parseSdp(request.body) if contentType == 'application/sdp' else None
+		if not payloadTypes or MJPEG_PT not in payloadTypes:
+			self.replyRtsp(self.UNSUPPORTED_MEDIA_TYPE_415, seq)
+			return
+		name = request.uri
+		if name in self.CHANNELS:
+			self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
+			return
+		sender = self.getSender()
+		bucket = self.getScheduler().globalBucket
+		with ServerWorker.liveLock:
+			stream = self.LIVE.get(name)
+			if stream is None:
+				recordPath = recordingPath(self.LIVE_RECORD_DIR, name) if self.LIVE_RECORD_DIR else None
+				stream = self.LIVE[name] = LiveStream(name, sender, recordPath, bucket=bucket)
+		if not stream.claim(self):
+			print("ANNOUNCE refused: %s is already being published" % name)
+			self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
+			return
+		self.clientInfo['announced'] = stream
+		self.replyRtsp(self.OK_200, seq)
+	
+	def setupRecord(self, request, seq):
+		"""Open the publisher's session and tell it where to send: a UDP port pair or interleaved channels."""
+		transportLine = request.header('transport', '')
+		try:
+			interleaved = self.parseInterleaved(transportLine)
+		except ValueError:
+			self.replyRtsp(self.UNSUPPORTED_TRANSPORT_461, seq)
+			return
+		try:
+			# Received, not sent: nothing to reserve
+			session = self.sessions.open(self)
+		except AdmissionError as e:
+			print("SETUP refused: %s" % e)
+			self.replyRtsp(self.ADMISSION_STATUS[e.status], seq)
+			return
+		self.sessions.start(self.getScheduler())
+		self.clientInfo['sessionEntry'] = session
+		self.clientInfo['session'] = session.id
+		if interleaved is not None:
+			self.clientInfo['interleaved'] = interleaved
+			header = 'Transport: RTP/AVP/TCP;unicast;interleaved=%d-%d;mode=record' % interleaved
+		else:
+			rtpSocket, rtcpSocket = bindPortPair()
+			self.clientInfo['liveSockets'] = (rtpSocket, rtcpSocket)
+			serverPort = rtpSocket.getsockname()[1]
+			clientPorts = ''
+			for param in transportLine.split(';'):
+				if 'client_port' in param:
+					clientPorts = 'client_port=%s;' % param.split('=')[1].strip()
+			header = 'Transport: RTP/AVP;unicast;%sserver_port=%d-%d;mode=record' % (clientPorts, serverPort, serverPort + 1)
+		self.state = self.READY
+		self.replyRtsp(self.OK_200, seq, [header])
+	
+	def startRecord(self):
+		"""Start relaying what the publisher sends; its session lives as long as frames come in."""
+		stream = self.clientInfo['announced']
+		session = self.clientInfo['sessionEntry']
+		stream.touch = lambda: self.sessions.touch(session)
+		sockets = self.clientInfo.get('liveSockets')
+		if sockets:
+			source = self.clientInfo['rtspSocket'][1][0]
+			threading.Thread(target=stream.receive, args=(sockets[0], source), daemon=True).start()
+	
+	def stopRecord(self):
+		"""Give up the announced stream; its viewers wait for the next publisher."""
+		stream = self.clientInfo.pop('announced', None)
+		if stream is not None:
+			stream.release(self)
+		# The receiving thread sees the socket closed within its timeout
+		for sock in self.clientInfo.pop('liveSockets', ()):
+			sock.close()
+	
+	def adaptQuality(self, rtcp):
+		"""Switch rendition on the receiver's feedback; applies from the next frame."""
+		quality = self.clientInfo.get('quality')
+		pacer = self.clientInfo.get('pacer')
+		stream = self.clientInfo.get('videoStream')
+		if quality is None or pacer is None or stream is None:
+			return
+		dropped = pacer.framesDropped - self.clientInfo.get('framesDropped', 0)
+		self.clientInfo['framesDropped'] = pacer.framesDropped
+		level = quality.report(rtcp.fractionLost, rtcp.octets, time.monotonic(), dropped)
+		used = stream.setLevel(level)
+		if used != level:
+			# Not built yet
+			quality.level = used
+	
+	def startRtp(self):
+		"""Start sending RTP packets to the client, paced by the shared scheduler."""
+		interleaved = self.clientInfo.get('interleaved')
+		if interleaved:
+			writer = self.clientInfo['writer']
+		else:
+			address = (self.clientInfo['rtspSocket'][1][0], self.clientInfo['rtpPort'])
+			sender = self.getSender()
+		rtcp = self.clientInfo['rtcp']
+		packetizer = self.clientInfo['packetizer']
+		history = self.clientInfo.get('history')
+		def send(packet):
+			if not interleaved:
+				sender.queue(packet, address)
+			elif not writer.sendPacket(interleaved[0], packet):
+				# Dropped: the client does not read fast enough
+				return
+			# Sender reports count the media packets only, and only those are resent
+			if packet[1] & 0x7F != FEC_PT:
+				rtcp.sent(len(packet) - packetizer.headerSize)
+				if history is not None:
+					history.store(packet)
+		scheduler = self.getScheduler()
+		rate = self.SESSION_RATE
+		if self.clientInfo.get('bandwidth'):
+			rate = min(rate or float('inf'), self.clientInfo['bandwidth'] // 8)
+		pacer = PacedStream(scheduler, self.nextPackets, send,
+			self.clientInfo['videoStream'].fps, rate, self.skipFrame)
+		self.clientInfo['pacer'] = pacer
+		pacer.start()
+		self.scheduleReport(time.monotonic())
+	
+	def stopRtp(self):
+		"""Stop sending RTP packets (PAUSE or TEARDOWN)."""
+		if 'pacer' in self.clientInfo:
+			self.clientInfo.pop('pacer').stop()
+		if 'reportTimer' in self.clientInfo:
+			self.getScheduler().cancel(self.clientInfo.pop('reportTimer'))
+	
+	def closeSession(self):
+		"""Stop everything the session does and release what it holds
+		(TEARDOWN, lost connection or timeout). Safe to call again."""
+		self.leaveChannel()
+		self.stopRtp()
+		self.stopRecord()
+		self.state = self.INIT
+		if 'rtcp' in self.clientInfo:
+			self.rtcpSessions.pop(self.clientInfo['rtcp'].ssrc, None)
+		if 'sessionEntry' in self.clientInfo:
+			self.sessions.close(self.clientInfo.pop('sessionEntry'))
+		# Later replies on the connection name no session
+		self.clientInfo.pop('session', None)
+		if 'videoStream' in self.clientInfo:
+			stream = self.clientInfo.pop('videoStream')
+			# Closed on the scheduler, after any frame of this session being sent
+			self.getScheduler().callAt(time.monotonic(), lambda now: stream.close())
+		for key in ('channel', 'live', 'multicast', 'quality', 'fec', 'fecLayout', 'avpf', 'history', 'retransmitBucket', 'interleaved'):
+			self.clientInfo.pop(key, None)
+	
+	def expire(self):
+		"""The client has not been heard from: drop the session and its connection."""
+		self.closeSession()
+		self.closeConnection()
+	
+	def closeConnection(self):
+		"""Close the RTSP connection; the receiving thread sees EOF and exits."""
+		try:
+			self.clientInfo['rtspSocket'][0].shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+	
+	def scheduleReport(self, now):
+		"""Schedule the next RTCP sender report, at a randomized interval."""
+		when = now + RTCP_INTERVAL * uniform(0.5, 1.5)
+		self.clientInfo['reportTimer'] = self.getScheduler().callAt(when, self.sendReport)
+	
+	def sendReport(self, now):
+		"""Send an RTCP sender report to the client."""
+		rtcp = self.clientInfo['rtcp']
+		if 'interleaved' in self.clientInfo:
+			self.clientInfo['writer'].sendControl(self.clientInfo['interleaved'][1], rtcp.senderReport())
+		elif rtcp.address:
+			try:
+				self.rtcpSocket.sendto(rtcp.senderReport(), rtcp.address)
+			except OSError:
+				pass
+		self.scheduleReport(now)
+	
+	@staticmethod
+	def handleRtcp(data, address):
+		"""Take in an RTCP packet from a client: receiver reports update their session."""
+		try:
+			packets = parseCompound(data)
+		except ValueError:
+			return
+		for packet in packets:
+			if packet.pt in (RR, SR):
+				for block in packet.blocks:
+					session = ServerWorker.rtcpSessions.get(block.ssrc)
+					if session:
+						session.receiverReport(block)
+			elif packet.pt == RTPFB and packet.count == FMT_NACK:
+				try:
+					ssrc, seqs = parseNack(packet)
+				except ValueError:
+					continue
+				session = ServerWorker.rtcpSessions.get(ssrc)
+				if session:
+					session.nack(seqs)
+	
+	def makeWriter(self):
+		"""Return the writer of interleaved packets for this connection."""
+		return InterleavedWriter(self.clientInfo['rtspSocket'][0], self.getScheduler())
+	
+	def closeWriter(self):
+		if 'writer' in self.clientInfo:
+			self.clientInfo.pop('writer').close()
+	
+	def receiveInterleaved(self, frame):
+		"""Take in binary data the client sent on the RTSP connection: its RTCP
+		packets, or a publisher's RTP packets."""
+		interleaved = self.clientInfo.get('interleaved')
+		if not interleaved:
+			return
+		if frame.channel == interleaved[1]:
+			self.handleRtcp(frame.data, None)
+		elif frame.channel == interleaved[0] and self.state == self.RECORDING and len(frame.data) >= HEADER_SIZE:
+			self.clientInfo['announced'].relay([frame.data])
+	
+	def retransmit(self, rtcp, seqs):
+		"""Resend the packets the client reported lost, within the session's retransmission budget."""
+		history = self.clientInfo.get('history')
+		bucket = self.clientInfo.get('retransmitBucket')
+		if history is None or bucket is None or self.state != self.PLAYING:
+			return
+		address = (self.clientInfo['rtspSocket'][1][0], self.clientInfo['rtpPort'])
+		sender = self.getSender()
+		now = time.monotonic()
+		holdoff = rtcp.rtt or self.RESEND_HOLDOFF
+		for seq in seqs:
+			packet = history.resend(seq, now, holdoff)
+			if packet is None:
+				continue
+			# Over budget the loss stands: resending must not add to congestion
+			if bucket.delay(len(packet), now) > 0:
+				break
+			bucket.consume(len(packet))
+			sender.sendto(packet, address)
+			rtcp.retransmitted += 1
+	
+	@staticmethod
+	def recvRtcp(sock):
+		"""Read RTCP packets from the clients (threaded server)."""
+		while True:
+			try:
+				data, address = sock.recvfrom(2048)
+			except OSError:
+				return
+			ServerWorker.handleRtcp(data, address)
+	
+	@classmethod
+	def sessionReport(cls):
+		"""Return one line per session with the receivers' latest feedback."""
+		lines = []
+		for rtcp in list(cls.rtcpSessions.values()):
+			if not rtcp.reports:
+				continue
+			s = rtcp.stats()
+			line = "Session %08x: %d packets sent, %.1f%% lost (%d total), jitter %.1f ms, RTT %s" % (
+				s['ssrc'], s['packets'], 100 * s['fractionLost'], s['cumulativeLost'], 1e3 * s['jitter'],
+				'%.1f ms' % (1e3 * s['rtt']) if s['rtt'] is not None else 'unknown')
+			if s['nacked']:
+				line += ", %d NACKed, %d resent" % (s['nacked'], s['retransmitted'])
+			lines.append(line)
+		return '\n'.join(lines)
+	
+	@classmethod
+	def collectMetrics(cls):
+		"""Return the server's counters and every session's, for Metrics (read when scraped)."""
+		sessions = cls.sessions
+		metrics = [
+			('rtp_sessions', 'gauge', "Sessions open", [({}, len(sessions.sessions))]),
+			('rtp_sessions_opened_total', 'counter', "Sessions admitted", [({}, sessions.opened)]),
+			('rtp_sessions_expired_total', 'counter', "Sessions expired without a request or report", [({}, sessions.expired)]),
+			('rtp_sessions_refused_total', 'counter', "SETUPs refused by admission control", [({}, sessions.refused)]),
+			('rtp_reserved_bits_per_second', 'gauge', "Bit rate reserved by the open sessions", [({}, sessions.reserved)]),
+		]
+		if cls.rtpSender:
+			metrics.append(('rtp_packets_sent_total', 'counter', "UDP datagrams sent", [({}, cls.rtpSender.sent)]))
+			metrics.append(('rtp_packets_dropped_total', 'counter', "UDP datagrams the kernel refused", [({}, cls.rtpSender.dropped)]))
+		if cls.FRAME_CACHE:
+			s = cls.FRAME_CACHE.stats()
+			metrics.append(('rtp_frame_cache_hits_total', 'counter', "Frame cache hits", [({}, s['hits'])]))
+			metrics.append(('rtp_frame_cache_misses_total', 'counter', "Frame cache misses", [({}, s['misses'])]))
+			metrics.append(('rtp_frame_cache_bytes', 'gauge', "Bytes of frames cached", [({}, s['bytes'])]))
+
+		# One sample per session of each per-session metric
+		perSession = [
+			('rtp_session_packets_sent_total', 'counter', "Media packets sent to the session", lambda r, p, w: r['packets']),
+			('rtp_session_octets_sent_total', 'counter', "Payload octets sent to the session", lambda r, p, w: r['octets']),
+			('rtp_session_fraction_lost', 'gauge', "Fraction lost in the last receiver report", lambda r, p, w: r['fractionLost']),
+			('rtp_session_jitter_seconds', 'gauge', "Interarrival jitter in the last receiver report", lambda r, p, w: r['jitter']),
+			('rtp_session_rtt_seconds', 'gauge', "Round-trip time from the receiver reports", lambda r, p, w: r['rtt']),
+			('rtp_session_nacked_total', 'counter', "Packets the receiver asked for again", lambda r, p, w: r['nacked']),
+			('rtp_session_retransmitted_total', 'counter', "Packets resent on NACKs", lambda r, p, w: r['retransmitted']),
+			('rtp_session_frames_sent_total', 'counter', "Frames sent", lambda r, p, w: p and p.framesSent),
+			('rtp_session_frames_skipped_total', 'counter', "Frames skipped because the link could not keep up",
+				lambda r, p, w: p and p.framesDropped),
+			('rtp_session_interleaved_dropped_total', 'counter', "Interleaved packets dropped for a slow reader",
+				lambda r, p, w: w and w.droppedPackets),
+		]
+		# One sample per live stream
+		liveStreams = [({'stream': stream.name}, stream.stats()) for stream in list(cls.LIVE.values())]
+		for name, kind, help, key in (
+			('rtp_live_viewers', 'gauge', "Viewers of the live stream", 'viewers'),
+			('rtp_live_packets_received_total', 'counter', "Packets received from the publisher", 'packets'),
+			('rtp_live_frames_total', 'counter', "Complete frames received from the publisher", 'frames'),
+			('rtp_live_frames_incomplete_total', 'counter', "Frames received with packets missing", 'framesIncomplete'),
+			('rtp_live_packets_relayed_total', 'counter', "Packets relayed to viewers", 'relayed'),
+		):
+			if liveStreams:
+				metrics.append((name, kind, help, [(labels, stats[key]) for labels, stats in liveStreams]))
+
+		rows = []
+		for session in list(sessions.sessions.values()):
+			info = session.owner.clientInfo
+			if 'rtcp' in info:
+				rows.append(({'session': session.id}, info['rtcp'].stats(), info.get('pacer'), info.get('writer')))
+		for name, kind, help, value in perSession:
+			samples = [(labels, value(r, p, w)) for labels, r, p, w in rows]
+			metrics.append((name, kind, help, [(labels, v) for labels, v in samples if v is not None]))
+		return metrics
+	
+	def joinChannel(self):
+		"""Start receiving the channel's broadcast, or the live stream, from the current frame."""
+		if self.clientInfo.get('multicast'):
+			# The channel sends to the group once for all multicast viewers
+			return
+		address = (self.clientInfo['rtspSocket'][1][0], self.clientInfo['rtpPort'])
+		source = self.clientInfo.get('channel') or self.clientInfo['live']
+		source.subscribe(self, address, self.clientInfo['ssrc'])
+	
+	def leaveChannel(self):
+		"""Stop receiving the channel's broadcast or the live stream."""
+		source = self.clientInfo.get('channel') or self.clientInfo.get('live')
+		if source is not None:
+			source.unsubscribe(self)
+	
+	@classmethod
+	def getSender(cls):
+		"""Return the UDP sender shared by all sessions, creating it on first use."""
+		with ServerWorker.senderLock:
+			if ServerWorker.rtpSender is None:
+				rtpSocket, ServerWorker.rtcpSocket = bindPortPair(cls.RTP_PORT)
+				ServerWorker.rtpSender = UdpBatchSender(rtpSocket, mode=cls.SEND_MODE)
+				threading.Thread(target=cls.recvRtcp, args=(ServerWorker.rtcpSocket,), daemon=True).start()
+		return ServerWorker.rtpSender
+	
+	@classmethod
+	def getScheduler(cls):
+		"""Return the scheduler shared by all sessions, starting it on first use."""
+		sender = cls.getSender()
+		with ServerWorker.senderLock:
+			if ServerWorker.scheduler is None:
+				ServerWorker.scheduler = PacingScheduler(cls.GLOBAL_RATE, sender.flush)
+				ServerWorker.scheduler.start()
+		return ServerWorker.scheduler
+	
+	def nextPackets(self):
+		"""Read and packetize the next frame; None at the end of the movie."""
+		stream = self.clientInfo.get('videoStream')
+		if stream is None:
+			# Closed meanwhile
+			return None
+		if Metrics.enabled:
+			start = time.perf_counter()
+			data = stream.nextFrame()
+			FRAME_READ_SECONDS.since(start)
+		else:
+			data = stream.nextFrame()
+		if not data:
+			return None
+		frameNumber = stream.frameNbr()
+		self.clientInfo['rtcp'].frameSent(self.clientInfo['packetizer'].timestamp(frameNumber))
+		if Metrics.enabled:
+			start = time.perf_counter()
+			packets = self.makeRtp(data, frameNumber)
+			PACKETIZE_SECONDS.since(start)
+			return packets
+		return self.makeRtp(data, frameNumber)
+
+	def skipFrame(self):
+		"""Skip the next frame without sending it (the link cannot keep up)."""
+		stream = self.clientInfo.get('videoStream')
+		if stream is not None:
+			stream.seek(stream.frameNbr() + 1)
+
+	def makeRtp(self, payload, frameNbr):
+		"""RTP-packetize the video data into MTU-sized packets, plus parity packets if negotiated."""
+		if self.SEND_TIMESTAMPS:
+			packets = self.clientInfo['packetizer'].packetize(payload, frameNbr, SEND_TIME_EXT, SEND_TIME.pack(time.time_ns() // 1000))
+		else:
+			packets = self.clientInfo['packetizer'].packetize(payload, frameNbr)
+		fec = self.clientInfo.get('fec')
+		return fec.protect(packets) if fec is not None else packets
+		
+	def replyRtsp(self, code, seq, headers=None):
+		"""Send RTSP reply to the client."""
 		# Error messages
-		elif code == self.FILE_NOT_FOUND_404:
+		if code == self.FILE_NOT_FOUND_404:
 			print("404 NOT FOUND")
 		elif code == self.CON_ERR_500:
 			print("500 CONNECTION ERROR")
+		
+		fields = []
+		if 'session' in self.clientInfo:
+			session = str(self.clientInfo['session'])
+			if self.sessions.timeout:
+				session += ';timeout=%d' % self.sessions.timeout
+			fields.append(('Session', session))
+		for header in headers or ():
+			name, _, value = header.partition(':')
+			fields.append((name, value.strip()))
+		self.sendRtspReply(response(self.STATUS[code], seq, fields).decode())
+	
+	def sendRtspReply(self, reply):
+		"""Write an RTSP reply on the client's RTSP connection."""
+		if 'writer' in self.clientInfo:
+			# In order with the interleaved packets
+			self.clientInfo['writer'].sendReply(reply.encode())
+			return
+		connSocket = self.clientInfo['rtspSocket'][0]
+		connSocket.send(reply.encode())
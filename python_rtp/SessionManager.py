@@ -0,0 +1,121 @@
+import threading, time
+from random import randint
+
+# Seconds a session lives without hearing from its client (RTSP default)
+DEFAULT_TIMEOUT = 60
+
+# Seconds between two sweeps for expired sessions
+SWEEP_INTERVAL = 5
+
+class AdmissionError(Exception):
+	"""A new session was refused; 'status' is the RTSP status to answer."""
+
+	def __init__(self, status, message):
+		Exception.__init__(self, message)
+		self.status = status
+
+class Session:
+	"""Entry of the session table: the worker owning the session, the bit
+	rate reserved for it and when its client was last heard from."""
+	__slots__ = ('id', 'owner', 'rate', 'lastActivity', 'rtcp')
+
+	def __init__(self, sessionId, owner, rate, rtcp=None):
+		self.id = sessionId
+		self.owner = owner
+		self.rate = rate
+		self.lastActivity = time.monotonic()
+		self.rtcp = rtcp
+
+	def idle(self, now):
+		"""Return the seconds since the last request or receiver report."""
+		last = self.lastActivity
+		if self.rtcp is not None and self.rtcp.lastHeard is not None:
+			last = max(last, self.rtcp.lastHeard)
+		return now - last
+
+class SessionManager:
+	"""Table of the server's RTSP sessions by session ID.
+
+	New sessions are admitted within a maximum count (503 otherwise) and
+	a total reserved bit rate (453). A session is renewed by every request
+	and every receiver report; one not heard from within 'timeout' seconds
+	is expired by a periodic sweep, which calls its owner's expire() to
+	release everything it holds."""
+
+	def __init__(self, maxSessions=0, maxRate=0, timeout=DEFAULT_TIMEOUT):
+		self.maxSessions = maxSessions
+		# Bits/s all sessions may reserve together (0: no limit)
+		self.maxRate = maxRate
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.sessions = {}
+		self.reserved = 0
+		self.opened = 0
+		self.expired = 0
+		self.refused = 0
+		self.scheduler = None
+
+	def open(self, owner, rate=0, rtcp=None):
+		"""Admit a session reserving 'rate' bits/s. Return its Session; raises AdmissionError."""
+		with self.lock:
+			if self.maxSessions and len(self.sessions) >= self.maxSessions:
+				self.refused += 1
+				raise AdmissionError(503, "%d sessions already" % len(self.sessions))
+			if self.maxRate and self.reserved + rate > self.maxRate:
+				self.refused += 1
+				raise AdmissionError(453, "%d of %d bit/s reserved" % (self.reserved, self.maxRate))
+			sessionId = randint(100000, 999999)
+			while sessionId in self.sessions:
+				sessionId = randint(100000, 999999)
+			session = Session(sessionId, owner, rate, rtcp)
+			self.sessions[sessionId] = session
+			self.reserved += rate
+			self.opened += 1
+			return session
+
+	def get(self, sessionId):
+		return self.sessions.get(sessionId)
+
+	def touch(self, session):
+		"""Renew a session: its client just sent a request."""
+		session.lastActivity = time.monotonic()
+
+	def close(self, session):
+		"""Remove a session from the table; closing twice is harmless."""
+		with self.lock:
+			if self.sessions.pop(session.id, None) is session:
+				self.reserved -= session.rate
+
+	def start(self, scheduler):
+		"""Sweep for expired sessions on 'scheduler' from now on."""
+		with self.lock:
+			if self.scheduler is not None:
+				return
+			self.scheduler = scheduler
+		scheduler.callAt(time.monotonic() + SWEEP_INTERVAL, self.onSweep)
+
+	def onSweep(self, now):
+		self.sweep(now)
+		self.scheduler.callAt(now + SWEEP_INTERVAL, self.onSweep)
+
+	def sweep(self, now=None):
+		"""Expire the sessions idle for longer than the timeout. Return how many."""
+		if not self.timeout:
+			return 0
+		if now is None:
+			now = time.monotonic()
+		with self.lock:
+			expired = [s for s in self.sessions.values() if s.idle(now) > self.timeout]
+		for session in expired:
+			print("Session %d expired after %.0f s without a request or report" % (session.id, session.idle(now)))
+			self.expired += 1
+			try:
+				session.owner.expire()
+			finally:
+				self.close(session)
+		return len(expired)
+
+	def report(self):
+		"""Return a one-line summary of the session table."""
+		return "Sessions: %d active, %.0f kbit/s reserved, %d opened, %d expired, %d refused" % (
+			len(self.sessions), self.reserved / 1000, self.opened, self.expired, self.refused)
@@ -0,0 +1,683 @@
+import argparse, random, socket, threading, time, traceback
+
+from RtpPacket import RtpPacket
+from JitterBuffer import JitterBuffer
+from FrameSinks import AsyncQueueSink, CountingSink, MjpegFileSink
+from RtspMessage import RtspParser, RtspMessage, RtspError, InterleavedFrame, interleave, parseMessage
+from Fec import FecDecoder, parseLayout
+from RtpCapture import CaptureWriter, RTP, RTCP
+import Metrics
+from Rtcp import ReceptionReporter, RTCP_INTERVAL, SR, parseCompound, receiverReport, sourceDescription, bye, cname, genericNack
+
+# Large enough for any datagram, whatever MTU the server uses
+RTP_BUFFER_SIZE = 65536
+RTP_SOCKET_RCVBUF = 1 << 20
+
+RECEIVE_SECONDS = Metrics.histogram('rtp_receive_seconds', "Time to take in one received RTP packet, reassembly and FEC included")
+
+class StreamClient:
+    """RTSP/RTP streaming client without a user interface.
+
+    Runs the RTSP state machine and the RTP receive loop, rebuilds frames
+    in a JitterBuffer and hands every frame, when it is due, to the frame
+    sinks (see FrameSinks). Requests are sent without waiting for the
+    reply, as a GUI wants; pass 'wait' (seconds) to block until the
+    server has answered. frames() yields the frames as an async iterator.
+
+    With startCapture(), every RTP/RTCP datagram received is also logged
+    with its arrival time, for Replay.py.
+
+    Nothing here imports Tk or PIL; Client is the GUI on top of it."""
+
+    INIT = 0
+    READY = 1
+    PLAYING = 2
+
+    SETUP = 0
+    PLAY = 1
+    PAUSE = 2
+    TEARDOWN = 3
+    GET_PARAMETER = 4
+
+    def __init__(self, serverAddr, serverPort, rtpPort, fileName, sinks=(), playoutDelay=0.1, multicast=False, bandwidth=None, fec=None, nack=False, interleaved=False):
+        self.serverAddr = serverAddr
+        self.serverPort = int(serverPort)
+        self.rtpPort = int(rtpPort)
+        self.fileName = fileName
+        self.multicast = multicast
+        self.multicastGroup = None
+        # Bits/s the server should stay within (None: no cap)
+        self.bandwidth = bandwidth
+        # (columns, rows) of the parity packets to ask for (None: no FEC),
+        # and what repairs lost packets once the server agreed
+        self.fec = fec
+        self.fecDecoder = None
+        # Ask for lost packets again with RTCP NACKs (RTP/AVPF), if the server agrees
+        self.nack = nack
+        self.nackEnabled = False
+        # Receive RTP and RTCP on the RTSP connection ('$' frames) instead
+        # of UDP; the (RTP, RTCP) channels once the server agreed
+        self.interleaved = interleaved
+        self.channels = None
+        self.sinks = list(sinks)
+        self.state = self.INIT
+        self.rtspSeq = 0
+        self.sessionId = 0
+        self.requestSent = -1
+        # Requests waiting for their reply, by CSeq: (request, time sent)
+        self.pending = {}
+        self.sendLock = threading.Lock()
+        # Seconds the server keeps the session without hearing from us
+        self.sessionTimeout = None
+        self.teardownAcked = 0
+        self.frameNbr = 0
+        self.rtspSocket = None
+        self.rtpSocket = None
+        # RTCP on the port after the RTP port of either side
+        self.rtcpSocket = None
+        self.serverRtcpPort = None
+        self.ssrc = random.getrandbits(32)
+        self.senderSsrc = None
+        self.reporter = ReceptionReporter()
+        self.jitterBuffer = JitterBuffer(targetDelay=playoutDelay)
+        # Sequence number of the last reply, for requests that wait
+        self.replied = threading.Condition()
+        self.replySeq = 0
+        # Called with (title, message) when something fails in the background
+        self.onError = None
+        # Logs the datagrams received (see startCapture)
+        self.capture = None
+
+    def addSink(self, sink):
+        self.sinks.append(sink)
+
+    def removeSink(self, sink):
+        if sink in self.sinks:
+            self.sinks.remove(sink)
+
+    def startCapture(self, path):
+        """Log every RTP/RTCP datagram received from now on to a capture file (see RtpCapture)."""
+        self.capture = CaptureWriter(path)
+
+    def sessionInfo(self):
+        """Return what a replay of the session needs to rebuild its receive path."""
+        return {
+            'file': self.fileName,
+            'fecPt': self.fecDecoder.pt if self.fecDecoder is not None else None,
+            'playoutDelay': self.jitterBuffer.targetDelay,
+        }
+
+    def closeSinks(self):
+        sinks, self.sinks = self.sinks, []
+        for sink in sinks:
+            sink.close()
+
+    def error(self, title, message):
+        if self.onError:
+            self.onError(title, message)
+        else:
+            print("%s: %s" % (title, message))
+
+    def connect(self):
+        """Connect to the Server. Start a new RTSP/TCP session. Raises OSError."""
+        self.rtspSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.rtspSocket.connect((self.serverAddr, self.serverPort))
+
+    def setup(self, wait=None):
+        """Send SETUP."""
+        if self.state == self.INIT:
+            return self.sendRtspRequest(self.SETUP, wait)
+        return False
+
+    def play(self, wait=None):
+        """Send PLAY and start receiving."""
+        if self.state == self.READY:
+            self.playEvent = threading.Event()
+            # Timing restarts after a pause
+            self.jitterBuffer.reset()
+            # Create a new thread to listen for RTP packets (interleaved
+            # packets come in with the RTSP replies)
+            if self.channels is None:
+                threading.Thread(target=self.listenRtp, daemon=True).start()
+            # and one to release frames on the playout clock
+            threading.Thread(target=self.playoutFrames, daemon=True).start()
+            return self.sendRtspRequest(self.PLAY, wait)
+        return False
+
+    def pause(self, wait=None):
+        """Send PAUSE."""
+        if self.state == self.PLAYING:
+            return self.sendRtspRequest(self.PAUSE, wait)
+        return False
+
+    def teardown(self, wait=None):
+        """Send TEARDOWN."""
+        return self.sendRtspRequest(self.TEARDOWN, wait)
+
+    def close(self):
+        """Tear the session down if needed and close the sinks."""
+        if self.state != self.INIT and self.requestSent != self.TEARDOWN:
+            try:
+                self.teardown(wait=2)
+            except OSError:
+                pass
+        self.closeSinks()
+        if self.capture is not None:
+            self.capture.close()
+
+    async def frames(self, maxQueued=8):
+        """Yield (timestamp, frame) as frames become due, until the session ends."""
+        import asyncio
+        sink = AsyncQueueSink(asyncio.get_running_loop(), maxQueued)
+        self.addSink(sink)
+        try:
+            while True:
+                item = await sink.queue.get()
+                if item is None:
+                    return
+                yield item
+        finally:
+            self.removeSink(sink)
+
+    def listenRtp(self):
+        """Listen for RTP packets."""
+        # One receive buffer and one packet object for the whole stream
+        buf = bytearray(RTP_BUFFER_SIZE)
+        rtpPacket = RtpPacket()
+        repaired = RtpPacket()
+        while True:
+            try:
+                nbytes = self.rtpSocket.recv_into(buf)
+                if nbytes:
+                    self.receiveRtp(rtpPacket, repaired, buf, nbytes)
+            except Exception:
+                # Stop listening upon requesting PAUSE or TEARDOWN
+                if hasattr(self, 'playEvent') and self.playEvent.is_set():
+                    break
+
+                # Upon receiving ACK for TEARDOWN request,
+                # close the RTP socket
+                if self.teardownAcked == 1:
+                    try:
+                        self.rtpSocket.shutdown(socket.SHUT_RDWR)
+                    except Exception:
+                        pass
+                    try:
+                        self.rtpSocket.close()
+                    except Exception:
+                        pass
+                    break
+
+    def receiveRtp(self, rtpPacket, repaired, buf, nbytes, arrival=None):
+        """Take in a received RTP packet, decoded with 'rtpPacket' (and 'repaired' for FEC)."""
+        if Metrics.enabled:
+            start = time.perf_counter()
+        if arrival is None:
+            arrival = time.monotonic()
+        if self.capture is not None:
+            self.capture.write(RTP, memoryview(buf)[:nbytes], arrival)
+        rtpPacket.decode(buf, nbytes)
+        self.senderSsrc = rtpPacket.ssrc()
+        decoder = self.fecDecoder
+
+        if decoder is not None and rtpPacket.payloadType() == decoder.pt:
+            # Parity packets only ever feed the decoder
+            recovered = decoder.parity(memoryview(buf)[:nbytes])
+        else:
+            self.jitterBuffer.insert(rtpPacket, arrival)
+            recovered = decoder.media(rtpPacket.seqNum(), memoryview(buf)[:nbytes]) if decoder is not None else ()
+
+        # Repaired packets go in as if received, before reassembly
+        for packet in recovered:
+            repaired.decode(packet)
+            self.jitterBuffer.insert(repaired, arrival)
+
+        if self.nackEnabled and self.jitterBuffer.missing:
+            self.sendNack()
+        if Metrics.enabled:
+            RECEIVE_SECONDS.since(start)
+
+    def receiveInterleaved(self, frame, rtpPacket, repaired):
+        """Take in an RTP or RTCP packet received on the RTSP connection."""
+        try:
+            if frame.channel == self.channels[0]:
+                self.receiveRtp(rtpPacket, repaired, frame.data, len(frame.data))
+            elif frame.channel == self.channels[1]:
+                self.receiveRtcp(frame.data)
+        except ValueError:
+            # A malformed packet; the replies after it still count
+            pass
+
+    def playoutFrames(self):
+        """Hand frames to the sinks when the jitter buffer says they are due."""
+        while not self.playEvent.is_set() and self.teardownAcked == 0:
+            frame = self.jitterBuffer.get(timeout=0.5)
+            if frame:
+                self.deliverFrame(frame[0], frame[1])
+
+    def deliverFrame(self, timestamp, data):
+        """Hand a due frame to the sinks."""
+        self.frameNbr += 1
+        for sink in list(self.sinks):
+            sink.frame(timestamp, data)
+
+    def sendRtspRequest(self, requestCode, wait=None):
+        """Send RTSP request to the server. Raises OSError if sending fails.
+
+        Return False if the request does not apply in the current state;
+        with 'wait', return whether the reply came within 'wait' seconds."""
+        # The keep-alive thread sends requests too
+        with self.sendLock:
+            request = self.composeRequest(requestCode)
+            if request is None:
+                return False
+            seq = self.rtspSeq
+            self.pending[seq] = (requestCode, time.monotonic())
+
+            # Send the RTSP request using rtspSocket.
+            self.rtspSocket.send(request.encode())
+            print('\nData sent:\n' + request)
+
+        if wait is None:
+            return True
+        with self.replied:
+            return self.replied.wait_for(lambda: self.replySeq >= seq, wait)
+
+    def composeRequest(self, requestCode):
+        """Return the text of a request, or None if it does not apply in the current state."""
+        request = None
+
+        # Setup request
+        if requestCode == self.SETUP and self.state == self.INIT:
+            # Start thread to receive RTSP replies
+            threading.Thread(target=self.recvRtspReply, daemon=True).start()
+
+            # Update RTSP sequence number.
+            self.rtspSeq += 1
+
+            # Write the RTSP request to be sent.
+            if self.multicast:
+                transport = "RTP/AVP;multicast"
+            elif self.interleaved:
+                transport = "RTP/AVP/TCP;unicast;interleaved=0-1"
+            elif self.nack:
+                transport = "RTP/AVPF;unicast"
+            else:
+                transport = "RTP/UDP"
+            request = f"SETUP {self.fileName} RTSP/1.0\r\nCSeq: {self.rtspSeq}\r\nTransport: {transport}; client_port={self.rtpPort}\r\n"
+            if self.bandwidth:
+                request += f"Bandwidth: {self.bandwidth}\r\n"
+            if self.fec:
+                request += "X-FEC: columns=%d;rows=%d\r\n" % self.fec
+            request += "\r\n"
+
+            # Keep track of the sent request.
+            self.requestSent = self.SETUP
+
+        # Play request
+        elif requestCode == self.PLAY and self.state == self.READY:
+            self.rtspSeq += 1
+            request = f"PLAY {self.fileName} RTSP/1.0\r\nCSeq: {self.rtspSeq}\r\nSession: {self.sessionId}\r\n\r\n"
+            self.requestSent = self.PLAY
+
+        # Pause request
+        elif requestCode == self.PAUSE and self.state == self.PLAYING:
+            self.rtspSeq += 1
+            request = f"PAUSE {self.fileName} RTSP/1.0\r\nCSeq: {self.rtspSeq}\r\nSession: {self.sessionId}\r\n\r\n"
+            self.requestSent = self.PAUSE
+
+        # Teardown request
+        elif requestCode == self.TEARDOWN and not self.state == self.INIT:
+            self.rtspSeq += 1
+            request = f"TEARDOWN {self.fileName} RTSP/1.0\r\nCSeq: {self.rtspSeq}\r\nSession: {self.sessionId}\r\n\r\n"
+            self.requestSent = self.TEARDOWN
+
+        # Keep-alive: does not change the state, so requestSent is left alone
+        elif requestCode == self.GET_PARAMETER and not self.state == self.INIT:
+            self.rtspSeq += 1
+            request = f"GET_PARAMETER {self.fileName} RTSP/1.0\r\nCSeq: {self.rtspSeq}\r\nSession: {self.sessionId}\r\n\r\n"
+
+        return request
+
+    def recvRtspReply(self):
+        """Receive RTSP reply from the server."""
+        parser = RtspParser()
+        # Interleaved RTP packets come in here too
+        rtpPacket = RtpPacket()
+        repaired = RtpPacket()
+        while True:
+            try:
+                reply = self.rtspSocket.recv(RTP_BUFFER_SIZE)
+            except Exception:
+                break
+
+            if reply:
+                try:
+                    for message in parser.feed(reply):
+                        if isinstance(message, InterleavedFrame):
+                            if self.channels is not None:
+                                self.receiveInterleaved(message, rtpPacket, repaired)
+                            continue
+                        # Debug: show the RTSP reply
+                        print("\nRTSP Reply received:\n" + str(message))
+                        self.parseRtspReply(message)
+                except RtspError as e:
+                    print("Bad RTSP reply: %s" % e)
+                    reply = b''
+                except Exception:
+                    traceback.print_exc()
+
+            # Close the RTSP socket upon requesting Teardown
+            if self.requestSent == self.TEARDOWN or not reply:
+                try:
+                    self.rtspSocket.shutdown(socket.SHUT_RDWR)
+                except Exception:
+                    pass
+                try:
+                    self.rtspSocket.close()
+                except Exception:
+                    pass
+                break
+
+    def parseRtspReply(self, reply):
+        """Parse the RTSP reply (an RtspMessage or its text) from the server."""
+        if not isinstance(reply, RtspMessage):
+            try:
+                reply = parseMessage(reply)
+            except RtspError:
+                return
+        seqNum = reply.cseq()
+        if seqNum is None or reply.isRequest():
+            return
+
+        # Process only replies to a request sent and not answered yet
+        entry = self.pending.pop(seqNum, None)
+        if entry is not None:
+            requestCode, sentAt = entry
+            try:
+                session = int(reply.session())
+            except (TypeError, ValueError):
+                session = 0
+
+            # New RTSP session ID
+            if self.sessionId == 0:
+                self.sessionId = session
+
+            # Process only if the session ID is the same
+            if self.sessionId == session:
+                if reply.status == 200:
+                    if requestCode == self.SETUP:
+                        # Update RTSP state.
+                        self.state = self.READY
+                        self.sessionTimeout = reply.sessionTimeout()
+
+                        # A channel may answer with a multicast group to join
+                        self.parseTransport(reply.header('transport', ''))
+
+                        # The server sends parity packets only if it says so
+                        self.parseFec(reply.header('x-fec'))
+                        if self.capture is not None:
+                            self.capture.writeSession(self.sessionInfo())
+
+                        # Retransmissions too; the SETUP round trip is a first RTT estimate
+                        if self.nack and 'RTP/AVPF' in reply.header('transport', ''):
+                            self.nackEnabled = True
+                            self.jitterBuffer.enableNack(time.monotonic() - sentAt)
+
+                        # Open RTP port, unless RTP comes on this connection
+                        if self.channels is None:
+                            self.openRtpPort()
+                        else:
+                            threading.Thread(target=self.reportInterleaved, daemon=True).start()
+
+                        # Without RTCP reports nothing renews the session
+                        if self.rtcpSocket is None and self.channels is None and self.sessionTimeout:
+                            threading.Thread(target=self.keepAlive, daemon=True).start()
+                    elif requestCode == self.PLAY:
+                        self.state = self.PLAYING
+                    elif requestCode == self.PAUSE:
+                        self.state = self.READY
+
+                        # The play thread exits. A new thread is created on resume.
+                        if hasattr(self, 'playEvent'):
+                            self.playEvent.set()
+                    elif requestCode == self.TEARDOWN:
+                        self.state = self.INIT
+
+                        # Flag the teardownAcked to close the socket.
+                        self.teardownAcked = 1
+                        self.closeSinks()
+                else:
+                    self.error('Request Failed', '%d %s' % (reply.status, reply.reason))
+
+            with self.replied:
+                self.replySeq = seqNum
+                self.replied.notify_all()
+
+    def parseTransport(self, transport):
+        """Pick up 'destination=' and 'port=' from the SETUP reply's Transport header."""
+        params = dict(p.strip().split('=', 1) for p in transport.split(';') if '=' in p)
+        if 'destination' in params and 'port' in params:
+            self.multicastGroup = params['destination'].strip()
+            self.rtpPort = int(params['port'])
+        if 'server_port' in params:
+            ports = params['server_port'].split('-')
+            self.serverRtcpPort = int(ports[1]) if len(ports) > 1 else int(ports[0]) + 1
+        if 'interleaved' in params and 'RTP/AVP/TCP' in transport:
+            channels = [int(n) for n in params['interleaved'].split('-')]
+            self.channels = (channels[0], channels[1] if len(channels) > 1 else channels[0] + 1)
+
+    def parseFec(self, value):
+        """Set up FEC from the SETUP reply's 'X-FEC: columns=<C>;rows=<R>;pt=<PT>' header."""
+        if not value or parseLayout(value) is None:
+            return
+        params = dict(p.strip().split('=', 1) for p in value.split(';') if '=' in p)
+        try:
+            self.fecDecoder = FecDecoder(int(params['pt']))
+        except (KeyError, ValueError):
+            pass
+
+    def openRtpPort(self):
+        """Open RTP socket binded to a specified port."""
+        # Create a new datagram socket to receive RTP packets from the server
+        self.rtpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        # Set the timeout value of the socket to 0.5sec
+        self.rtpSocket.settimeout(0.5)
+
+        # A frame now arrives as a burst of packets; give the kernel room to queue them
+        try:
+            self.rtpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RTP_SOCKET_RCVBUF)
+        except Exception:
+            pass
+
+        try:
+            # Bind the socket to the address using the RTP port given by the client user
+            self.rtpSocket.bind(('', self.rtpPort))
+        except Exception:
+            self.error('Unable to Bind', 'Unable to bind PORT=%d' % self.rtpPort)
+
+        if self.multicastGroup:
+            membership = socket.inet_aton(self.multicastGroup) + socket.inet_aton('0.0.0.0')
+            self.rtpSocket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+        self.openRtcpPort()
+
+    def openRtcpPort(self):
+        """Open the RTCP socket on the port after the RTP port and start reporting."""
+        if self.serverRtcpPort is None:
+            # The server does not do RTCP (or this is a multicast channel)
+            return
+        self.rtcpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.rtcpSocket.bind(('', self.rtpPort + 1))
+        except OSError:
+            self.rtcpSocket.close()
+            self.rtcpSocket = None
+            print("RTCP disabled: unable to bind PORT=%d" % (self.rtpPort + 1))
+            return
+        threading.Thread(target=self.runRtcp, daemon=True).start()
+
+    def runRtcp(self):
+        """Take in sender reports and send receiver reports until TEARDOWN."""
+        sock = self.rtcpSocket
+        nextReport = time.monotonic() + RTCP_INTERVAL * random.uniform(0.5, 1.5)
+        while self.teardownAcked == 0:
+            sock.settimeout(max(0.01, nextReport - time.monotonic()))
+            try:
+                self.receiveRtcp(sock.recv(2048))
+            except (OSError, ValueError):
+                pass
+            now = time.monotonic()
+            if now >= nextReport:
+                self.sendReport()
+                nextReport = now + RTCP_INTERVAL * random.uniform(0.5, 1.5)
+        self.sendReport(leaving=True)
+        sock.close()
+
+    def reportInterleaved(self):
+        """Send receiver reports on the RTSP connection until TEARDOWN."""
+        while True:
+            time.sleep(RTCP_INTERVAL * random.uniform(0.5, 1.5))
+            if self.teardownAcked or self.state == self.INIT:
+                break
+            self.sendReport()
+
+    def receiveRtcp(self, data):
+        """Take in an RTCP packet from the server. Raises ValueError if malformed."""
+        if self.capture is not None:
+            self.capture.write(RTCP, data)
+        for packet in parseCompound(data):
+            if packet.pt == SR:
+                self.senderSsrc = packet.ssrc
+                self.reporter.senderReport(packet)
+
+    def sendNack(self):
+        """Ask the server again for the missing packets that can still make their frame."""
+        seqs = self.jitterBuffer.nackList()
+        if not seqs or self.rtcpSocket is None or self.senderSsrc is None:
+            return
+        # A NACK on its own (RFC 5506), not waiting for the next report
+        try:
+            self.rtcpSocket.sendto(genericNack(self.ssrc, self.senderSsrc, seqs), (self.serverAddr, self.serverRtcpPort))
+        except OSError:
+            pass
+
+    def keepAlive(self):
+        """Renew the session with GET_PARAMETER requests until TEARDOWN."""
+        while True:
+            time.sleep(self.sessionTimeout / 2)
+            if self.teardownAcked or self.state == self.INIT:
+                break
+            try:
+                self.sendRtspRequest(self.GET_PARAMETER)
+            except OSError:
+                break
+
+    def receptionBlocks(self):
+        """Return the report blocks about the stream received so far."""
+        jb = self.jitterBuffer
+        if self.senderSsrc is None or jb.maxSeq is None:
+            return []
+        return [self.reporter.block(self.senderSsrc, jb.baseSeq, jb.maxSeq, jb.received, jb.jitter)]
+
+    def sendReport(self, leaving=False):
+        """Send a compound RR + SDES (+ BYE) packet to the server."""
+        report = receiverReport(self.ssrc, self.receptionBlocks()) + sourceDescription(self.ssrc, cname())
+        if leaving:
+            report += bye(self.ssrc)
+        try:
+            if self.channels is not None:
+                with self.sendLock:
+                    self.rtspSocket.sendall(interleave(self.channels[1], report) + report)
+            else:
+                self.rtcpSocket.sendto(report, (self.serverAddr, self.serverRtcpPort))
+        except OSError:
+            pass
+
+    def collectMetrics(self):
+        """Return the reception counters of the session, for Metrics (read when scraped)."""
+        stats = self.stats()
+        labels = {'session': self.sessionId}
+        return [
+            ('rtp_client_packets_received_total', 'counter', "RTP packets received (FEC repairs included)", [(labels, stats['received'])]),
+            ('rtp_client_packets_lost_total', 'counter', "RTP packets never received", [(labels, stats['lost'])]),
+            ('rtp_client_packets_reordered_total', 'counter', "RTP packets received out of order", [(labels, stats['reordered'])]),
+            ('rtp_client_packets_duplicate_total', 'counter', "RTP packets received twice", [(labels, stats['duplicates'])]),
+            ('rtp_client_packets_late_total', 'counter', "RTP packets received after their frame was due", [(labels, stats['late'])]),
+            ('rtp_client_packets_recovered_total', 'counter', "RTP packets rebuilt by FEC", [(labels, stats['recovered'])]),
+            ('rtp_client_packets_retransmitted_total', 'counter', "NACKed packets that came in time", [(labels, stats['repaired'])]),
+            ('rtp_client_frames_played_total', 'counter', "Frames handed to the sinks", [(labels, stats['framesPlayed'])]),
+            ('rtp_client_frames_lost_total', 'counter', "Frames incomplete when due", [(labels, stats['framesLost'])]),
+            ('rtp_client_jitter_seconds', 'gauge', "Interarrival jitter", [(labels, stats['jitter'])]),
+            ('rtp_client_playout_delay_seconds', 'gauge', "Playout delay of the jitter buffer", [(labels, stats['delay'])]),
+        ]
+
+    def stats(self):
+        """Return the reception counters, see JitterBuffer.stats, and the
+        packets repaired by FEC (counted as received there)."""
+        stats = self.jitterBuffer.stats()
+        decoder = self.fecDecoder
+        stats['recovered'] = decoder.recovered if decoder is not None else 0
+        stats['parity'] = decoder.parityReceived if decoder is not None else 0
+        return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless RTSP/RTP client: record a stream or count its frames.")
+    parser.add_argument('server')
+    parser.add_argument('port', type=int)
+    parser.add_argument('rtpport', type=int)
+    parser.add_argument('file')
+    parser.add_argument('--record', metavar='MJPEG', help="write the frames to this movie file")
+    parser.add_argument('--duration', type=float, default=10, help="seconds to play (default %(default)s)")
+    parser.add_argument('--multicast', action='store_true', help="ask a channel for multicast delivery")
+    parser.add_argument('--bandwidth', type=int, help="ask the server to stay within this many bits/s")
+    parser.add_argument('--nack', action='store_true', help="ask for lost packets again with RTCP NACKs "
+        "when they can still arrive in time (RTP/AVPF)")
+    parser.add_argument('--tcp', action='store_true', help="receive RTP on the RTSP connection "
+        "(interleaved, for paths that drop UDP)")
+    parser.add_argument('--metrics', action='store_true', help="time the receive path and print the timings at the end")
+    parser.add_argument('--metrics-port', type=int, default=0,
+        help="also serve the timings and counters on http://127.0.0.1:PORT/metrics (Prometheus text format)")
+    parser.add_argument('--capture', metavar='FILE', help="log the RTP/RTCP datagrams received, "
+        "with their arrival times, for Replay.py")
+    parser.add_argument('--fec', metavar='COLSxROWS', help="ask for XOR parity packets over COLS-packet rows "
+        "(and columns of ROWS rows), e.g. 8x1 or 4x4")
+    args = parser.parse_args()
+    fec = None
+    if args.fec:
+        try:
+            fec = tuple(int(n) for n in args.fec.lower().split('x', 1))
+        except ValueError:
+            parser.error("--fec takes COLSxROWS")
+        if len(fec) == 1:
+            fec += (1,)
+        if parseLayout('columns=%d;rows=%d' % fec) is None:
+            parser.error("--fec %s does not fit a 48-packet parity mask" % args.fec)
+
+    counter = CountingSink()
+    sinks = [counter]
+    if args.record:
+        sinks.append(MjpegFileSink(args.record))
+    client = StreamClient(args.server, args.port, args.rtpport, args.file, sinks, multicast=args.multicast, bandwidth=args.bandwidth, fec=fec, nack=args.nack, interleaved=args.tcp)
+    if args.metrics_port:
+        Metrics.serve(args.metrics_port)
+    elif args.metrics:
+        Metrics.enable()
+    Metrics.addCollector(client.collectMetrics)
+    if args.capture:
+        client.startCapture(args.capture)
+    client.connect()
+    if not client.setup(wait=5) or not client.play(wait=5):
+        raise SystemExit("the server did not accept the session")
+    time.sleep(args.duration)
+    stats = client.stats()
+    client.close()
+    print("%d frames (%.1f fps), %d bytes; %d packets received, %d lost, %d recovered by FEC, "
+        "%d retransmitted in time (%d NACKed)" % (counter.frames, counter.fps(), counter.bytes, stats['received'],
+        stats['lost'], stats['recovered'], stats['repaired'], stats['nacked']))
+    if args.metrics:
+        print(Metrics.REGISTRY.summary())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import sys, socket, struct, threading, errno, time, ctypes, ctypes.util
+from collections import OrderedDict
+
+import Metrics
+
+# Linux UDP generic segmentation offload (kernel >= 4.18)
+SOL_UDP = 17
+UDP_SEGMENT = 103
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65000
+
+DEFAULT_BATCH_SIZE = 64
+MAX_IOV = 2
+SEND_MODES = ('auto', 'gso', 'sendmmsg', 'sendto')
+# Destination addresses whose sockaddr is kept, least recently used dropped
+MAX_ADDRESSES = 4096
+
+SEND_SECONDS = Metrics.histogram('rtp_send_seconds', "Time to hand one batch of queued RTP packets to the kernel")
+
+# iov_base is declared as char* so that a bytes object can be stored
+# without copying (ctypes keeps it alive)
+class iovec(ctypes.Structure):
+	_fields_ = [('iov_base', ctypes.c_char_p), ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+	_fields_ = [
+		('msg_name', ctypes.c_void_p),
+		('msg_namelen', ctypes.c_uint32),
+		('msg_iov', ctypes.POINTER(iovec)),
+		('msg_iovlen', ctypes.c_size_t),
+		('msg_control', ctypes.c_void_p),
+		('msg_controllen', ctypes.c_size_t),
+		('msg_flags', ctypes.c_int),
+	]
+
+class mmsghdr(ctypes.Structure):
+	_fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+# struct cmsghdr { size_t len; int level; int type; } followed by the uint16 segment size
+CMSG_HEADER = struct.Struct('@Nii')
+GSO_CMSG_LEN = CMSG_HEADER.size + 2
+GSO_CMSG_SPACE = (GSO_CMSG_LEN + 7) & ~7
+SEGMENT_SIZE = struct.Struct('=H')
+SOCKADDR_IN_SIZE = 16
+
+def loadSendmmsg():
+	"""Return libc's sendmmsg, or None where it does not exist."""
+	if not sys.platform.startswith('linux'):
+		return None
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+		func = libc.sendmmsg
+	except (OSError, AttributeError):
+		return None
+	func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+	func.restype = ctypes.c_int
+	return func
+
+sendmmsg = loadSendmmsg()
+
+def gsoSupported(sock):
+	"""Return True if the kernel accepts UDP_SEGMENT on this socket."""
+	if not sys.platform.startswith('linux'):
+		return False
+	try:
+		sock.getsockopt(SOL_UDP, UDP_SEGMENT)
+		return True
+	except OSError:
+		return False
+
+class UdpBatchSender:
+	"""Queue UDP datagrams from many sessions and send them in batches.
+
+	All sessions share one socket. A datagram is either a bytes-like object
+	or a list of buffers that are sent back to back (scatter/gather). On
+	flush, consecutive datagrams to the same address are merged into one
+	GSO super-datagram where the kernel supports UDP_SEGMENT, and the
+	resulting messages go out with a single sendmmsg call. Without those,
+	every datagram falls back to sendto/sendmsg."""
+
+	def __init__(self, sock=None, mode='auto', batchSize=DEFAULT_BATCH_SIZE):
+		if sock is None:
+			sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock = sock
+		self.batchSize = batchSize
+		self.lock = threading.Lock()
+		self.queued = []
+		self.sent = 0
+		self.dropped = 0
+		self.syscalls = 0
+
+		if mode not in SEND_MODES:
+			raise ValueError("unknown send mode %r" % mode)
+		ipv4 = sock.family == socket.AF_INET
+		self.useSendmmsg = mode in ('auto', 'gso', 'sendmmsg') and sendmmsg is not None and ipv4
+		self.useGso = mode in ('auto', 'gso') and gsoSupported(sock)
+		self.mode = 'gso' if self.useGso else ('sendmmsg' if self.useSendmmsg else 'sendto')
+
+		# Preallocated message vector for sendmmsg: MAX_IOV iovecs and one
+		# GSO control message slot per entry
+		self.msgvec = (mmsghdr * batchSize)()
+		self.iov = (iovec * (batchSize * MAX_IOV))()
+		self.control = ctypes.create_string_buffer(GSO_CMSG_SPACE * batchSize)
+		controlBase = ctypes.addressof(self.control)
+		for i in range(batchSize):
+			hdr = self.msgvec[i].msg_hdr
+			hdr.msg_iov = ctypes.pointer(self.iov[i * MAX_IOV])
+			hdr.msg_iovlen = 1
+			hdr.msg_namelen = SOCKADDR_IN_SIZE
+			CMSG_HEADER.pack_into(self.control, i * GSO_CMSG_SPACE, GSO_CMSG_LEN, SOL_UDP, UDP_SEGMENT)
+		self.controlBase = controlBase
+		self.addresses = OrderedDict()
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def queue(self, data, address):
+		"""Queue one datagram for 'address'; sent on the next flush."""
+		with self.lock:
+			self.queued.append((data, address))
+
+	def queueAll(self, datagrams):
+		"""Queue (data, address) pairs in one go, e.g. a packet fanned out to many viewers."""
+		with self.lock:
+			self.queued.extend(datagrams)
+
+	def sendto(self, data, address):
+		"""Queue one datagram and flush immediately."""
+		with self.lock:
+			self.queued.append((data, address))
+			return self.flushLocked()
+
+	def flush(self):
+		"""Send everything queued. Return the number of datagrams sent."""
+		with self.lock:
+			return self.flushLocked()
+
+	def flushLocked(self):
+		if not self.queued:
+			return 0
+		if Metrics.enabled:
+			start = time.perf_counter()
+		queued = self.queued
+		self.queued = []
+		messages = self.groupGso(queued) if self.useGso else [(buffers(data), address, 0, 1) for data, address in queued]
+
+		before = self.sent
+		if self.useSendmmsg:
+			for first in range(0, len(messages), self.batchSize):
+				self.sendBatch(messages[first:first + self.batchSize])
+		else:
+			for message in messages:
+				self.sendOne(message)
+		if Metrics.enabled:
+			SEND_SECONDS.since(start)
+		return self.sent - before
+
+	def groupGso(self, queued):
+		"""Merge runs of equal-sized datagrams to the same address into GSO messages.
+
+		Return a list of (buffers, address, segment size, datagram count);
+		a segment size of 0 means a plain datagram."""
+		messages = []
+		run = None
+		for data, address in queued:
+			bufs = buffers(data)
+			size = sum(len(b) for b in bufs)
+			if run is not None:
+				runBufs, runAddress, segment, count, total, closed = run
+				if address == runAddress and not closed and size <= segment \
+						and count < GSO_MAX_SEGMENTS and total + size <= GSO_MAX_BYTES:
+					runBufs.extend(bufs)
+					# Only the last segment may be shorter than the others
+					run = (runBufs, runAddress, segment, count + 1, total + size, size < segment)
+					continue
+				messages.append(finishRun(run))
+			run = (list(bufs), address, size, 1, size, False)
+		if run is not None:
+			messages.append(finishRun(run))
+		return messages
+
+	def sendOne(self, message):
+		"""Send one message with sendmsg; used when sendmmsg is unavailable."""
+		bufs, address, segment, count = message
+		ancdata = [(SOL_UDP, UDP_SEGMENT, SEGMENT_SIZE.pack(segment))] if segment else []
+		try:
+			self.sock.sendmsg(bufs, ancdata, 0, address)
+			self.sent += count
+		except BlockingIOError:
+			self.dropped += count
+		except OSError:
+			if segment:
+				# GSO refused (e.g. by the route): send the segments one by one
+				self.useGso = False
+				self.resendSegments(message)
+			else:
+				self.dropped += count
+		self.syscalls += 1
+
+	def resendSegments(self, message):
+		"""Split a GSO message into datagrams and send them individually."""
+		bufs, address, segment, count = message
+		data = b''.join(bufs)
+		for start in range(0, len(data), segment):
+			self.sendOne(([data[start:start + segment]], address, 0, 1))
+
+	def sendBatch(self, messages):
+		"""Send up to batchSize messages with one sendmmsg call."""
+		msgvec = self.msgvec
+		iov = self.iov
+		keep = []
+		for i, (bufs, address, segment, count) in enumerate(messages):
+			hdr = msgvec[i].msg_hdr
+			if len(bufs) <= MAX_IOV:
+				# Gather straight from the caller's buffers, e.g. a per-session
+				# header and a payload shared by many sessions
+				for j, buf in enumerate(bufs):
+					entry = iov[i * MAX_IOV + j]
+					entry.iov_base = buf if type(buf) is bytes else bufferAddress(buf, keep)
+					entry.iov_len = len(buf)
+				hdr.msg_iovlen = len(bufs)
+			else:
+				# One memcpy in C is far cheaper than filling an iovec per buffer from Python
+				data = b''.join(bufs)
+				entry = iov[i * MAX_IOV]
+				entry.iov_base = data
+				entry.iov_len = len(data)
+				hdr.msg_iovlen = 1
+			hdr.msg_name = self.sockaddr(address, keep)
+			if segment:
+				SEGMENT_SIZE.pack_into(self.control, i * GSO_CMSG_SPACE + CMSG_HEADER.size, segment)
+				hdr.msg_control = self.controlBase + i * GSO_CMSG_SPACE
+				hdr.msg_controllen = GSO_CMSG_SPACE
+			else:
+				hdr.msg_control = None
+				hdr.msg_controllen = 0
+
+		done = 0
+		while done < len(messages):
+			result = sendmmsg(self.sock.fileno(), ctypes.addressof(msgvec) + done * ctypes.sizeof(mmsghdr), len(messages) - done, 0)
+			self.syscalls += 1
+			if result > 0:
+				self.sent += sum(m[3] for m in messages[done:done + result])
+				done += result
+				continue
+			# The message at 'done' failed: fall back to the per-message path for it
+			if ctypes.get_errno() in (errno.EAGAIN, errno.ENOBUFS):
+				# EAGAIN/ENOBUFS: the socket buffer is full, drop the rest of the batch
+				self.dropped += sum(m[3] for m in messages[done:])
+				return
+			self.sendOne(messages[done])
+			done += 1
+
+	def sockaddr(self, address, keep):
+		"""Return the address of a cached struct sockaddr_in for an (ip, port) pair.
+
+		The buffer is kept alive in 'keep' too, as it may be evicted
+		before the batch is sent."""
+		addresses = self.addresses
+		name = addresses.get(address)
+		if name is None:
+			ip, port = address
+			raw = struct.pack('=H', socket.AF_INET) + struct.pack('!H', port) + socket.inet_aton(socket.gethostbyname(ip)) + bytes(8)
+			buf = ctypes.create_string_buffer(raw, SOCKADDR_IN_SIZE)
+			name = addresses[address] = (buf, ctypes.addressof(buf))
+			if len(addresses) > MAX_ADDRESSES:
+				addresses.popitem(last=False)
+		else:
+			addresses.move_to_end(address)
+		keep.append(name[0])
+		return name[1]
+
+	def close(self):
+		self.flush()
+		self.sock.close()
+
+def buffers(data):
+	"""Return a datagram as a list of buffers."""
+	if isinstance(data, (list, tuple)):
+		return list(data)
+	return [data]
+
+def finishRun(run):
+	bufs, address, segment, count, total, closed = run
+	return bufs, address, segment if count > 1 else 0, count
+
+def bufferAddress(buf, keep):
+	"""Return the address of a bytes-like object, keeping it alive in 'keep'."""
+	view = memoryview(buf)
+	if view.readonly or not view.c_contiguous:
+		# ctypes can only address writable buffers; copy the others
+		data = view.tobytes()
+		keep.append(data)
+		return data
+	array = (ctypes.c_char * view.nbytes).from_buffer(view)
+	keep.append(array)
+	return ctypes.addressof(array)
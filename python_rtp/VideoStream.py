@@ -1,25 +1,327 @@
-class VideoStream:
+import bisect, os, mmap, struct, threading
+from array import array
+
+# Every frame is stored as a 5-byte ASCII length followed by the JPEG data
+FRAME_HEADER_SIZE = 5
+DEFAULT_FPS = 20
+
+# Sidecar index: magic, size and mtime of the movie file, frame count,
+# followed by the frame offsets (uint64) and lengths (uint32)
+INDEX_EXT = '.idx'
+INDEX_MAGIC = b'VSI1'
+INDEX_HEADER = struct.Struct('<4sQQI')
+
+# Sidecar timing (written by MovieTool): magic, size and mtime of the movie
+# file, frame count and frame rate, followed by the presentation time of
+# every frame and of the end of the movie (uint32 milliseconds)
+TIMING_EXT = '.tim'
+TIMING_MAGIC = b'VST1'
+TIMING_HEADER = struct.Struct('<4sQQId')
+
+def writeSidecar(path, data):
+	"""Replace a sidecar file atomically, so readers never see half of it."""
+	tmp = path + '.tmp'
+	with open(tmp, 'wb') as file:
+		for chunk in data:
+			file.write(chunk)
+	os.replace(tmp, path)
+
+def writeIndex(filename, fileSize, fileMtime, offsets, lengths):
+	"""Write the sidecar index of a movie; raises OSError."""
+	writeSidecar(filename + INDEX_EXT, (INDEX_HEADER.pack(INDEX_MAGIC, fileSize, fileMtime, len(offsets)),
+		offsets.tobytes(), lengths.tobytes()))
+
+def writeTiming(filename, fileSize, fileMtime, fps, times):
+	"""Write the sidecar timing of a movie: 'times' holds one entry per frame
+	and one for the end, in milliseconds. Raises OSError."""
+	writeSidecar(filename + TIMING_EXT, (TIMING_HEADER.pack(TIMING_MAGIC, fileSize, fileMtime, len(times) - 1, fps),
+		times.tobytes()))
+
+def readSidecar(path, header):
+	"""Return (header fields, rest) of a sidecar file, or None if it is missing or short."""
+	try:
+		with open(path, 'rb') as file:
+			raw = file.read()
+	except OSError:
+		return None
+	if len(raw) < header.size:
+		return None
+	return header.unpack_from(raw), raw[header.size:]
+
+def readIndex(filename, fileSize, fileMtime):
+	"""Return (offsets, lengths) from the sidecar index if it matches the movie, else None."""
+	sidecar = readSidecar(filename + INDEX_EXT, INDEX_HEADER)
+	if sidecar is None:
+		return None
+	(magic, size, mtime, count), raw = sidecar
+	if magic != INDEX_MAGIC or size != fileSize or mtime != fileMtime:
+		return None
+	offsets = array('Q')
+	lengths = array('I')
+	end = count * offsets.itemsize
+	if len(raw) != end + count * lengths.itemsize:
+		return None
+	offsets.frombytes(raw[:end])
+	lengths.frombytes(raw[end:])
+	return offsets, lengths
+
+def readTiming(filename, fileSize, fileMtime, frameCount):
+	"""Return (fps, times) from the sidecar timing if it matches the movie, else None."""
+	sidecar = readSidecar(filename + TIMING_EXT, TIMING_HEADER)
+	if sidecar is None:
+		return None
+	(magic, size, mtime, count, fps), raw = sidecar
+	times = array('I')
+	if magic != TIMING_MAGIC or size != fileSize or mtime != fileMtime or count != frameCount \
+			or len(raw) != (count + 1) * times.itemsize or not fps > 0:
+		return None
+	times.frombytes(raw)
+	return fps, times
+
+class MovieFile:
+	"""A memory-mapped movie and its frame index, shared by every session."""
+
 	def __init__(self, filename):
 		self.filename = filename
+		self.path = os.path.realpath(filename)
+		self.file = open(filename, 'rb')
+		self.refs = 0
+
+		stat = os.fstat(self.file.fileno())
+		self.fileSize = stat.st_size
+		self.fileMtime = stat.st_mtime_ns
+		if self.fileSize:
+			self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		else:
+			# mmap refuses empty files
+			self.data = b''
+		self.view = memoryview(self.data)
+
+		index = self.loadIndex()
+		if index is None:
+			index = self.buildIndex()
+			self.saveIndex(index)
+		self.offsets, self.lengths = index
+		# Frame rate and presentation times (ms) from the timing sidecar, if any
+		self.fps, self.times = self.loadTiming()
+		self.meanSize = None
+
+	def buildIndex(self):
+		"""Scan the movie once and return the frame offsets and lengths."""
+		offsets = array('Q')
+		lengths = array('I')
+		pos = 0
+		while pos + FRAME_HEADER_SIZE <= self.fileSize:
+			try:
+				framelength = int(self.data[pos:pos + FRAME_HEADER_SIZE])
+			except ValueError:
+				break
+			start = pos + FRAME_HEADER_SIZE
+			# Ignore a truncated last frame
+			if start + framelength > self.fileSize:
+				break
+			offsets.append(start)
+			lengths.append(framelength)
+			pos = start + framelength
+		return offsets, lengths
+
+	def indexFilename(self):
+		"""Return the path of the sidecar index file."""
+		return self.filename + INDEX_EXT
+
+	def loadIndex(self):
+		"""Load the sidecar index if it matches the movie file, else return None."""
+		return readIndex(self.filename, self.fileSize, self.fileMtime)
+
+	def saveIndex(self, index):
+		"""Persist the frame index next to the movie so restarts skip the scan."""
+		offsets, lengths = index
 		try:
-			self.file = open(filename, 'rb')
+			writeIndex(self.filename, self.fileSize, self.fileMtime, offsets, lengths)
+		except OSError:
+			# Read-only media directory: keep the in-memory index only
+			pass
+
+	def loadTiming(self):
+		"""Return (fps, times) from the sidecar timing if it matches the movie, else (None, None)."""
+		return readTiming(self.filename, self.fileSize, self.fileMtime, len(self.offsets)) or (None, None)
+
+	def getFrame(self, index):
+		"""Return frame 'index' (0-based) as a zero-copy memoryview."""
+		offset = self.offsets[index]
+		return self.view[offset:offset + self.lengths[index]]
+
+	def frameCount(self):
+		"""Return the number of frames in the movie."""
+		return len(self.offsets)
+
+	def meanFrameSize(self):
+		"""Return the average frame size in bytes."""
+		if self.meanSize is None:
+			self.meanSize = sum(self.lengths) / len(self.lengths) if len(self.lengths) else 0.0
+		return self.meanSize
+
+	def close(self):
+		"""Release the mapping and the file handle."""
+		self.view.release()
+		if isinstance(self.data, mmap.mmap):
+			try:
+				self.data.close()
+			except BufferError:
+				# Frames handed out are still referenced; the mapping goes away with them
+				pass
+		self.file.close()
+
+# Open movies by real path, so that sessions watching the same movie
+# share one mapping and one index
+movies = {}
+moviesLock = threading.Lock()
+
+def openMovie(filename):
+	"""Return the shared MovieFile for 'filename', opening it if needed."""
+	key = os.path.realpath(filename)
+	stat = os.stat(key)
+	with moviesLock:
+		movie = movies.get(key)
+		# A movie replaced on disk is opened afresh; sessions on the old
+		# one keep it until they release it
+		if movie is None or (movie.fileSize, movie.fileMtime) != (stat.st_size, stat.st_mtime_ns):
+			movie = movies[key] = MovieFile(filename)
+		movie.refs += 1
+		return movie
+
+def releaseMovie(movie):
+	"""Drop one reference to a MovieFile; the last one closes it."""
+	with moviesLock:
+		movie.refs -= 1
+		if movie.refs > 0:
+			return
+		if movies.get(movie.path) is movie:
+			del movies[movie.path]
+	movie.close()
+
+class VideoStream:
+	def __init__(self, filename, fps=None, cache=None, renditions=None):
+		self.filename = filename
+		try:
+			self.movie = openMovie(filename)
 		except:
 			raise IOError
+		# The rate asked for, else the movie's own (from its timing sidecar)
+		self.fps = fps or self.movie.fps or DEFAULT_FPS
+		# The movie's presentation times only hold at its own rate
+		self.times = self.movie.times if self.fps == self.movie.fps else None
 		self.frameNum = 0
-		
+		self.cache = cache
+		# Frames before this one have been requested from the read-ahead stage
+		self.prefetched = 0
+		# Quality ladder (see Renditions): frames come from the movie of the
+		# current level, level 0 being the movie itself
+		self.renditions = renditions
+		self.level = 0
+		self.levelMovies = {0: self.movie}
+		if renditions:
+			renditions.request(filename)
+
 	def nextFrame(self):
 		"""Get next frame."""
-		data = self.file.read(5) # Get the framelength from the first 5 bits
-		if data: 
-			framelength = int(data)
-							
-			# Read the current frame
-			data = self.file.read(framelength)
-			self.frameNum += 1
+		if self.frameNum >= self.movie.frameCount():
+			return b''
+		data = self.getFrame(self.frameNum)
+		self.frameNum += 1
 		return data
-		
+
+	def getFrame(self, index):
+		"""Return frame 'index' (0-based), from the shared cache if there is one."""
+		movie = self.levelMovies[self.level]
+		if self.cache is None:
+			return movie.getFrame(index)
+		readAhead = self.cache.readAhead
+		ahead = self.prefetched - index
+		if readAhead and (ahead <= readAhead // 2 or ahead > readAhead + 1):
+			# Running low, or the stream seeked: keep the next frames warm
+			if 0 < ahead <= readAhead + 1:
+				start = self.prefetched
+			else:
+				start = index + 1
+			self.prefetched = index + 1 + readAhead
+			self.cache.prefetch(movie, start, self.prefetched - start)
+		return self.cache.get(movie, index)
+
+	def levels(self):
+		"""Return the number of quality levels."""
+		return self.renditions.levels() if self.renditions else 1
+
+	def setLevel(self, level):
+		"""Serve the next frames from rendition 'level', or the closest better
+		one that is ready. Return the level used."""
+		while level > 0 and not self.openLevel(level):
+			level -= 1
+		if level != self.level:
+			self.level = level
+			# The read-ahead of the previous level does not help this one
+			self.prefetched = 0
+		return level
+
+	def openLevel(self, level):
+		if level in self.levelMovies:
+			return True
+		if not self.renditions.ready(self.filename, level):
+			return False
+		try:
+			movie = openMovie(self.renditions.path(self.filename, level))
+		except OSError:
+			return False
+		if movie.frameCount() != self.movie.frameCount():
+			# Not built from this version of the movie
+			releaseMovie(movie)
+			return False
+		self.levelMovies[level] = movie
+		return True
+
+	def levelRate(self, level):
+		"""Return the bit rate of a level at this stream's frame rate
+		(estimated from the movie until the rendition is built)."""
+		movie = self.levelMovies.get(level)
+		if movie is not None:
+			return movie.meanFrameSize() * 8 * self.fps
+		return self.levelRate(0) * self.renditions.sizeFactor(level)
+
 	def frameNbr(self):
 		"""Get frame number."""
 		return self.frameNum
-	
-	
\ No newline at end of file
+
+	def frameCount(self):
+		"""Return the number of frames in the movie."""
+		return self.movie.frameCount()
+
+	def duration(self):
+		"""Return the movie duration in seconds."""
+		if self.times is not None:
+			return self.times[-1] / 1000
+		return self.movie.frameCount() / self.fps
+
+	def seek(self, frameNbr):
+		"""Make frame 'frameNbr' (0-based) the next frame returned by nextFrame."""
+		self.frameNum = max(0, min(int(frameNbr), self.movie.frameCount()))
+
+	def seekTime(self, seconds):
+		"""Seek to the frame shown at 'seconds' from the start of the movie."""
+		if self.times is not None:
+			self.seek(bisect.bisect_right(self.times, seconds * 1000) - 1)
+		else:
+			self.seek(seconds * self.fps)
+
+	def position(self):
+		"""Return the playback position in seconds."""
+		if self.times is not None:
+			return self.times[self.frameNum] / 1000
+		return self.frameNum / self.fps
+
+	def close(self):
+		"""Release this session's reference to the movie."""
+		if self.movie is not None:
+			for movie in self.levelMovies.values():
+				releaseMovie(movie)
+			self.levelMovies = {}
+			self.movie = None
@@ -0,0 +1,125 @@
+import multiprocessing, queue, socket, time
+
+# Seconds between two stats messages of a worker
+STATS_INTERVAL = 5
+
+# Delay before restarting a worker, doubled while it keeps crashing
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+
+# A worker up this long is healthy again: its restart delay is reset
+STABLE_TIME = 60
+
+# Stats of the workers that are summed up; any other number is a maximum
+SUMMED = ('sessions', 'opened', 'expired', 'refused', 'reservedKbps', 'packets', 'dropped')
+
+def reusePortSupported():
+	"""Return True if several sockets may listen on one port (Linux, BSD)."""
+	return hasattr(socket, 'SO_REUSEPORT')
+
+class WorkerPool:
+	"""Supervisor of N server processes sharing the RTSP port.
+
+	Every worker listens on the port itself with SO_REUSEPORT, so the
+	kernel spreads new connections over them, and runs its own sessions,
+	scheduler and RTP socket: nothing is shared but the port. A worker
+	that exits is restarted, after a growing delay if it keeps crashing.
+	Workers send their counters every STATS_INTERVAL seconds; report()
+	adds them up.
+
+	'target(index, statsQueue, *args)' is run in each worker process."""
+
+	def __init__(self, count, target, args=()):
+		self.count = count
+		self.target = target
+		self.args = tuple(args)
+		self.statsQueue = multiprocessing.Queue()
+		self.processes = [None] * count
+		self.started = [0.0] * count
+		self.delays = [RESTART_DELAY] * count
+		self.restartAt = [None] * count
+		self.latest = {}
+		self.restarts = 0
+
+	def start(self, index):
+		process = multiprocessing.Process(target=self.target, args=(index, self.statsQueue) + self.args,
+			name='worker-%d' % index, daemon=True)
+		process.start()
+		self.processes[index] = process
+		self.started[index] = time.monotonic()
+		self.restartAt[index] = None
+
+	def supervise(self, now):
+		"""Restart the workers that exited, once their delay has passed."""
+		for index, process in enumerate(self.processes):
+			if process.is_alive():
+				continue
+			if self.restartAt[index] is None:
+				if now - self.started[index] >= STABLE_TIME:
+					self.delays[index] = RESTART_DELAY
+				print("Worker %d (pid %d) exited with code %s, restarting in %.0f s" % (
+					index, process.pid, process.exitcode, self.delays[index]))
+				self.latest.pop(index, None)
+				self.restartAt[index] = now + self.delays[index]
+				self.delays[index] = min(MAX_RESTART_DELAY, 2 * self.delays[index])
+			elif now >= self.restartAt[index]:
+				process.join()
+				self.restarts += 1
+				self.start(index)
+
+	def collect(self, timeout):
+		"""Take in the workers' stats messages for up to 'timeout' seconds."""
+		deadline = time.monotonic() + timeout
+		while True:
+			try:
+				index, stats = self.statsQueue.get(timeout=max(0.0, deadline - time.monotonic()))
+			except queue.Empty:
+				return
+			self.latest[index] = stats
+
+	def totals(self):
+		"""Return the stats of all workers combined."""
+		totals = {}
+		for stats in self.latest.values():
+			for name, value in stats.items():
+				if name in SUMMED:
+					totals[name] = totals.get(name, 0) + value
+				else:
+					totals[name] = max(totals.get(name, value), value)
+		return totals
+
+	def report(self):
+		"""Return a one-line summary of the workers and their combined stats."""
+		alive = sum(1 for process in self.processes if process.is_alive())
+		t = self.totals()
+		return ("Workers: %d/%d up, %d restarts; %d sessions (%d opened, %d expired, %d refused), "
+			"%.0f kbit/s reserved, %d packets sent, %d dropped, lateness p99 %.2f ms") % (
+			alive, self.count, self.restarts, t.get('sessions', 0), t.get('opened', 0), t.get('expired', 0),
+			t.get('refused', 0), t.get('reservedKbps', 0), t.get('packets', 0), t.get('dropped', 0),
+			1e3 * t.get('latenessP99', 0))
+
+	def run(self, reportInterval):
+		"""Start the workers and supervise them until interrupted."""
+		for index in range(self.count):
+			self.start(index)
+		nextReport = time.monotonic() + reportInterval
+		try:
+			while True:
+				self.collect(1.0)
+				now = time.monotonic()
+				self.supervise(now)
+				if now >= nextReport:
+					print(self.report())
+					nextReport = now + reportInterval
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.stop()
+
+	def stop(self):
+		for process in self.processes:
+			if process is not None and process.is_alive():
+				process.terminate()
+		for process in self.processes:
+			if process is not None:
+				process.join(5)